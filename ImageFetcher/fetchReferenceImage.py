@@ -186,67 +186,90 @@ def fetchSensorSeason(sensorName, bounds, date, bigRange=False):
     return fullCollection
 
 
-def findClearImage(bounds, date):
-    '''Find a suitable reference image at a location'''
-    
-    MAX_CLOUD_PERCENTAGE = 0.00
-
-    # Needed to change EE formats for later function calls
-    rectBounds = bounds
+# Minimum number of images for a sensor's normal season composite to be used.
+DESIRED_NUM_IMAGES = 10
+
+# Sensor choices made by findClearImage, keyed by approximate location and season.
+# - Values are (sensor index, bigRange)
+_sensorChoices = {}
+
+def getChoiceKey(longitude, latitude, date):
+    '''The sensor choice is shared by requests near the same place and season.'''
+    CHOICE_DEGREES = 0.5
+    return (round(longitude/CHOICE_DEGREES), round(latitude/CHOICE_DEGREES), date[0:7])
+
+def getChosenSensor(longitude, latitude, date):
+    '''Returns the name of the sensor already chosen for requests near a location and date,
+       or None if no choice has been made there yet.'''
+    choice = _sensorChoices.get(getChoiceKey(longitude, latitude, date))
+    if choice is None:
+        return None
+    return LANDSAT_SENSORS[choice[0]]['name']
+
+def getSensorComposite(sensor, bounds, date, bigRange=False):
+    '''Build the composite reference image for one sensor'''
+    requestString = sensor['name']
+    if bigRange:
+        refImageCollection = fetchSensorSeason(requestString, bounds, date, bigRange=True)
+        return ee.Algorithms.Landsat.simpleComposite(refImageCollection, asFloat=True)
+
+    refImageCollection = fetchSensorSeason(requestString, bounds, date)
+    percentile = 50 # Default values
+    cloudScoreRange = 10
+    maxDepth = 40
+    return ee.Algorithms.Landsat.simpleComposite(refImageCollection,
+                            percentile, cloudScoreRange, maxDepth, asFloat=True)
+
+def chooseSensor(counts):
+    '''Given the number of images found for each sensor, return (sensor index, bigRange).
+       Sensors are in order of decreasing desireability, use the first with enough
+       images or otherwise the one with the most images across all dates.'''
+    bestNumImages = 0
+    bestSensor    = None
+    for (i, numRefImagesFound) in enumerate(counts):
+        print ('Found ' + str(numRefImagesFound) + ' landsat images in this region using sensor '
+               + LANDSAT_SENSORS[i]['name'])
+        if numRefImagesFound >= DESIRED_NUM_IMAGES:
+            return (i, False)
+        if numRefImagesFound > bestNumImages:
+            bestNumImages = numRefImagesFound
+            bestSensor    = i
+    if bestSensor is None:
+        return None
+    # We did not get as many images as we wanted, but we still got something with one sensor
+    return (bestSensor, True)
+
+def findClearImage(bounds, date, choiceKey=None, deadline=None):
+    '''Find a suitable reference image at a location.
+       Returns (composite, sensor).
+       If choiceKey is provided the sensor choice is remembered for later calls with that key,
+       which then make no Earth Engine requests here.
+       Earth Engine requests are not started after deadline, a time.time() value.'''
 
     # TODO: Any use for the water mask?
     ## Get the permanent water mask
     ## - We change the band name to make this work with the evaluation function call further down
     #waterMask = ee.Image("MODIS/MOD44W/MOD44W_005_2000_02_24").select(['water_mask'], ['b1'])
 
-    
-    DESIRED_NUM_IMAGES = 10
-    bestNumImages = 0
-    bestSensor    = None
-    
-    # Keep trying sensors until we get a good image
-    # - The sensors are in order of decreasing desireability
-    for sensor in LANDSAT_SENSORS:
-        requestString = sensor['name']
-    
-        #print 'Looking for sensor: ' + requestString
-    
-        #refImageCollection = ee.ImageCollection(requestString).filterDate(dateStart, dateEnd).filterBounds(bounds)
-        refImageCollection = fetchSensorSeason(requestString, bounds, date)
-        numRefImagesFound  = refImageCollection.size().getInfo()
-        if (numRefImagesFound > bestNumImages):
-            bestNumImages = numRefImagesFound
-            bestSensor    = sensor
-        print 'Found ' + str(numRefImagesFound) + ' landsat images in this region using sensor ' + requestString
-        
-        if numRefImagesFound < DESIRED_NUM_IMAGES:
-            continue # Skip sensors without enough image data
-    
-        percentile = 50 # Default values
-        cloudScoreRange = 10
-        maxDepth = 40
-        composite = ee.Algorithms.Landsat.simpleComposite(refImageCollection,
-                                percentile, cloudScoreRange, maxDepth, asFloat=True)
-        
-        #cloudPercentage = getCloudPercentage(composite, rectBounds)
-        #print 'Cloud percentage in composite = ' + str(cloudPercentage)
-        
-        return (composite, sensor)
-
-    if (bestNumImages > 0):
-        requestString = bestSensor['name']
-        # We did not get as many images as we wanted, but we still got something with one sensor
-        #refImageCollection = ee.ImageCollection(sensorStringNames[bestSensor]).filterDate(dateStart, dateEnd).filterBounds(bounds)
-        refImageCollection = fetchSensorSeason(requestString, bounds, date, bigRange=True)
-        composite = ee.Algorithms.Landsat.simpleComposite(refImageCollection, asFloat=True)
-        return (composite, bestSensor)
-        
-
-    # If we made it here then we failed to find any images!
-    
-    raise Exception('Did not find enough landsat images in the requested region: ' + str(bounds.getInfo()))
+    if (choiceKey is not None) and (choiceKey in _sensorChoices):
+        choice = _sensorChoices[choiceKey]
+    else:
+        # Count the images for every sensor in a single request, then only
+        #  build the composite for the sensor we choose.
+        counts = ee.List([fetchSensorSeason(sensor['name'], bounds, date).size()
+                          for sensor in LANDSAT_SENSORS])
+        choice = chooseSensor(miscUtilities.getInfoBefore(counts, deadline))
+        if choice is None:
+            # If we made it here then we failed to find any images!
+            raise Exception('Did not find enough landsat images in the requested region: ' + str(bounds.getInfo()))
+        if choiceKey is not None:
+            _sensorChoices[choiceKey] = choice
+
+    (sensorIndex, bigRange) = choice
+    sensor    = LANDSAT_SENSORS[sensorIndex]
+    composite = getSensorComposite(sensor, bounds, date, bigRange)
+    return (composite, sensor)
 
-    
     # TODO: A last check for cloud percentage?
     
     #refImageList       = refImageCollection.toList(100)
@@ -265,36 +288,17 @@ def findClearImage(bounds, date):
     #return refImage
 
 
-def fetchReferenceImage(longitude, latitude, metersPerPixel, date, outputPath):
-    '''Fetch a reference Earth image for a given location and save it to disk'''
-    # Try to get an image this size at the requested resolution.
-    #DESIRED_IMAGE_SIZE = 2000
-    #bufferSizeMeters = (DESIRED_IMAGE_SIZE / 2.0) * metersPerPixel
-
-    # Cap the requested image resolution at the resolution of the input images.
-    # - TODO: Vary this with the data source that is used.
-    BEST_MPP = 25
-    mppToUse = metersPerPixel
-    if mppToUse < BEST_MPP:
-        mppToUse = BEST_MPP
+def fetchReferenceImage(longitude, latitude, metersPerPixel, date, outputPath, bufferScale=1.0,
+                        deadline=None):
+    '''Fetch a reference Earth image for a given location and save it to disk.
+       The fetched region is bufferScale times the normal size in each direction.
+       Raises an exception if the fetch fails or does not finish before deadline,
+       a time.time() value.  Retrying is left to the caller.
+       Returns (percentValid, metersPerPixel, sensorName)'''
 
-    MIN_IMAGE_SIZE  = 2000  # Don't fetch an image smaller than this
-    MAX_IMAGE_SIZE  = 3000
-    MAX_ERROR_RANGE = 100000 # 50km possible error handled by this amount
-    
-    # Default calculation is based on the max error range, but it is capped by pixel size
-    bufferSizeMeters = MAX_ERROR_RANGE / 2.0
-    estPixelSize     = MAX_ERROR_RANGE / mppToUse
-    if estPixelSize < MIN_IMAGE_SIZE:
-        bufferSizeMeters = (MIN_IMAGE_SIZE*mppToUse) / 2.0
-    if estPixelSize > MAX_IMAGE_SIZE:
-        print 'Warning: capping image size below ' + str(estPixelSize)
-        bufferSizeMeters = (MAX_IMAGE_SIZE*mppToUse) / 2.0
-        # TODO: Lower the image resolution in this case?
+    (mppToUse, bufferSizeMeters) = miscUtilities.getReferenceRequestSize(metersPerPixel)
+    bufferSizeMeters *= bufferScale
 
-    
-    # TODO: Check for a max size too!
-    
     center = ee.Geometry.Point(longitude, latitude)
     circle = center.buffer(bufferSizeMeters)
     bounds = circle.bounds()
@@ -314,8 +318,10 @@ def fetchReferenceImage(longitude, latitude, metersPerPixel, date, outputPath):
 
 
     #try:
+    choiceKey = getChoiceKey(longitude, latitude, date)
+
     #image = findClearImage(bounds, dateStart, dateEnd)
-    (image, sensor) = findClearImage(bounds, eeDate)
+    (image, sensor) = findClearImage(bounds, eeDate, choiceKey, deadline)
     #except:
     #    print 'Failed to find reference image, trying again with larger boundary.'
     #    center = ee.Geometry.Point(longitude, latitude)
@@ -323,9 +329,6 @@ def fetchReferenceImage(longitude, latitude, metersPerPixel, date, outputPath):
     #    bounds = circle.bounds()
     #    image = findClearImage(bounds, dateStart, dateEnd)
 
-    percentValid = image.mask().reduceRegion(ee.Reducer.mean(), bounds, scale*10).getInfo()['B1']
-    print 'Percent valid = ' + str(percentValid)
-    
     # Dynamically estimating the search range seems like more trouble than it is worth at the moment
     
     #print image.select(sensor['rgbBands']).reduceRegion(ee.Reducer.mean(), bounds, 400).getInfo()
@@ -345,23 +348,11 @@ def fetchReferenceImage(longitude, latitude, metersPerPixel, date, outputPath):
     #landsatVisParams = {'bands': sensor['rgbBands'], 'gain': '1.8, 1.5, 1.0'}
 
     # Download the image and return percent valid pixels and the resolution we used.
-    # - Earth Engine sometimes fails so try a few times before giving up.
-    
-    NUM_RETRIES = 6
-    SLEEP_TIME  = 10
-    numTries = 0
-    while True:
-        if numTries < (NUM_RETRIES-1):
-            try:
-                miscUtilities.downloadEeImage(image, bounds, scale, outputPath, landsatVisParams)
-                return (percentValid, mppToUse)
-            except Exception: # After the first failures, wait and try again.
-                print 'Caught exception downloading reference image, will wait and retry.'
-                time.sleep(SLEEP_TIME)
-            numTries += 1
-        else: # Last pass, don't catch the exception.
-            miscUtilities.downloadEeImage(image, bounds, scale, outputPath, landsatVisParams)
-            return (percentValid, mppToUse)
+    # - The valid fraction is measured on the downloaded image so it costs no extra request.
+    miscUtilities.downloadEeImage(image, bounds, scale, outputPath, landsatVisParams, deadline)
+    percentValid = miscUtilities.getImagePercentValid(outputPath)
+    print 'Percent valid = ' + str(percentValid)
+    return (percentValid, mppToUse, sensor['name'])
     
 
 #======================================================================================================
@@ -0,0 +1,66 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+'''
+    Reference image source which reads from a mosaic on local disk instead of
+    Earth Engine.  Produces the same output as fetchReferenceImage.py.
+'''
+
+import os
+
+import miscUtilities
+import offline_config
+
+
+def fetchReferenceImage(longitude, latitude, metersPerPixel, date, outputPath, bufferScale=1.0,
+                        deadline=None):
+    '''Cut a reference image for a given location out of the local mosaic and save it to disk.
+       The mosaic covers a single season so the date is not used, and reading it
+       is quick enough that the deadline is only checked before starting.
+       The fetched region is bufferScale times the normal size in each direction.
+       Returns (percentValid, metersPerPixel, sensorName)'''
+
+    from osgeo import gdal
+
+    mosaicPath = offline_config.LOCAL_REFERENCE_MOSAIC
+    if not os.path.exists(mosaicPath):
+        raise Exception('Local reference mosaic does not exist: ' + mosaicPath)
+
+    miscUtilities.getRemainingSeconds(deadline)
+    (mppToUse, bufferSizeMeters) = miscUtilities.getReferenceRequestSize(metersPerPixel)
+    bufferSizeMeters *= bufferScale
+    bounds = miscUtilities.getLonLatBounds(longitude, latitude, bufferSizeMeters)
+
+    # Match the pixel size Earth Engine uses for a meters scale in EPSG:4326.
+    METERS_PER_DEGREE_AT_EQUATOR = 111319.49
+    degreesPerPixel = mppToUse / METERS_PER_DEGREE_AT_EQUATOR
+
+    # GDAL reads from the closest overview of the mosaic and only the tiles
+    #  which overlap the requested region.
+    dataset = gdal.Warp(outputPath, mosaicPath, format='GTiff', dstSRS='EPSG:4326',
+                        outputBounds=bounds, xRes=degreesPerPixel, yRes=degreesPerPixel,
+                        resampleAlg='average', outputType=gdal.GDT_Byte,
+                        dstNodata=0, multithread=True)
+    if dataset is None:
+        raise Exception('Failed to read reference image from local mosaic ' + mosaicPath)
+
+    # Pixels outside the mosaic or without data are marked invalid.
+    percentValid = miscUtilities.getPercentValid(dataset)
+    dataset = None # Close the file
+    print 'Percent valid = ' + str(percentValid)
+
+    sensorName = 'local:' + os.path.basename(mosaicPath)
+    return (percentValid, mppToUse, sensorName)
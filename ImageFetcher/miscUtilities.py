@@ -15,12 +15,16 @@
 # the License.
 # -----------------------------------------------------------------------------
 
-import ee
+try:
+    import ee
+except ImportError: # Only needed to fetch from Earth Engine
+    ee = None
 import os
 import math
 import json
 import threading
 import time
+import random
 import xml.etree.cElementTree as ET
 import tempfile
 import zipfile
@@ -48,6 +52,43 @@ def safe_get_info(ee_object, max_num_attempts=None):
             raise Exception('safe_get_info failed to succeed after ' +str(num_attempts)+ ' attempts!')
 
 
+def retryWithBackoff(function, maxAttempts, baseDelay, maxDelay, deadline=None):
+    '''Call function until it succeeds and return its result.  After each failure wait a
+       random time up to an exponentially growing limit before trying again.
+       Gives up and raises the last exception after maxAttempts calls or if the next
+       call would start after deadline, a time.time() value.'''
+    numAttempts = 0
+    while True:
+        try:
+            return function()
+        except Exception as e:
+            numAttempts += 1
+            delay = random.uniform(0, min(maxDelay, baseDelay * 2**numAttempts))
+            if (numAttempts >= maxAttempts) or (deadline and (time.time() + delay > deadline)):
+                raise
+            print 'Caught exception: %s. Waiting %.1fs and then retrying.' % (e, delay)
+            time.sleep(delay)
+
+
+def getRemainingSeconds(deadline):
+    '''Returns the number of seconds left before deadline, a time.time() value,
+       or None if there is no deadline.  Raises an exception if it has passed.'''
+    if deadline is None:
+        return None
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise Exception('Reference fetch deadline passed')
+    return remaining
+
+
+def getInfoBefore(eeObject, deadline):
+    '''Call getInfo() on an Earth Engine object if deadline has not passed yet.
+       The Earth Engine request timeout is shared by every thread in the process,
+       so it is left at its default rather than set from this deadline.'''
+    getRemainingSeconds(deadline)
+    return eeObject.getInfo()
+
+
 class waitForEeResult(threading.Thread):
     '''Starts up a thread to run a pair of functions in series'''
 
@@ -82,13 +123,13 @@ def regionIsInUnitedStates(region):
     
     
     
-def unComputeRectangle(eeRect):
+def unComputeRectangle(eeRect, deadline=None):
     '''"Decomputes" an ee Rectangle object so more functions will work on it'''
     # This function is to work around some dumb EE behavior
 
     LON = 0 # Helper constants
     LAT = 1    
-    rectCoords  = eeRect.getInfo()['coordinates']    # EE object -> dictionary -> string
+    rectCoords  = getInfoBefore(eeRect, deadline)['coordinates'] # EE object -> dictionary -> string
     minLon      = rectCoords[0][0][LON]           # Exctract the numbers from the string
     minLat      = rectCoords[0][0][LAT]
     maxLon      = rectCoords[0][2][LON]
@@ -152,8 +193,90 @@ def computeScale(metersPerDegree, metersPerPixel):
     return scale
 
 
-def downloadEeImage(eeObject, bbox, scale, file_path, vis_params=None):
-    '''Downloads an Earth Engine image object to the specified path'''
+def getReferenceRequestSize(metersPerPixel):
+    '''Returns (metersPerPixel, bufferSizeMeters) to use when fetching a reference image
+       for an input image with the given resolution.'''
+
+    # Try to get an image this size at the requested resolution.
+    #DESIRED_IMAGE_SIZE = 2000
+    #bufferSizeMeters = (DESIRED_IMAGE_SIZE / 2.0) * metersPerPixel
+
+    # Cap the requested image resolution at the resolution of the input images.
+    # - TODO: Vary this with the data source that is used.
+    BEST_MPP = 25
+    mppToUse = metersPerPixel
+    if mppToUse < BEST_MPP:
+        mppToUse = BEST_MPP
+
+    MIN_IMAGE_SIZE  = 2000  # Don't fetch an image smaller than this
+    MAX_IMAGE_SIZE  = 3000
+    MAX_ERROR_RANGE = 100000 # 50km possible error handled by this amount
+    
+    # Default calculation is based on the max error range, but it is capped by pixel size
+    bufferSizeMeters = MAX_ERROR_RANGE / 2.0
+    estPixelSize     = MAX_ERROR_RANGE / mppToUse
+    if estPixelSize < MIN_IMAGE_SIZE:
+        bufferSizeMeters = (MIN_IMAGE_SIZE*mppToUse) / 2.0
+    if estPixelSize > MAX_IMAGE_SIZE:
+        print 'Warning: capping image size below ' + str(estPixelSize)
+        bufferSizeMeters = (MAX_IMAGE_SIZE*mppToUse) / 2.0
+        # TODO: Lower the image resolution in this case?
+
+    # TODO: Check for a max size too!
+
+    return (mppToUse, bufferSizeMeters)
+
+
+# Approximate length of a degree of latitude
+METERS_PER_DEGREE = 111320.0
+
+def getLonLatBounds(longitude, latitude, bufferSizeMeters):
+    '''Returns the approximate (minLon, minLat, maxLon, maxLat) bounding box of a
+       circle around a point.'''
+    latDegrees = bufferSizeMeters / METERS_PER_DEGREE
+    lonDegrees = latDegrees / max(math.cos(math.radians(latitude)), 0.01)
+    return (longitude-lonDegrees, latitude-latDegrees,
+            longitude+lonDegrees, latitude+latDegrees)
+
+def getBoundsSizeMeters(bounds):
+    '''Returns the approximate size of the longer side of a (minLon, minLat, maxLon, maxLat)
+       bounding box in meters.'''
+    (minLon, minLat, maxLon, maxLat) = bounds
+    centerLat = (minLat + maxLat) / 2.0
+    width  = (maxLon - minLon) * METERS_PER_DEGREE * math.cos(math.radians(centerLat))
+    height = (maxLat - minLat) * METERS_PER_DEGREE
+    return max(width, height)
+
+
+def getPercentValid(dataset):
+    '''Returns the fraction of valid pixels in an open GDAL reference image.
+       Earth Engine downloads have no nodata value and write masked pixels as zero
+       in every band, so those are counted as invalid if the image has no mask.'''
+    from osgeo import gdal
+    band = dataset.GetRasterBand(1)
+    if not (band.GetMaskFlags() & gdal.GMF_ALL_VALID):
+        return float((band.GetMaskBand().ReadAsArray() > 0).mean())
+    valid = None
+    for b in range(1, dataset.RasterCount+1):
+        bandValid = dataset.GetRasterBand(b).ReadAsArray() > 0
+        valid = bandValid if valid is None else (valid | bandValid)
+    return float(valid.mean())
+
+
+def getImagePercentValid(imagePath):
+    '''Returns the fraction of valid pixels in a reference image file, see getPercentValid.'''
+    from osgeo import gdal
+    dataset = gdal.Open(imagePath)
+    if dataset is None:
+        raise Exception('GDAL could not open image file ' + imagePath)
+    percentValid = getPercentValid(dataset)
+    dataset = None # Close the file
+    return percentValid
+
+
+def downloadEeImage(eeObject, bbox, scale, file_path, vis_params=None, deadline=None):
+    '''Downloads an Earth Engine image object to the specified path.
+       Raises an exception if the download does not finish before deadline, a time.time() value.'''
 
     with TemporaryDirectory() as workDir:
 
@@ -169,9 +292,10 @@ def downloadEeImage(eeObject, bbox, scale, file_path, vis_params=None):
             if ',' in band_names: # If needed, convert from string to list
                 band_names = band_names.replace(' ', '').split(',')
         else: # Grab the first three band names
-            if len(eeObject.getInfo()['bands']) > 3:
+            bands = getInfoBefore(eeObject, deadline)['bands']
+            if len(bands) > 3:
                 print 'Warning: Limiting recorded file to first three band names!'
-            for b in eeObject.getInfo()['bands']:
+            for b in bands:
                 band_names.append(b['id'])
                 if len(band_names) == 3:
                     break
@@ -195,10 +319,11 @@ def downloadEeImage(eeObject, bbox, scale, file_path, vis_params=None):
             eeRect = apply(ee.Geometry.Rectangle, bbox)
         else:
             eeRect = bbox
-        eeGeom = unComputeRectangle(eeRect).toGeoJSONString()
+        eeGeom = unComputeRectangle(eeRect, deadline).toGeoJSONString()
         
         # Retrieve a download URL from Earth Engine
         dummy_name = 'EE_image'
+        getRemainingSeconds(deadline)
         url = download_object.getDownloadUrl({'name' : dummy_name, 'scale': scale,
                                               'crs': 'EPSG:4326', 'region': eeGeom})
         #crsTransform = [scale, 0, eeRect.]
@@ -213,13 +338,18 @@ def downloadEeImage(eeObject, bbox, scale, file_path, vis_params=None):
         
         # Download the packed file
         print 'Downloading image...'
-        data = urllib2.urlopen(url)
+        remaining = getRemainingSeconds(deadline)
+        if remaining is None:
+            data = urllib2.urlopen(url)
+        else:
+            data = urllib2.urlopen(url, timeout=remaining)
         with open(zip_path, 'wb') as fp:
             while True:
                 chunk = data.read(16 * 1024)
                 if not chunk:
                     break
                 fp.write(chunk)
+                getRemainingSeconds(deadline) # The timeout only applies to each read
         print 'Download complete!'
         
         # Each band get packed seperately in the zip file.
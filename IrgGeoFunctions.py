@@ -19,18 +19,136 @@
 
 """IrgGeoFunctions.py - Functions for working with different geo-data formats"""
 
-import sys, os, glob, re, shutil, subprocess, string, time, errno
+import sys, os, glob, re, shutil, subprocess, string, time, errno, struct, copy
 import re
+import collections
 import IrgStringFunctions
 
 
+# Image sizes and geo info already looked up, keyed by path.  Entries are only
+#  used if the modification time and file size still match.  Each cache is kept
+#  in least recently used order and the oldest entry is dropped when it is full.
+_imageSizeCache    = collections.OrderedDict()
+_imageGeoInfoCache = collections.OrderedDict()
+IMAGE_SIZE_CACHE_MAX_ENTRIES = 2000
+
+def getCacheEntry(cache, key):
+    """Returns the cached value for key and marks it as recently used, or None."""
+    value = cache.pop(key, None)
+    if value is not None:
+        cache[key] = value
+    return value
+
+def setCacheEntry(cache, key, value):
+    """Adds a value to a cache, dropping the least recently used entries if it is full."""
+    cache.pop(key, None)
+    while len(cache) >= IMAGE_SIZE_CACHE_MAX_ENTRIES:
+        cache.popitem(last=False)
+    cache[key] = value
+
+def getFileCacheKey(path):
+    """Returns a value which changes when a file is modified"""
+    try:
+        info = os.stat(path)
+    except OSError:
+        raise Exception('Image file ' + path + ' not found!')
+    return (info.st_mtime, info.st_size)
+
 def getImageSize(imagePath):
     """Returns the size [samples, lines] in an image"""
 
     # Make sure the input file exists
-    if not os.path.exists(imagePath):
-        raise Exception('Image file ' + imagePath + ' not found!')
-       
+    fileKey = getFileCacheKey(imagePath)
+    cached  = getCacheEntry(_imageSizeCache, imagePath)
+    if cached and (cached[0] == fileKey):
+        return list(cached[1])
+
+    # Try to read the size from the file header before using GDAL
+    size = None
+    try:
+        with open(imagePath, 'rb') as handle:
+            header = handle.read(4)
+            handle.seek(0)
+            if header[0:2] == '\xff\xd8':
+                size = readJpegHeaderSize(handle)
+            elif header in ['II*\x00', 'MM\x00*']:
+                size = readTiffHeaderSize(handle)
+    except (IOError, struct.error):
+        size = None
+    if not size:
+        size = getImageSizeGdal(imagePath)
+
+    setCacheEntry(_imageSizeCache, imagePath, (fileKey, list(size)))
+    return list(size)
+
+
+def readJpegHeaderSize(handle):
+    """Returns [samples, lines] from the start of frame marker of an open JPEG file,
+       or None if it could not be found."""
+
+    handle.seek(2) # Skip the start of image marker
+    while True:
+        # Each segment starts with 0xFF, possibly padded with more 0xFF bytes
+        if handle.read(1) != '\xff':
+            return None # Lost sync with the markers
+        marker = handle.read(1)
+        while marker == '\xff':
+            marker = handle.read(1)
+        if not marker:
+            return None
+        markerCode = ord(marker)
+        if (markerCode == 0xD8) or (0xD0 <= markerCode <= 0xD7) or (markerCode == 0x01):
+            continue # These markers have no length field
+        if markerCode == 0xD9: # End of image
+            return None
+        (length,) = struct.unpack('>H', handle.read(2))
+        # SOF0-SOF15 except DHT (C4), JPG (C8), and DAC (CC)
+        if (0xC0 <= markerCode <= 0xCF) and (markerCode not in [0xC4, 0xC8, 0xCC]):
+            (precision, lines, samples) = struct.unpack('>BHH', handle.read(5))
+            if (lines == 0) or (samples == 0): # Height is defined later in the file
+                return None
+            return [samples, lines]
+        handle.seek(length - 2, 1)
+
+
+def readTiffHeaderSize(handle):
+    """Returns [samples, lines] from the first image file directory of an open
+       TIFF file, or None if it could not be read."""
+
+    TIFF_TYPE_FORMATS = {3:'H', 4:'I'} # SHORT and LONG
+    IMAGE_WIDTH_TAG   = 256
+    IMAGE_LENGTH_TAG  = 257
+
+    order = '<' if (handle.read(2) == 'II') else '>'
+    (magic, ifdOffset) = struct.unpack(order + 'HI', handle.read(6))
+    if magic != 42: # BigTIFF is left to GDAL
+        return None
+    handle.seek(ifdOffset)
+    (numEntries,) = struct.unpack(order + 'H', handle.read(2))
+    values = {}
+    for i in range(numEntries):
+        (tag, fieldType, count, valueBytes) = struct.unpack(order + 'HHI4s', handle.read(12))
+        if (tag in [IMAGE_WIDTH_TAG, IMAGE_LENGTH_TAG]) and (fieldType in TIFF_TYPE_FORMATS):
+            valueFormat = order + TIFF_TYPE_FORMATS[fieldType]
+            (values[tag],) = struct.unpack(valueFormat, valueBytes[0:struct.calcsize(valueFormat)])
+    if (IMAGE_WIDTH_TAG not in values) or (IMAGE_LENGTH_TAG not in values):
+        return None
+    return [values[IMAGE_WIDTH_TAG], values[IMAGE_LENGTH_TAG]]
+
+
+def getImageSizeGdal(imagePath):
+    """Returns the size [samples, lines] in an image using GDAL"""
+
+    try:
+        from osgeo import gdal
+    except ImportError:
+        gdal = None
+    if gdal:
+        dataset = gdal.Open(imagePath)
+        if dataset is None:
+            raise Exception('GDAL could not open image file ' + imagePath)
+        return [dataset.RasterXSize, dataset.RasterYSize]
+
     # Use subprocess to suppress the command output
     cmd = ['gdalinfo', imagePath]
     p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
@@ -115,9 +233,121 @@ def parseGdalLonLatBounds(line):
         return numberSets
 
 
+# Levels of band statistics stored in the geo info cache
+STATS_NONE   = 0
+STATS_APPROX = 1
+STATS_EXACT  = 2
+
 # This can take a while if stats are requested
-def getImageGeoInfo(imagePath, getStats=True):
-    """Obtains some image geo information from gdalinfo in dictionary format"""
+def getImageGeoInfo(imagePath, getStats=True, approxStats=False):
+    """Obtains some image geo information in dictionary format.
+       If getStats is set each band_info entry also has min, max, mean, and stddev
+       values.  If approxStats is also set these may be computed from overviews
+       or a subset of the pixels."""
+
+    statsLevel = STATS_NONE
+    if getStats:
+        statsLevel = STATS_APPROX if approxStats else STATS_EXACT
+
+    fileKey = getFileCacheKey(imagePath)
+    cached  = getCacheEntry(_imageGeoInfoCache, imagePath)
+    if cached and (cached[0] == fileKey) and (cached[1] >= statsLevel):
+        return copy.deepcopy(cached[2])
+
+    try:
+        from osgeo import gdal
+    except ImportError:
+        gdal = None
+    if gdal:
+        outputDict = getImageGeoInfoGdal(imagePath, getStats, approxStats)
+    else:
+        outputDict = getImageGeoInfoGdalinfo(imagePath, getStats)
+        if getStats:
+            statsLevel = STATS_EXACT
+
+    setCacheEntry(_imageGeoInfoCache, imagePath, (fileKey, statsLevel, outputDict))
+    return copy.deepcopy(outputDict)
+
+
+def getImageGeoInfoGdal(imagePath, getStats=True, approxStats=False):
+    """Obtains the getImageGeoInfo dictionary using the GDAL Python bindings"""
+
+    from osgeo import gdal, osr
+
+    dataset = gdal.Open(imagePath)
+    if dataset is None:
+        raise Exception('GDAL could not open image file ' + imagePath)
+
+    outputDict = {}
+    (width, height) = (dataset.RasterXSize, dataset.RasterYSize)
+    outputDict['image_size'] = (width, height) #cols, rows
+
+    # Get origin location and pixel size, in the same format as the gdalinfo parser
+    (originX, pixelWidth, rotX, originY, rotY, pixelHeight) = dataset.GetGeoTransform()
+    outputDict['origin']     = [[originX,    originY    ]]
+    outputDict['pixel_size'] = [[pixelWidth, pixelHeight]]
+
+    # Get bounding box in projected coordinates and possibly lonlat coordinates
+    minX = originX
+    maxY = originY
+    maxX = originX + width*pixelWidth + height*rotX
+    minY = originY + width*rotY       + height*pixelHeight
+    outputDict['projection_bounds'] = (minX, maxX, minY, maxY)
+
+    projectionWkt = dataset.GetProjection()
+    proj4Text     = ''
+    prettyWkt     = ''
+    if projectionWkt:
+        srs = osr.SpatialReference()
+        srs.ImportFromWkt(projectionWkt)
+        lonLatSrs = srs.CloneGeogCS()
+        if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'): # GDAL 3 defaults to lat, lon order
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+            lonLatSrs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        toLonLat = osr.CoordinateTransformation(srs, lonLatSrs)
+        (minLon, maxLat) = toLonLat.TransformPoint(minX, maxY)[0:2]
+        (maxLon, minLat) = toLonLat.TransformPoint(maxX, minY)[0:2]
+        while (maxLon < minLon): # Get lon values in the same degree range
+            maxLon += 360.0
+        outputDict['lonlat_bounds'] = (minLon, maxLon, minLat, maxLat)
+        proj4Text = srs.ExportToProj4()
+        prettyWkt = srs.ExportToPrettyWkt()
+
+    # Get some proj4 values
+    outputDict['standard_parallel_1'] = getGdalInfoTagValue(prettyWkt, 'standard_parallel_1')
+    outputDict['central_meridian']    = getGdalInfoTagValue(prettyWkt, 'central_meridian')
+    outputDict['projection']          = getProjectionName(proj4Text)
+
+    # Extract this variable which ASP inserts into its point cloud files
+    pointOffset = dataset.GetMetadataItem('POINT_OFFSET') # Tag name must be synced with C++ code
+    if pointOffset:
+        offsetValues = pointOffset.split(' ')
+        outputDict['point_offset'] = (float(offsetValues[0]), float(offsetValues[1]), float(offsetValues[2]))
+
+    # List of dictionaries per band
+    outputDict['band_info'] = []
+    for band in range(1, dataset.RasterCount+1):
+        rasterBand = dataset.GetRasterBand(band)
+        bandInfo = {'type': gdal.GetDataTypeName(rasterBand.DataType)}
+        if getStats:
+            (bandMin, bandMax, bandMean, bandStd) = rasterBand.ComputeStatistics(approxStats)
+            bandInfo.update({'min':bandMin, 'max':bandMax, 'mean':bandMean, 'stddev':bandStd})
+        outputDict['band_info'].append(bandInfo)
+
+    return outputDict
+
+
+def getProjectionName(proj4Text):
+    """Returns the getImageGeoInfo projection name for a proj4 string"""
+    if '+proj=eqc' in proj4Text:
+        return 'EQUIRECTANGULAR'
+    if '+proj=ster' in proj4Text:
+        return 'POLAR STEREOGRAPHIC'
+    return 'UNKNOWN'
+
+
+def getImageGeoInfoGdalinfo(imagePath, getStats=True):
+    """Obtains the getImageGeoInfo dictionary by parsing gdalinfo output"""
     
     outputDict = {}
     
@@ -163,12 +393,7 @@ def getImageGeoInfo(imagePath, getStats=True):
     outputDict['standard_parallel_1'] = getGdalInfoTagValue(textOutput, 'standard_parallel_1')
     outputDict['central_meridian']    = getGdalInfoTagValue(textOutput, 'central_meridian')
 
-    # TODO: Get the projection type!
-    if '+proj=eqc' in textOutput:
-        outputDict['projection'] = 'EQUIRECTANGULAR'
-    elif '+proj=ster' in textOutput:
-        outputDict['projection'] = 'POLAR STEREOGRAPHIC'
-    outputDict['projection'] = 'UNKNOWN'
+    outputDict['projection'] = getProjectionName(textOutput)
     
     # Extract this variable which ASP inserts into its point cloud files
     try:
@@ -179,32 +404,37 @@ def getImageGeoInfo(imagePath, getStats=True):
         pass # In most cases this line will not be present
 
     
-    if getStats: # TODO: Which fields are set by this?
+    # List of dictionaries per band
+    outputDict['band_info'] = []
 
-        # List of dictionaries per band
-        outputDict['band_info'] = []
+    # Populate band information
+    band = 1
+    while (True): # Loop until we run out of bands
+        bandString = 'Band ' + str(band) + ' Block='
+        bandLoc = textOutput.find(bandString)
+        if bandLoc < 0: # Ran out of bands
+            break
     
-        # Populate band information
-        band = 1
-        while (True): # Loop until we run out of bands
-            bandString = 'Band ' + str(band) + ' Block='
-            bandLoc = textOutput.find(bandString)
-            if bandLoc < 0: # Ran out of bands
-                break
-        
-            # Found the band, read pertinent information
-            bandInfo = {}
-        
-            # Get the type string
-            bandLine = IrgStringFunctions.getLineAfterText(textOutput, bandString)
-            typePos  = bandLine.find('Type=')
-            commaPos = bandLine.find(',')
-            typeName = bandLine[typePos+5:commaPos-1]
-            bandInfo['type'] = typeName
-        
-            outputDict['band_info'] = bandInfo
-        
-            band = band + 1 # Move on to the next band
+        # Found the band, read pertinent information
+        bandInfo = {}
+    
+        # Get the type string
+        bandLine = IrgStringFunctions.getLineAfterText(textOutput, bandString)
+        typePos  = bandLine.find('Type=')
+        commaPos = bandLine.find(',')
+        typeName = bandLine[typePos+5:commaPos]
+        bandInfo['type'] = typeName
+
+        # Get the statistics for this band
+        if getStats:
+            for (key, tag) in [('min',    'STATISTICS_MINIMUM='), ('max',    'STATISTICS_MAXIMUM='),
+                               ('mean',   'STATISTICS_MEAN='   ), ('stddev', 'STATISTICS_STDDEV=' )]:
+                tagStart = textOutput.find(tag, bandLoc)
+                bandInfo[key] = IrgStringFunctions.getNumberAfterEqualSign(textOutput, tagStart)
+    
+        outputDict['band_info'].append(bandInfo)
+    
+        band = band + 1 # Move on to the next band
         
     return outputDict
 
@@ -227,42 +457,14 @@ def doesImageHaveGeoData(imagePath):
     
 
 
-def getImageStats(imagePath):
-    """Obtains some image statistics from gdalinfo"""
+def getImageStats(imagePath, approxStats=False):
+    """Returns a (min, max, mean, stddev) tuple for each band in an image"""
     
     if not os.path.exists(imagePath):
         raise Exception('Image file ' + imagePath + ' not found!')
     
-    # Call command line tool silently
-    cmd = ['gdalinfo', imagePath, '-stats']
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    textOutput, err = p.communicate()
-    
-    # Statistics are computed seperately for each band
-    bandStats = []
-    band = 0
-    while (True): # Loop until we run out of bands
-        # Look for the stats line for this band
-        bandString = 'Band ' + str(band+1) + ' Block='
-        bandLoc = textOutput.find(bandString)
-        if bandLoc < 0:
-            return bandStats # Quit if we did not find it
-            
-        # Now parse out the statistics for this band
-        bandMaxStart  = textOutput.find('STATISTICS_MAXIMUM=', bandLoc)
-        bandMeanStart = textOutput.find('STATISTICS_MEAN=',    bandLoc)
-        bandMinStart  = textOutput.find('STATISTICS_MINIMUM=', bandLoc)
-        bandStdStart  = textOutput.find('STATISTICS_STDDEV=',  bandLoc)
-               
-        bandMax  = IrgStringFunctions.getNumberAfterEqualSign(textOutput, bandMaxStart)
-        bandMean = IrgStringFunctions.getNumberAfterEqualSign(textOutput, bandMeanStart)
-        bandMin  = IrgStringFunctions.getNumberAfterEqualSign(textOutput, bandMinStart)
-        bandStd  = IrgStringFunctions.getNumberAfterEqualSign(textOutput, bandStdStart)
-            
-        # Add results to the output list
-        bandStats.append( (bandMin, bandMax, bandMean, bandStd) )
-            
-        band = band + 1 # Move to the next band
+    info = getImageGeoInfo(imagePath, getStats=True, approxStats=approxStats)
+    return [(b['min'], b['max'], b['mean'], b['stddev']) for b in info['band_info']]
     
 
 def getGeoTiffBoundingBox(geoTiffPath):
@@ -463,7 +665,7 @@ def build_vrt( fullImageSize, tileLocs, tilePaths, outputPath ):
 
     
     # Read some metadata from one of the tiles
-    gdalInfo = getImageGeoInfo(tilePaths[0])
+    gdalInfo = getImageGeoInfo(tilePaths[0], getStats=False)
     
     num_bands = len(gdalInfo['band_info'])
     data_type = gdalInfo['band_info'][0]['type']
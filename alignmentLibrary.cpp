@@ -0,0 +1,394 @@
+//__BEGIN_LICENSE__
+// Copyright (c) 2017, United States Government, as represented by the
+// Administrator of the National Aeronautics and Space Administration.
+// All rights reserved.
+//
+// The GeoRef platform is licensed under the Apache License, Version 2.0
+// (the "License"); you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+// http://www.apache.org/licenses/LICENSE-2.0.
+//
+// Unless required by applicable law or agreed to in writing, software distributed
+// under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+// CONDITIONS OF ANY KIND, either express or implied. See the License for the
+// specific language governing permissions and limitations under the License.
+//__END_LICENSE__
+
+#include <stdio.h>
+#include <algorithm>
+#include <exception>
+#include <string>
+#include <vector>
+
+#include "imageAlignment.h"
+
+/**
+  C interface to the image alignment code so that it can be loaded in process
+  with ctypes (see alignment_engine.py) instead of running registerGeocamImage.
+
+  Images are passed in as packed 8 bit row-major buffers, either grayscale
+  or in BGR order.
+  All the results are stored in an opaque handle which must be released
+  with georefFreeResult(), or georefFreeBatch() for batch alignment.
+*/
+
+/// Options passed in from Python, must be kept in sync with alignment_engine.py!
+struct GeorefAlignOptions
+{
+  int         mode;        // One of the ModeType values
+  int         debug;       // If nonzero, write debug images to debugFolder.
+  const char* debugFolder; // Must end with a slash
+  const char* featureCacheFolder; // If set, reference image features are cached here.
+  int         featureCacheMaxMb;  // Size limit for the feature cache folder
+  const char* cascadeDetectors;   // Detector list for MODE_CASCADE such as "orb,sift,akaze"
+  double      timeBudgetSeconds;  // Time limit for MODE_CASCADE
+  int         cascadePyramid;     // If nonzero, MODE_CASCADE uses pyramid matching.
+  int         matcherType;        // One of the MatcherType values
+  int         tileSize;           // If nonzero, detect features in parallel tiles of this size.
+  int         numThreads;         // Number of threads used for tiled detection, 0 for the default.
+  int         guided;             // If nonzero, use center and rotation guided matching.
+  double      centerTolerance;    // Max guided prior center offset as a fraction of the reference image size
+  double      priorScale;         // Expected match image to reference image scale
+  double      matchScale;         // If set, the match image is resized by this amount first.
+};
+
+/// Holds the output of one alignment call.
+struct GeorefAlignResult
+{
+  int    numInliers;
+  int    confidence; // 0 = NONE, 1 = LOW, 2 = HIGH, same as registration_common.py
+  double transform[9];
+  std::vector<cv::Point2f> refInlierCoords;
+  std::vector<cv::Point2f> matchInlierCoords;
+  std::string timingJson; // Output of AlignmentTiming::toJson()
+};
+
+/// Holds the ranked outputs of one batch alignment call.
+struct GeorefBatchResult
+{
+  std::vector<int>                refIndices; // Index of the reference image for each result
+  std::vector<GeorefAlignResult*> results;    // Owned by the batch
+  std::string timingJson;
+};
+
+
+/// Convert the output of evaluateRegistrationAccuracy to the Python confidence codes.
+int confidenceStringToCode(const std::string &confString)
+{
+  if (confString == "CONFIDENCE_HIGH")
+    return 2;
+  if (confString == "CONFIDENCE_LOW")
+    return 1;
+  return 0;
+}
+
+/// Wrap a caller owned buffer in a cv::Mat without copying it.
+cv::Mat wrapImageBuffer(const unsigned char* data, int rows, int cols, int channels)
+{
+  const int type = (channels == 1) ? CV_8UC1 : CV_8UC3;
+  return cv::Mat(rows, cols, type, const_cast<unsigned char*>(data));
+}
+
+
+/// Set up the alignment context from the options passed in from Python.
+/// - Returns the feature cache, if any, which the caller must delete.
+FeatureCache* applyOptions(const GeorefAlignOptions* options, AlignmentContext &context)
+{
+  FeatureCache* featureCache = NULL;
+  if (options->featureCacheFolder && (options->featureCacheFolder[0] != '\0'))
+  {
+    featureCache = new FeatureCache(options->featureCacheFolder,
+                                    static_cast<size_t>(options->featureCacheMaxMb)*1024*1024);
+    context.featureCache = featureCache;
+  }
+  if (options->cascadeDetectors && (options->cascadeDetectors[0] != '\0'))
+  {
+    if (!parseDetectorList(options->cascadeDetectors, context.cascade.detectors))
+      context.cascade.detectors = CascadeSettings().detectors;
+  }
+  if (options->timeBudgetSeconds > 0)
+    context.cascade.timeBudgetSeconds = options->timeBudgetSeconds;
+  context.cascade.usePyramid = (options->cascadePyramid != 0);
+  context.matcherType        = static_cast<MatcherType>(options->matcherType);
+  context.tileSize           = options->tileSize;
+  context.guided.enabled     = (options->guided != 0);
+  if (options->centerTolerance > 0)
+    context.guided.centerTolerance = options->centerTolerance;
+  if (options->priorScale > 0)
+    context.guided.scale = options->priorScale;
+  cv::setNumThreads((options->numThreads > 0) ? options->numThreads : -1); // -1 is the OpenCV default
+  return featureCache;
+}
+
+/// Allocate a result handle with an identity transform and no inliers.
+GeorefAlignResult* createEmptyResult()
+{
+  GeorefAlignResult* result = new GeorefAlignResult();
+  result->numInliers = 0;
+  result->confidence = 0;
+  for (int i=0; i<9; ++i)
+    result->transform[i] = (i % 4 == 0) ? 1.0 : 0.0;
+  return result;
+}
+
+
+/// Implementation of georefAlignImages, fills in a result from createEmptyResult().
+/// - May throw, the caller must catch all exceptions before returning to C.
+void alignImagesIntoResult(GeorefAlignResult* result,
+                           const unsigned char* refData, int refRows, int refCols, int refChannels,
+                           const unsigned char* matchData, int matchRows, int matchCols, int matchChannels,
+                           const GeorefAlignOptions* options)
+{
+  if ((!refData) || (!matchData) || (!options))
+    return;
+
+  // preprocess() accepts either BGR or grayscale images.
+  cv::Mat refImageIn   = wrapImageBuffer(refData,   refRows,   refCols,   refChannels  );
+  cv::Mat matchImageIn = wrapImageBuffer(matchData, matchRows, matchCols, matchChannels);
+
+  std::string debugFolder = options->debugFolder ? options->debugFolder : "";
+  bool        debug       = (options->debug != 0);
+
+  AlignmentTiming  timing;
+  AlignmentContext context;
+  context.timing = &timing;
+  cv::Ptr<FeatureCache> featureCache(applyOptions(options, context));
+  matchImageIn = scaleAlignmentImage(matchImageIn, options->matchScale);
+  timing.endStage("resize");
+
+  // The transform is from MATCH (second input) to REF (first input)
+  cv::Mat transform(3, 3, CV_32FC1);
+  int numInliers = 0;
+  try
+  {
+    numInliers = computeImageTransformRobust(refImageIn, matchImageIn, transform,
+                                             result->refInlierCoords, result->matchInlierCoords,
+                                             static_cast<ModeType>(options->mode), debugFolder, debug, &context);
+  }
+  catch (const cv::Exception &e)
+  {
+    printf("Caught OpenCV exception during alignment: %s\n", e.what());
+    numInliers = 0;
+  }
+  featureCache.release();
+  result->timingJson = timing.toJson();
+  if (!numInliers)
+  {
+    printf("Failed to compute image transform!\n");
+    result->refInlierCoords.clear();
+    result->matchInlierCoords.clear();
+    return;
+  }
+
+  std::string confString = evaluateRegistrationAccuracy(numInliers, transform);
+  printf("Computed %s transform with %d inliers.\n", confString.c_str(), numInliers);
+
+  result->numInliers = numInliers;
+  result->confidence = confidenceStringToCode(confString);
+  for (int r=0; r<3; ++r)
+    for (int c=0; c<3; ++c)
+      result->transform[r*3+c] = transform.at<double>(r,c);
+
+  if (debug)
+    writeOverlayImage(refImageIn, matchImageIn, transform, debugFolder+"warped.tif");
+}
+
+/// Implementation of georefAlignImageBatch, fills in an empty batch.
+/// - May throw, the caller must catch all exceptions before returning to C.
+void alignImageBatchIntoResult(GeorefBatchResult* batch,
+                               const unsigned char** refData, const int* refRows,
+                               const int* refCols, const int* refChannels, int numRefs,
+                               const unsigned char* matchData, int matchRows, int matchCols, int matchChannels,
+                               const GeorefAlignOptions* options)
+{
+  if ((!refData) || (!matchData) || (!options))
+    return;
+
+  std::vector<cv::Mat> refImages(numRefs);
+  for (int i=0; i<numRefs; ++i)
+  {
+    if (refData[i])
+      refImages[i] = wrapImageBuffer(refData[i], refRows[i], refCols[i], refChannels[i]);
+  }
+  cv::Mat matchImageIn = wrapImageBuffer(matchData, matchRows, matchCols, matchChannels);
+
+  std::string debugFolder = options->debugFolder ? options->debugFolder : "";
+  bool        debug       = (options->debug != 0);
+
+  AlignmentTiming  timing;
+  AlignmentContext context;
+  context.timing = &timing;
+  cv::Ptr<FeatureCache> featureCache(applyOptions(options, context));
+  matchImageIn = scaleAlignmentImage(matchImageIn, options->matchScale);
+  timing.endStage("resize");
+
+  std::vector<BatchAlignmentResult> ranked;
+  computeImageTransformBatch(refImages, matchImageIn, static_cast<ModeType>(options->mode),
+                             debugFolder, debug, &context, ranked);
+  featureCache.release();
+  batch->timingJson = timing.toJson();
+
+  for (size_t i=0; i<ranked.size(); ++i)
+  {
+    GeorefAlignResult* result = createEmptyResult();
+    if (ranked[i].numInliers > 0)
+    {
+      result->numInliers = ranked[i].numInliers;
+      result->confidence = confidenceStringToCode(ranked[i].confidence);
+      for (int r=0; r<3; ++r)
+        for (int c=0; c<3; ++c)
+          result->transform[r*3+c] = ranked[i].transform.at<double>(r,c);
+      result->refInlierCoords.swap  (ranked[i].refInlierCoords  );
+      result->matchInlierCoords.swap(ranked[i].matchInlierCoords);
+    }
+    result->timingJson = batch->timingJson;
+    batch->refIndices.push_back(ranked[i].refIndex);
+    batch->results.push_back(result);
+  }
+}
+
+/// Return an alignment result to its empty state after a failure.
+void resetResult(GeorefAlignResult* result)
+{
+  GeorefAlignResult* empty = createEmptyResult();
+  std::swap(*result, *empty);
+  delete empty;
+}
+
+/// Return a batch result to its empty state after a failure.
+void resetBatch(GeorefBatchResult* batch)
+{
+  for (size_t i=0; i<batch->results.size(); ++i)
+    delete batch->results[i];
+  batch->results.clear();
+  batch->refIndices.clear();
+  batch->timingJson.clear();
+}
+
+
+extern "C" {
+
+/// Align the match image to the reference image.
+/// - Always returns a handle, check georefResultNumInliers() to see if it worked.
+GeorefAlignResult* georefAlignImages(const unsigned char* refData, int refRows, int refCols, int refChannels,
+                                     const unsigned char* matchData, int matchRows, int matchCols, int matchChannels,
+                                     const GeorefAlignOptions* options)
+{
+  // No C++ exception may pass back through the C interface into Python.
+  GeorefAlignResult* result = createEmptyResult();
+  try
+  {
+    alignImagesIntoResult(result, refData, refRows, refCols, refChannels,
+                          matchData, matchRows, matchCols, matchChannels, options);
+  }
+  catch (const std::exception &e)
+  {
+    printf("Caught exception during alignment: %s\n", e.what());
+    resetResult(result);
+  }
+  catch (...)
+  {
+    printf("Caught unknown exception during alignment.\n");
+    resetResult(result);
+  }
+  return result;
+}
+
+/// Align the match image to each of numRefs reference images, stopping at the
+///  first high confidence result.
+/// - The match image features are only computed once.
+/// - Always returns a handle, the results are sorted by decreasing inlier count
+///   and reference images skipped by the early exit have no result.
+GeorefBatchResult* georefAlignImageBatch(const unsigned char** refData, const int* refRows,
+                                         const int* refCols, const int* refChannels, int numRefs,
+                                         const unsigned char* matchData, int matchRows, int matchCols, int matchChannels,
+                                         const GeorefAlignOptions* options)
+{
+  // No C++ exception may pass back through the C interface into Python.
+  GeorefBatchResult* batch = new GeorefBatchResult();
+  try
+  {
+    alignImageBatchIntoResult(batch, refData, refRows, refCols, refChannels, numRefs,
+                              matchData, matchRows, matchCols, matchChannels, options);
+  }
+  catch (const std::exception &e)
+  {
+    printf("Caught exception during batch alignment: %s\n", e.what());
+    resetBatch(batch);
+  }
+  catch (...)
+  {
+    printf("Caught unknown exception during batch alignment.\n");
+    resetBatch(batch);
+  }
+  return batch;
+}
+
+/// Returns the number of results in a batch.
+int georefBatchSize(const GeorefBatchResult* batch)
+{
+  return static_cast<int>(batch->results.size());
+}
+
+/// Returns the reference image index of the i'th ranked result.
+int georefBatchRefIndex(const GeorefBatchResult* batch, int i)
+{
+  return batch->refIndices[i];
+}
+
+/// Returns the i'th ranked result, which is valid until the batch is freed.
+/// - Use the georefResult functions to read it but do not free it.
+const GeorefAlignResult* georefBatchResult(const GeorefBatchResult* batch, int i)
+{
+  return batch->results[i];
+}
+
+void georefFreeBatch(GeorefBatchResult* batch)
+{
+  for (size_t i=0; i<batch->results.size(); ++i)
+    delete batch->results[i];
+  delete batch;
+}
+
+int georefResultNumInliers(const GeorefAlignResult* result)
+{
+  return static_cast<int>(result->refInlierCoords.size());
+}
+
+int georefResultConfidence(const GeorefAlignResult* result)
+{
+  return result->confidence;
+}
+
+/// Copy out the 3x3 row-major transform.
+void georefResultTransform(const GeorefAlignResult* result, double* transformOut)
+{
+  for (int i=0; i<9; ++i)
+    transformOut[i] = result->transform[i];
+}
+
+/// Copy out the inliers, each buffer must hold 2*georefResultNumInliers() floats.
+void georefResultInliers(const GeorefAlignResult* result, float* refOut, float* matchOut)
+{
+  const size_t numInliers = result->refInlierCoords.size();
+  for (size_t i=0; i<numInliers; ++i)
+  {
+    refOut  [2*i  ] = result->refInlierCoords  [i].x;
+    refOut  [2*i+1] = result->refInlierCoords  [i].y;
+    matchOut[2*i  ] = result->matchInlierCoords[i].x;
+    matchOut[2*i+1] = result->matchInlierCoords[i].y;
+  }
+}
+
+/// Returns the stage timing JSON string, valid until the result is freed.
+const char* georefResultTiming(const GeorefAlignResult* result)
+{
+  return result->timingJson.c_str();
+}
+
+void georefFreeResult(GeorefAlignResult* result)
+{
+  delete result;
+}
+
+} // extern "C"
@@ -0,0 +1,503 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+import os
+import ctypes
+import json
+import time
+import subprocess
+import numpy
+from PIL import Image
+
+from django.conf import settings
+
+import offline_config
+
+"""
+In-process interfaces to the C++ image alignment code.
+
+Loads the georefAlignment shared library built alongside registerGeocamImage
+so that alignment can be run on NumPy arrays without starting a new process
+and writing the results to a text file.  Also contains a client for the
+long running registerGeocamImage server mode.
+"""
+
+# Mode values, these must match the ModeType enum in imageAlignment.h
+MODE_FAST     = 0
+MODE_ACCURATE = 1
+MODE_PYRAMID  = 2
+MODE_CASCADE  = 3
+
+# Matcher values, these must match the MatcherType enum in imageAlignment.h
+MATCHER_BRUTE_FORCE = 0
+MATCHER_FLANN       = 1
+MATCHER_NAMES = {'bf': MATCHER_BRUTE_FORCE, 'flann': MATCHER_FLANN}
+
+def getAlignmentMode(slowMethod):
+    '''Returns the alignment mode to use for the slowMethod flag used by the callers.
+       When the detector cascade is enabled it is used for every alignment, picking
+       the detector itself, and slowMethod is ignored.'''
+    if offline_config.USE_ALIGNMENT_CASCADE:
+        return MODE_CASCADE
+    if slowMethod:
+        return MODE_ACCURATE
+    if offline_config.USE_PYRAMID_ALIGNMENT:
+        return MODE_PYRAMID
+    return MODE_FAST
+
+
+class GeorefAlignOptions(ctypes.Structure):
+    '''Mirrors the GeorefAlignOptions struct in alignmentLibrary.cpp'''
+    _fields_ = [('mode',               ctypes.c_int),
+                ('debug',              ctypes.c_int),
+                ('debugFolder',        ctypes.c_char_p),
+                ('featureCacheFolder', ctypes.c_char_p),
+                ('featureCacheMaxMb',  ctypes.c_int),
+                ('cascadeDetectors',   ctypes.c_char_p),
+                ('timeBudgetSeconds',  ctypes.c_double),
+                ('cascadePyramid',     ctypes.c_int),
+                ('matcherType',        ctypes.c_int),
+                ('tileSize',           ctypes.c_int),
+                ('numThreads',         ctypes.c_int),
+                ('guided',             ctypes.c_int),
+                ('centerTolerance',    ctypes.c_double),
+                ('priorScale',         ctypes.c_double),
+                ('matchScale',         ctypes.c_double)]
+
+
+# The library is loaded once per process the first time it is needed.
+_library = None
+
+def getLibraryPath():
+    '''Returns the path to the compiled alignment library'''
+    return settings.PROJ_ROOT + '/apps/georef_imageregistration/build/libgeorefAlignment.so'
+
+def loadLibrary():
+    '''Loads the alignment library and sets up the function signatures'''
+    global _library
+    if _library:
+        return _library
+
+    libraryPath = getLibraryPath()
+    if not os.path.exists(libraryPath):
+        raise Exception('Alignment library not found: ' + libraryPath)
+    lib = ctypes.CDLL(libraryPath)
+
+    imageArgs = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_int]
+    lib.georefAlignImages.argtypes = imageArgs + imageArgs + [ctypes.POINTER(GeorefAlignOptions)]
+    lib.georefAlignImages.restype  = ctypes.c_void_p
+    lib.georefResultNumInliers.argtypes = [ctypes.c_void_p]
+    lib.georefResultNumInliers.restype  = ctypes.c_int
+    lib.georefResultConfidence.argtypes = [ctypes.c_void_p]
+    lib.georefResultConfidence.restype  = ctypes.c_int
+    lib.georefResultTransform.argtypes  = [ctypes.c_void_p, ctypes.c_void_p]
+    lib.georefResultTransform.restype   = None
+    lib.georefResultInliers.argtypes    = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p]
+    lib.georefResultInliers.restype     = None
+    lib.georefResultTiming.argtypes     = [ctypes.c_void_p]
+    lib.georefResultTiming.restype      = ctypes.c_char_p
+    lib.georefFreeResult.argtypes       = [ctypes.c_void_p]
+    lib.georefFreeResult.restype        = None
+
+    intArray = ctypes.POINTER(ctypes.c_int)
+    lib.georefAlignImageBatch.argtypes  = ([ctypes.POINTER(ctypes.c_void_p), intArray, intArray, intArray,
+                                            ctypes.c_int] + imageArgs + [ctypes.POINTER(GeorefAlignOptions)])
+    lib.georefAlignImageBatch.restype   = ctypes.c_void_p
+    lib.georefBatchSize.argtypes        = [ctypes.c_void_p]
+    lib.georefBatchSize.restype         = ctypes.c_int
+    lib.georefBatchRefIndex.argtypes    = [ctypes.c_void_p, ctypes.c_int]
+    lib.georefBatchRefIndex.restype     = ctypes.c_int
+    lib.georefBatchResult.argtypes      = [ctypes.c_void_p, ctypes.c_int]
+    lib.georefBatchResult.restype       = ctypes.c_void_p
+    lib.georefFreeBatch.argtypes        = [ctypes.c_void_p]
+    lib.georefFreeBatch.restype         = None
+
+    _library = lib
+    return _library
+
+
+def getFeatureCacheFolder():
+    '''Returns the reference feature cache folder, creating it if needed.
+       Returns an empty string if the cache is disabled.'''
+    folder = offline_config.FEATURE_CACHE_FOLDER
+    if not folder:
+        return ''
+    if not os.path.exists(folder):
+        try:
+            os.makedirs(folder)
+        except OSError: # Another process may have created it
+            pass
+    return folder
+
+def getFeatureCacheArgs():
+    '''Returns the registerGeocamImage command line options for the feature cache'''
+    folder = getFeatureCacheFolder()
+    if not folder:
+        return []
+    return ['--feature-cache', folder, '--feature-cache-mb', str(offline_config.FEATURE_CACHE_MAX_MB)]
+
+def getNumThreads(numThreads=None):
+    '''Returns the number of threads the C++ code should use, 0 means all cores'''
+    if numThreads is None:
+        return offline_config.ALIGNMENT_NUM_THREADS
+    return numThreads
+
+def getToolOptionArgs(numThreads=None):
+    '''Returns the registerGeocamImage command line options set in offline_config'''
+    args = getFeatureCacheArgs()
+    args += ['--cascade',     ','.join(offline_config.ALIGNMENT_CASCADE_DETECTORS),
+             '--time-budget', str(offline_config.ALIGNMENT_TIME_BUDGET)]
+    if offline_config.USE_PYRAMID_ALIGNMENT:
+        args.append('--cascade-pyramid')
+    args += ['--matcher',   offline_config.ALIGNMENT_MATCHER,
+             '--tile-size', str(offline_config.ALIGNMENT_TILE_SIZE)]
+    numThreads = getNumThreads(numThreads)
+    if numThreads > 0:
+        args += ['--threads', str(numThreads)]
+    if offline_config.USE_GUIDED_MATCHING:
+        args += ['--guided', '--center-tolerance', str(offline_config.GUIDED_CENTER_TOLERANCE)]
+    return args
+
+
+def parseTiming(text):
+    '''Parse the stage timing JSON written by the C++ code.
+       Returns {'stages': {name: seconds}, 'counts': {name: count}, 'total': seconds}'''
+    timing = {'stages': {}, 'counts': {}, 'total': 0.0}
+    if text:
+        timing.update(json.loads(text))
+    return timing
+
+def addTiming(timing, other):
+    '''Add the stage times in other to timing.  The counts from other replace those in timing.'''
+    for (name, seconds) in other['stages'].iteritems():
+        timing['stages'][name] = timing['stages'].get(name, 0.0) + seconds
+    timing['counts'].update(other['counts'])
+    timing['total'] += other['total']
+    return timing
+
+
+def loadImage(imagePath, reduction=1):
+    '''Load an image file as a contiguous uint8 grayscale array.
+       If reduction is more than 1 the image is loaded at 1/reduction of its size, which
+       for JPEG images is done while decoding. The size matches the OpenCV reduced modes.'''
+    if not os.path.exists(imagePath):
+        raise Exception('Image file ' + imagePath + ' not found!')
+    image = Image.open(imagePath)
+    if reduction > 1:
+        (width, height) = image.size
+        outputSize = ((width + reduction - 1) / reduction, (height + reduction - 1) / reduction)
+        image.draft('L', outputSize) # Only has an effect on JPEG images
+        image = image.convert('L')
+        if image.size != outputSize:
+            image = image.resize(outputSize, Image.ANTIALIAS)
+    else:
+        image = image.convert('L')
+    return numpy.ascontiguousarray(numpy.asarray(image, dtype=numpy.uint8))
+
+
+def getImageArgs(image):
+    '''Returns the (pointer, rows, cols, channels) arguments for an image array'''
+    if image.dtype != numpy.uint8:
+        raise Exception('Alignment images must be uint8, got ' + str(image.dtype))
+    image = numpy.ascontiguousarray(image)
+    channels = 1 if (image.ndim == 2) else image.shape[2]
+    if channels not in [1, 3]:
+        raise Exception('Alignment images must have 1 or 3 channels!')
+    return (image, [image.ctypes.data, image.shape[0], image.shape[1], channels])
+
+
+def computeImageTransform(refImage, matchImage, mode=MODE_FAST, debug=False, debugFolder='',
+                          numThreads=None, priorScale=1.0, matchScale=1.0):
+    '''Align two uint8 image arrays (grayscale or BGR).
+       The transform is from matchImage to refImage.
+       priorScale is the approximate size of a matchImage pixel in refImage pixels,
+       used by guided matching.  The image centers are assumed to roughly coincide.
+       If matchScale is not 1, matchImage is resized by that amount before aligning it
+       and the results are in the coordinates of the resized image.
+       Returns (transform, confidence, numInliers, refInliers, matchInliers, timing) where
+       transform is a 3x3 array, the inliers are Nx2 float32 arrays, and timing is the
+       stage timing dictionary described in parseTiming().'''
+
+    lib = loadLibrary()
+
+    # Keep references to the contiguous arrays until the call completes.
+    (refImage,   refArgs  ) = getImageArgs(refImage)
+    (matchImage, matchArgs) = getImageArgs(matchImage)
+
+    options = getAlignOptions(mode, debug, debugFolder, numThreads, priorScale, matchScale)
+
+    handle = lib.georefAlignImages(*(refArgs + matchArgs + [ctypes.byref(options)]))
+    try:
+        (transform, confidence, numInliers, refInliers, matchInliers) = readResult(lib, handle)
+        timing = parseTiming(lib.georefResultTiming(handle))
+    finally:
+        lib.georefFreeResult(handle)
+
+    return (transform, confidence, numInliers, refInliers, matchInliers, timing)
+
+
+def computeImageTransformBatch(refImages, matchImage, mode=MODE_FAST, debug=False, debugFolder='',
+                               numThreads=None, priorScale=1.0, matchScale=1.0):
+    '''Align one uint8 image array to each of a list of reference image arrays,
+       stopping after the first high confidence result.
+       The matchImage features are only computed once.
+       Returns (results, timing) where results is a list of
+       (refIndex, transform, confidence, numInliers, refInliers, matchInliers) tuples in the
+       computeImageTransform format, sorted by decreasing inlier count.  Reference images
+       which were not tried because of the early exit have no result.'''
+
+    lib = loadLibrary()
+
+    # Keep references to the contiguous arrays until the call completes.
+    refArrays   = []
+    refPointers = (ctypes.c_void_p * len(refImages))()
+    refRows     = (ctypes.c_int    * len(refImages))()
+    refCols     = (ctypes.c_int    * len(refImages))()
+    refChannels = (ctypes.c_int    * len(refImages))()
+    for (i, refImage) in enumerate(refImages):
+        (refImage, refArgs) = getImageArgs(refImage)
+        refArrays.append(refImage)
+        (refPointers[i], refRows[i], refCols[i], refChannels[i]) = refArgs
+    (matchImage, matchArgs) = getImageArgs(matchImage)
+
+    options = getAlignOptions(mode, debug, debugFolder, numThreads, priorScale, matchScale)
+
+    batch = lib.georefAlignImageBatch(*([refPointers, refRows, refCols, refChannels, len(refImages)] +
+                                        matchArgs + [ctypes.byref(options)]))
+    try:
+        results = []
+        timing  = parseTiming(None)
+        for i in range(lib.georefBatchSize(batch)):
+            handle = lib.georefBatchResult(batch, i)
+            results.append((lib.georefBatchRefIndex(batch, i),) + readResult(lib, handle))
+            timing = parseTiming(lib.georefResultTiming(handle))
+    finally:
+        lib.georefFreeBatch(batch)
+
+    return (results, timing)
+
+
+def getAlignOptions(mode, debug, debugFolder, numThreads, priorScale, matchScale=1.0):
+    '''Returns the GeorefAlignOptions for a library call, filled in from offline_config'''
+    if debugFolder and not debugFolder.endswith('/'):
+        debugFolder += '/'
+    cacheFolder = getFeatureCacheFolder()
+    cacheMaxMb  = offline_config.FEATURE_CACHE_MAX_MB if cacheFolder else 0
+    return GeorefAlignOptions(mode, int(debug), debugFolder, cacheFolder, cacheMaxMb,
+                              ','.join(offline_config.ALIGNMENT_CASCADE_DETECTORS),
+                              offline_config.ALIGNMENT_TIME_BUDGET,
+                              int(offline_config.USE_PYRAMID_ALIGNMENT),
+                              MATCHER_NAMES[offline_config.ALIGNMENT_MATCHER],
+                              offline_config.ALIGNMENT_TILE_SIZE,
+                              getNumThreads(numThreads),
+                              int(offline_config.USE_GUIDED_MATCHING),
+                              offline_config.GUIDED_CENTER_TOLERANCE,
+                              priorScale, matchScale)
+
+def readResult(lib, handle):
+    '''Returns (transform, confidence, numInliers, refInliers, matchInliers) from a result handle'''
+    numInliers = lib.georefResultNumInliers(handle)
+    confidence = lib.georefResultConfidence(handle)
+    transform  = numpy.zeros((3, 3), dtype=numpy.float64)
+    lib.georefResultTransform(handle, transform.ctypes.data)
+    refInliers   = numpy.zeros((numInliers, 2), dtype=numpy.float32)
+    matchInliers = numpy.zeros((numInliers, 2), dtype=numpy.float32)
+    if numInliers > 0:
+        lib.georefResultInliers(handle, refInliers.ctypes.data, matchInliers.ctypes.data)
+    return (transform, confidence, numInliers, refInliers, matchInliers)
+
+
+def alignImageFiles(testImagePath, refImagePath, workPrefix, debug=False, slowMethod=False,
+                    numThreads=None, testReduction=1, priorScale=1.0, testScale=1.0):
+    '''In-process equivalent of running registerGeocamImage on two files.
+       Returns values in the same format as registration_common.alignImages.'''
+
+    mode = getAlignmentMode(slowMethod)
+    debugFolder = os.path.dirname(workPrefix) + '/'
+
+    loadStart = time.time()
+    refImage  = loadImage(refImagePath)
+    testImage = loadImage(testImagePath, testReduction)
+    loadTime  = time.time() - loadStart
+
+    (transform, confidence, numInliers, refInliers, testInliers, timing) = \
+        computeImageTransform(refImage, testImage, mode, debug, debugFolder, numThreads,
+                              priorScale, testScale)
+    timing['stages']['load'] = loadTime
+    timing['total'] += loadTime
+    print 'TIMING: ' + json.dumps(timing)
+    if numInliers == 0:
+        raise Exception('Failed to compute transform!')
+
+    tform       = [float(f) for f in transform.flatten()]
+    refInliers  = [(float(p[0]), float(p[1])) for p in refInliers ]
+    testInliers = [(float(p[0]), float(p[1])) for p in testInliers]
+    return (tform, confidence, testInliers, refInliers, timing)
+
+
+def alignImageFileBatch(testImagePath, refImagePaths, workPrefix, debug=False, slowMethod=False,
+                        numThreads=None, testReduction=1, priorScale=1.0, testScale=1.0):
+    '''Align one file to each of a list of reference files, computing the test image
+       features only once and stopping after the first high confidence result.
+       Returns (results, timing) where results is a list of
+       (refIndex, tform, confidence, testInliers, refInliers) tuples sorted by decreasing
+       inlier count.  Failed alignments have zero confidence and no inliers.'''
+
+    mode = getAlignmentMode(slowMethod)
+    debugFolder = os.path.dirname(workPrefix) + '/'
+
+    loadStart = time.time()
+    refImages = [loadImage(path) for path in refImagePaths]
+    testImage = loadImage(testImagePath, testReduction)
+    loadTime  = time.time() - loadStart
+
+    (batchResults, timing) = computeImageTransformBatch(refImages, testImage, mode, debug,
+                                                        debugFolder, numThreads, priorScale,
+                                                        testScale)
+    timing['stages']['load'] = loadTime
+    timing['total'] += loadTime
+    print 'TIMING: ' + json.dumps(timing)
+
+    results = []
+    for (refIndex, transform, confidence, numInliers, refInliers, testInliers) in batchResults:
+        tform       = [float(f) for f in transform.flatten()]
+        refInliers  = [(float(p[0]), float(p[1])) for p in refInliers ]
+        testInliers = [(float(p[0]), float(p[1])) for p in testInliers]
+        results.append((refIndex, tform, confidence, testInliers, refInliers))
+    return (results, timing)
+
+
+#======================================================================================
+# Aligner server client
+
+# Confidence strings written by evaluateRegistrationAccuracy, in confidence code order.
+CONFIDENCE_NAMES = ['CONFIDENCE_NONE', 'CONFIDENCE_LOW', 'CONFIDENCE_HIGH']
+
+class AlignerDaemon(object):
+    '''Client for a registerGeocamImage process running in server mode.
+       The process is started on the first request and kept running so that
+       each alignment does not pay the process startup cost.'''
+
+    def __init__(self, toolPath=None):
+        if not toolPath:
+            toolPath = settings.PROJ_ROOT + '/apps/georef_imageregistration/build/registerGeocamImage'
+        self._toolPath   = toolPath
+        self._process    = None
+        self._nextId     = 0
+
+    def _start(self):
+        '''Start the server process and wait for it to be ready'''
+        print 'Starting aligner server: ' + self._toolPath
+        cmd = [self._toolPath] + getToolOptionArgs() + ['--server']
+        self._process = subprocess.Popen(cmd,
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        line = self._process.stdout.readline()
+        if line.strip() != 'READY':
+            self.close()
+            raise Exception('Aligner server failed to start, got: ' + line)
+
+    def isRunning(self):
+        return self._process and (self._process.poll() is None)
+
+    def close(self):
+        '''Shut down the server process'''
+        if not self._process:
+            return
+        try:
+            self._process.stdin.close()
+            self._process.wait()
+        except Exception:
+            self._process.kill()
+        self._process = None
+
+    def align(self, refImagePath, testImagePath, debugFolder='', debug=False, mode=MODE_FAST,
+              numThreads=None, testReduction=1, priorScale=1.0, testScale=1.0):
+        '''Send one alignment request and wait for the result.
+           Returns the parsed result dictionary written by the server.'''
+        if not self.isRunning():
+            self._start()
+
+        self._nextId += 1
+        requestId = str(self._nextId)
+        if debugFolder and not debugFolder.endswith('/'):
+            debugFolder += '/'
+        fields = [('id',          requestId),
+                  ('ref',         refImagePath),
+                  ('match',       testImagePath),
+                  ('debugFolder', debugFolder),
+                  ('debug',       'y' if debug else 'n'),
+                  ('mode',        str(mode))]
+        if numThreads is not None:
+            fields.append(('threads', str(numThreads)))
+        if testReduction > 1:
+            fields.append(('matchReduction', str(testReduction)))
+        if testScale != 1.0:
+            fields.append(('matchScale', repr(testScale)))
+        if priorScale != 1.0:
+            fields.append(('priorScale', str(priorScale)))
+        request = '\t'.join([k + '=' + v for (k, v) in fields]) + '\n'
+        try:
+            self._process.stdin.write(request)
+            self._process.stdin.flush()
+        except IOError:
+            self.close()
+            raise Exception('Lost connection to the aligner server!')
+
+        # Echo the progress output until we get our result line.
+        while True:
+            line = self._process.stdout.readline()
+            if not line: # The server died, it will be restarted on the next request.
+                self.close()
+                raise Exception('Aligner server exited while processing a request!')
+            if not line.startswith('RESULT '):
+                print line.rstrip()
+                continue
+            result = json.loads(line[len('RESULT '):])
+            if result['id'] == requestId:
+                return result
+
+
+# One server process is kept for each process that uses it, such as
+# each registration_processor pool worker.
+_daemon = None
+
+def getDaemon():
+    '''Returns the aligner server client for this process'''
+    global _daemon
+    if not _daemon:
+        _daemon = AlignerDaemon()
+    return _daemon
+
+def alignImageFilesWithDaemon(testImagePath, refImagePath, workPrefix, debug=False, slowMethod=False,
+                              numThreads=None, testReduction=1, priorScale=1.0, testScale=1.0):
+    '''Align two files using this process's aligner server.
+       Returns values in the same format as registration_common.alignImages.'''
+
+    mode = getAlignmentMode(slowMethod)
+    debugFolder = os.path.dirname(workPrefix) + '/'
+
+    result = getDaemon().align(refImagePath, testImagePath, debugFolder, debug, mode, numThreads,
+                               testReduction, priorScale, testScale)
+    timing = result.get('timing', parseTiming(None))
+    print 'TIMING: ' + json.dumps(timing)
+    if result['status'] != 'ok':
+        raise Exception('Failed to compute transform!')
+
+    tform       = [float(f) for f in result['transform']]
+    confidence  = CONFIDENCE_NAMES.index(result['confidence'])
+    refInliers  = [(float(p[0]), float(p[1])) for p in result['refInliers'  ]]
+    testInliers = [(float(p[0]), float(p[1])) for p in result['matchInliers']]
+    return (tform, confidence, testInliers, refInliers, timing)
@@ -0,0 +1,230 @@
+//__BEGIN_LICENSE__
+// Copyright (c) 2017, United States Government, as represented by the
+// Administrator of the National Aeronautics and Space Administration.
+// All rights reserved.
+//
+// The GeoRef platform is licensed under the Apache License, Version 2.0
+// (the "License"); you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+// http://www.apache.org/licenses/LICENSE-2.0.
+//
+// Unless required by applicable law or agreed to in writing, software distributed
+// under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+// CONDITIONS OF ANY KIND, either express or implied. See the License for the
+// specific language governing permissions and limitations under the License.
+//__END_LICENSE__
+
+#ifndef GEOREF_FEATURE_CACHE_H
+#define GEOREF_FEATURE_CACHE_H
+
+#include <stdio.h>
+#include <string>
+#include <vector>
+#include <algorithm>
+
+#include <dirent.h>
+#include <unistd.h>
+#include <utime.h>
+#include <sys/stat.h>
+
+#include "opencv2/core.hpp"
+
+/**
+  On-disk cache of keypoints and descriptors for reference images.
+
+  Entries are keyed by a hash of the image pixels plus the detector settings
+  so that re-running alignment against the same reference image skips the
+  detect and extract steps for that image.  The modification time of each
+  file is used as the last access time and the least recently used entries
+  are deleted when the cache grows past its size limit.
+*/
+class FeatureCache
+{
+public:
+
+  /// Cache files are stored in folder, which must already exist.
+  FeatureCache(const std::string &folder, const size_t maxBytes)
+    : m_folder(folder), m_maxBytes(maxBytes)
+  {
+    if (!m_folder.empty() && (m_folder[m_folder.size()-1] != '/'))
+      m_folder += "/";
+  }
+
+  /// Generate the cache key for an image and the settings used to process it.
+  /// - The settings string must change whenever the features would change.
+  std::string makeKey(const cv::Mat &image, const std::string &settings) const
+  {
+    // 64 bit FNV-1a hash of the image size and pixel data
+    const unsigned long long FNV_PRIME = 1099511628211ULL;
+    unsigned long long hash = 14695981039346656037ULL;
+    const int header[3] = {image.rows, image.cols, image.type()};
+    const unsigned char* headerBytes = reinterpret_cast<const unsigned char*>(header);
+    for (size_t i=0; i<sizeof(header); ++i)
+    {
+      hash ^= headerBytes[i];
+      hash *= FNV_PRIME;
+    }
+    const size_t rowBytes = image.cols * image.elemSize();
+    for (int r=0; r<image.rows; ++r)
+    {
+      const unsigned char* row = image.ptr<unsigned char>(r);
+      for (size_t i=0; i<rowBytes; ++i)
+      {
+        hash ^= row[i];
+        hash *= FNV_PRIME;
+      }
+    }
+    char hashString[32];
+    snprintf(hashString, sizeof(hashString), "%016llx", hash);
+    return std::string(hashString) + "_" + settings;
+  }
+
+  /// Load cached features, returns false if they are not in the cache.
+  bool load(const std::string &key, std::vector<cv::KeyPoint> &keypoints, cv::Mat &descriptors) const
+  {
+    const std::string path = getPath(key);
+    FILE* file = fopen(path.c_str(), "rb");
+    if (!file)
+      return false;
+
+    bool ok = true;
+    int header[5]; // magic, num keypoints, descriptor rows, cols, type
+    ok = ok && (fread(header, sizeof(int), 5, file) == 5) && (header[0] == FILE_MAGIC);
+    if (ok)
+    {
+      keypoints.resize(header[1]);
+      for (int i=0; ok && (i<header[1]); ++i)
+      {
+        float values[5];
+        int   ints  [2];
+        ok = (fread(values, sizeof(float), 5, file) == 5) &&
+             (fread(ints,   sizeof(int),   2, file) == 2);
+        keypoints[i] = cv::KeyPoint(values[0], values[1], values[2], values[3], values[4],
+                                    ints[0], ints[1]);
+      }
+    }
+    if (ok)
+    {
+      descriptors.create(header[2], header[3], header[4]);
+      const size_t rowBytes = descriptors.cols * descriptors.elemSize();
+      for (int r=0; ok && (r<descriptors.rows); ++r)
+        ok = (fread(descriptors.ptr<unsigned char>(r), 1, rowBytes, file) == rowBytes);
+    }
+    fclose(file);
+
+    if (!ok)
+    {
+      printf("Discarding bad feature cache file %s\n", path.c_str());
+      unlink(path.c_str());
+      keypoints.clear();
+      descriptors = cv::Mat();
+      return false;
+    }
+    utime(path.c_str(), NULL); // Mark as recently used
+    printf("Loaded %lu cached features from %s\n", keypoints.size(), path.c_str());
+    return true;
+  }
+
+  /// Write features to the cache, then enforce the size limit.
+  void save(const std::string &key, const std::vector<cv::KeyPoint> &keypoints,
+            const cv::Mat &descriptors) const
+  {
+    // Write to a temporary file and then rename it so that other processes
+    //  never see a partially written file.
+    const std::string path = getPath(key);
+    char tempSuffix[32];
+    snprintf(tempSuffix, sizeof(tempSuffix), ".%d.tmp", static_cast<int>(getpid()));
+    const std::string tempPath = path + tempSuffix;
+    FILE* file = fopen(tempPath.c_str(), "wb");
+    if (!file)
+    {
+      printf("Unable to write feature cache file %s\n", tempPath.c_str());
+      return;
+    }
+    const int header[5] = {FILE_MAGIC, static_cast<int>(keypoints.size()),
+                           descriptors.rows, descriptors.cols, descriptors.type()};
+    bool ok = (fwrite(header, sizeof(int), 5, file) == 5);
+    for (size_t i=0; ok && (i<keypoints.size()); ++i)
+    {
+      const cv::KeyPoint &k = keypoints[i];
+      const float values[5] = {k.pt.x, k.pt.y, k.size, k.angle, k.response};
+      const int   ints  [2] = {k.octave, k.class_id};
+      ok = (fwrite(values, sizeof(float), 5, file) == 5) &&
+           (fwrite(ints,   sizeof(int),   2, file) == 2);
+    }
+    const size_t rowBytes = descriptors.cols * descriptors.elemSize();
+    for (int r=0; ok && (r<descriptors.rows); ++r)
+      ok = (fwrite(descriptors.ptr<unsigned char>(r), 1, rowBytes, file) == rowBytes);
+    ok = (fclose(file) == 0) && ok;
+
+    if (!ok || (rename(tempPath.c_str(), path.c_str()) != 0))
+    {
+      printf("Failed to write feature cache file %s\n", path.c_str());
+      unlink(tempPath.c_str());
+      return;
+    }
+    evict();
+  }
+
+private:
+
+  static const int FILE_MAGIC = 0x47524643; // Bump if the file format changes
+
+  /// A cache file and its last access time
+  struct CacheEntry
+  {
+    std::string path;
+    time_t      accessTime;
+    size_t      numBytes;
+    bool operator<(const CacheEntry &other) const {return accessTime < other.accessTime;}
+  };
+
+  std::string getPath(const std::string &key) const
+  {
+    return m_folder + key + ".features";
+  }
+
+  /// Delete the least recently used files until the cache fits in the size limit.
+  void evict() const
+  {
+    DIR* dir = opendir(m_folder.c_str());
+    if (!dir)
+      return;
+    std::vector<CacheEntry> entries;
+    size_t totalBytes = 0;
+    const std::string EXTENSION = ".features";
+    struct dirent* item;
+    while ((item = readdir(dir)) != NULL)
+    {
+      std::string name = item->d_name;
+      if ((name.size() <= EXTENSION.size()) ||
+          (name.compare(name.size()-EXTENSION.size(), EXTENSION.size(), EXTENSION) != 0))
+        continue;
+      struct stat info;
+      CacheEntry entry;
+      entry.path = m_folder + name;
+      if (stat(entry.path.c_str(), &info) != 0)
+        continue;
+      entry.accessTime = info.st_mtime;
+      entry.numBytes   = info.st_size;
+      totalBytes += entry.numBytes;
+      entries.push_back(entry);
+    }
+    closedir(dir);
+
+    if (totalBytes <= m_maxBytes)
+      return;
+    std::sort(entries.begin(), entries.end());
+    for (size_t i=0; (i<entries.size()) && (totalBytes > m_maxBytes); ++i)
+    {
+      if (unlink(entries[i].path.c_str()) == 0)
+        totalBytes -= entries[i].numBytes;
+    }
+  }
+
+  std::string m_folder;
+  size_t      m_maxBytes;
+};
+
+
+#endif // GEOREF_FEATURE_CACHE_H
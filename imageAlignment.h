@@ -0,0 +1,1713 @@
+//__BEGIN_LICENSE__
+// Copyright (c) 2017, United States Government, as represented by the
+// Administrator of the National Aeronautics and Space Administration.
+// All rights reserved.
+//
+// The GeoRef platform is licensed under the Apache License, Version 2.0
+// (the "License"); you may not use this file except in compliance with the License.
+// You may obtain a copy of the License at
+// http://www.apache.org/licenses/LICENSE-2.0.
+//
+// Unless required by applicable law or agreed to in writing, software distributed
+// under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+// CONDITIONS OF ANY KIND, either express or implied. See the License for the
+// specific language governing permissions and limitations under the License.
+//__END_LICENSE__
+
+#ifndef GEOREF_IMAGE_ALIGNMENT_H
+#define GEOREF_IMAGE_ALIGNMENT_H
+
+#include <stdio.h>
+#include <iostream>
+#include <fstream>
+#include <sstream>
+#include <map>
+#include <set>
+#include <algorithm>
+#include <cfloat>
+
+#include "opencv2/core.hpp"
+#include "opencv2/features2d.hpp"
+#include "opencv2/calib3d.hpp"
+#include "opencv2/imgproc.hpp"
+
+#include "opencv2/xfeatures2d.hpp"
+
+#include "processingFunctions.h"
+#include "featureCache.h"
+
+/**
+  Image alignment functions shared by the registerGeocamImage tool and
+  the georefAlignment shared library.
+*/
+
+enum DetectorType {DETECTOR_TYPE_BRISK = 0, 
+                   DETECTOR_TYPE_ORB   = 1,
+                   DETECTOR_TYPE_SIFT  = 2,
+                   DETECTOR_TYPE_AKAZE = 3};
+
+enum ModeType {MODE_FAST     = 0,
+               MODE_ACCURATE = 1,
+               MODE_PYRAMID  = 2,
+               MODE_CASCADE  = 3};
+
+enum MatcherType {MATCHER_BRUTE_FORCE = 0,
+                  MATCHER_FLANN       = 1}; // KD-tree for float descriptors, LSH for binary
+
+/// Collects wall times and counts for each stage of an alignment.
+/// - Each call to endStage() charges the time since the previous call to that stage.
+/// - Repeated stages, such as from multiple alignment attempts, are summed.
+class AlignmentTiming
+{
+public:
+  AlignmentTiming() : m_startTicks(cv::getTickCount()), m_lastTicks(m_startTicks) {}
+
+  /// Prepended to the stage and count names until it is changed, so that
+  ///  the same stages run in different passes are reported separately.
+  void setPrefix(const std::string &prefix)
+  {
+    m_prefix = prefix;
+  }
+
+  void endStage(const std::string &stage)
+  {
+    const std::string name = m_prefix + stage;
+    const int64 now = cv::getTickCount();
+    const double seconds = (now - m_lastTicks) / cv::getTickFrequency();
+    m_lastTicks = now;
+    for (size_t i=0; i<m_stages.size(); ++i)
+    {
+      if (m_stages[i].first == name)
+      {
+        m_stages[i].second += seconds;
+        return;
+      }
+    }
+    m_stages.push_back(std::pair<std::string, double>(name, seconds));
+  }
+
+  /// Counts are overwritten if they are set more than once.
+  void setCount(const std::string &count, const size_t value)
+  {
+    const std::string name = m_prefix + count;
+    for (size_t i=0; i<m_counts.size(); ++i)
+    {
+      if (m_counts[i].first == name)
+      {
+        m_counts[i].second = value;
+        return;
+      }
+    }
+    m_counts.push_back(std::pair<std::string, size_t>(name, value));
+  }
+
+  /// Format as {"stages": {name: seconds, ...}, "counts": {name: count, ...}, "total": seconds}
+  std::string toJson() const
+  {
+    std::stringstream s;
+    s << "{\"stages\": {";
+    for (size_t i=0; i<m_stages.size(); ++i)
+      s << ((i > 0) ? ", " : "") << "\"" << m_stages[i].first << "\": " << m_stages[i].second;
+    s << "}, \"counts\": {";
+    for (size_t i=0; i<m_counts.size(); ++i)
+      s << ((i > 0) ? ", " : "") << "\"" << m_counts[i].first << "\": " << m_counts[i].second;
+    s << "}, \"total\": " << (m_lastTicks - m_startTicks) / cv::getTickFrequency() << "}";
+    return s.str();
+  }
+
+private:
+  int64 m_startTicks;
+  int64 m_lastTicks;
+  std::string m_prefix;
+  std::vector<std::pair<std::string, double> > m_stages;
+  std::vector<std::pair<std::string, size_t> > m_counts;
+};
+
+/// Inlier count thresholds used by evaluateRegistrationAccuracy
+const int LOW_CONFIDENCE_MIN_INLIERS  = 5;  // Fewer inliers than this is CONFIDENCE_NONE
+const int HIGH_CONFIDENCE_MIN_INLIERS = 26; // At least this many inliers is CONFIDENCE_HIGH
+
+
+
+void preprocess(const cv::Mat &inputImage, cv::Mat &outputImage)
+{
+  // No preprocessing, just operate on the grayscale images.
+  //outputImage = inputImage;
+  
+  // TODO: Utilize color information
+  // Convert from color to grayscale, images may also be loaded as grayscale.
+  cv::Mat grayImage;
+  if (inputImage.channels() == 1)
+    grayImage = inputImage;
+  else
+    cvtColor(inputImage, grayImage, CV_BGR2GRAY);
+  
+  // Intensity Stretching
+  cv::Mat normImage;
+  intensityStretch(grayImage, normImage);
+  
+  
+  outputImage = normImage;
+  return; // TODO: Experiment with other preprocessing
+  
+  
+  int kernelSize = 9;
+  cv::Mat temp;
+  
+  
+  
+  // Simple Edge detection
+  const int scale = 1;
+  const int delta = 0;
+  cv::Laplacian( normImage, temp, CV_32S, kernelSize, scale, delta, cv::BORDER_DEFAULT );
+  cv::convertScaleAbs( temp, outputImage, 0.001);
+  return;
+  
+  
+  // Canny edge detection
+  cv::Mat small;
+  double kScaleFactor = 1.0/1.0;
+  cv::resize(inputImage, small, cvSize(0, 0), kScaleFactor, kScaleFactor);
+  
+  const int cannyLow  = 200;
+  const int cannyHigh = 300;
+  cv::blur(small, temp, cv::Size(kernelSize, kernelSize));
+  cv::Canny(temp, outputImage, cannyLow, cannyHigh, kernelSize);
+  
+}
+
+
+/// Compute an affine transform for N points, no outlier handling.
+cv::Mat getAffineTransformOverdetermined( const std::vector<cv::Point2f> &src,
+                                          const std::vector<cv::Point2f> &dst)
+{
+  // TODO: Replace this C style code
+  size_t n = src.size();
+  cv::Mat M(2, 3, CV_64F), X(6, 1, CV_64F, M.data); // output
+  double* a = (double*)malloc(12*n*sizeof(double));
+  double* b = (double*)malloc(2*n*sizeof(double));
+  cv::Mat A(2*n, 6, CV_64F, a), B(2*n, 1, CV_64F, b); // input
+
+  for( int i = 0; i < n; i++ )
+  {
+    int j = i*12;   // 2 equations (in x, y) with 6 members: skip 12 elements
+    int k = i*12+6; // second equation: skip extra 6 elements
+    a[j] = a[k+3] = src[i].x;
+    a[j+1] = a[k+4] = src[i].y;
+    a[j+2] = a[k+5] = 1;
+    a[j+3] = a[j+4] = a[j+5] = 0;
+    a[k] = a[k+1] = a[k+2] = 0;
+    b[i*2] = dst[i].x;
+    b[i*2+1] = dst[i].y;
+  }
+  cv::solve( A, B, X, cv::DECOMP_SVD );
+  delete a;
+  delete b;
+  return M;
+}
+
+
+/// See how well all the final points fit into an affine transform
+void affineInlierPrune(std::vector<cv::Point2f> &ptsA, std::vector<cv::Point2f> &ptsB)
+{
+  // Eliminate at most this many points
+  const size_t MAX_PRUNING = 10;
+    
+  size_t numPoints = ptsA.size();
+  size_t numPointsRemoved = 0;
+  double currentError = 0;
+  while (numPointsRemoved < MAX_PRUNING)
+  {
+    // Compute an affine transform using all the points
+    //cv::Mat affineTransform = cv::getAffineTransform(ptsA, ptsB);
+    cv::Mat affineTransform = getAffineTransformOverdetermined(ptsA, ptsB);
+    
+    // Apply the transform to the points
+    std::vector<cv::Point2f> warpedPtsA;
+    cv::transform(ptsA, warpedPtsA, affineTransform);
+    
+    // Compute the per-point error
+    std::vector<double> error(warpedPtsA.size());
+    double maxError = 0;
+    size_t maxErrorIndex = 0;
+    for (size_t i=0; i<warpedPtsA.size(); ++i)
+    {
+      error[i] = sqrt( pow((ptsB[i].x - warpedPtsA[i].x), 2.0) +
+                       pow((ptsB[i].y - warpedPtsA[i].y), 2.0) );
+      if (error[i] > maxError)
+      {
+        maxError      = error[i];
+        maxErrorIndex = i;
+      }
+    }
+    printf("Computed max error %lf at index %lu\n", maxError, maxErrorIndex);
+    std::cout << ptsB[maxErrorIndex] << std::endl;
+    break; // TODO: Do something with this information!
+  }
+}
+
+
+/// Resize an image by a scale factor, using area interpolation when shrinking it.
+cv::Mat scaleAlignmentImage(const cv::Mat &image, const double scale)
+{
+  if ((scale <= 0) || (scale == 1.0) || (!image.data))
+    return image;
+  cv::Size newSize(std::max(1, cvRound(image.cols*scale)),
+                   std::max(1, cvRound(image.rows*scale)));
+  cv::Mat output;
+  cv::resize(image, output, newSize, 0, 0, (scale < 1.0) ? cv::INTER_AREA : cv::INTER_LINEAR);
+  return output;
+}
+
+
+/// Load an image for alignment.
+/// - Images are loaded as grayscale since preprocess() discards the color.
+/// - If reduction is 2, 4, or 8 the image is decoded at that fraction of its
+///   size, which JPEG images can do without decoding the full image.
+/// - The decoded image is then resized by scale.
+cv::Mat loadAlignmentImage(const std::string &path, const int reduction=1, const double scale=1.0)
+{
+  int flags = cv::IMREAD_GRAYSCALE;
+  if (reduction == 2)
+    flags = cv::IMREAD_REDUCED_GRAYSCALE_2;
+  else if (reduction == 4)
+    flags = cv::IMREAD_REDUCED_GRAYSCALE_4;
+  else if (reduction == 8)
+    flags = cv::IMREAD_REDUCED_GRAYSCALE_8;
+  else if (reduction != 1)
+    printf("Ignoring unsupported image reduction %d\n", reduction);
+  return scaleAlignmentImage(cv::imread(path, flags), scale);
+}
+
+
+/// Create the feature detector/extractor object for a detector type.
+cv::Ptr<cv::Feature2D> createFeatureTool(const DetectorType detectorType, const int nfeatures,
+                                         const bool verbose=true)
+{
+  if (detectorType == DETECTOR_TYPE_BRISK)
+  {
+    return cv::BRISK::create();
+  }
+  if (detectorType == DETECTOR_TYPE_ORB)
+  {
+    //nfeatures         = 2000; // ORB is pretty fast to try more features
+    float scaleFactor = 1.2f; // 1.2 is  default
+    int nlevels       = 8; // 8 is default
+    if (verbose)
+      printf("Using the ORB feature detector\n");
+    return cv::ORB::create(nfeatures);
+  }
+  if (detectorType == DETECTOR_TYPE_SIFT)
+  {
+    int nOctaveLayers        = 6; // Output seems very sensitive to this value!
+    double contrastThreshold = 0.04;
+    double edgeThreshold     = 15;
+    double sigma             = 1.2;
+    if (verbose)
+      printf("Using the SIFT feature detector\n");
+    return cv::xfeatures2d::SIFT::create(nfeatures, nOctaveLayers, contrastThreshold, edgeThreshold, sigma);
+  }
+  // DETECTOR_TYPE_AKAZE
+  int   descriptorType     = cv::AKAZE::DESCRIPTOR_MLDB;
+  //int   descriptorType     = cv::AKAZE::DESCRIPTOR_KAZE;
+  int   descriptorSize     = 0; // Max
+  int   descriptorChannels = 3;
+  float threshold          = 0.0015f; // Controls number of points found
+  int   numOctaves         = 8;
+  int   numOctaveLayers    = 5; // Num sublevels per octave
+  return cv::AKAZE::create(descriptorType, descriptorSize, descriptorChannels, threshold, numOctaves, numOctaveLayers);
+}
+
+
+/// Keeps feature detector objects allocated between alignment calls.
+/// - Used by long running processes such as the registerGeocamImage server mode.
+/// - Not thread safe, each thread needs its own cache.
+class FeatureToolCache
+{
+public:
+  cv::Ptr<cv::Feature2D> get(const DetectorType detectorType, const int nfeatures)
+  {
+    std::pair<int, int> key(static_cast<int>(detectorType), nfeatures);
+    std::map<std::pair<int, int>, cv::Ptr<cv::Feature2D> >::iterator iter = m_tools.find(key);
+    if (iter != m_tools.end())
+      return iter->second;
+    cv::Ptr<cv::Feature2D> tool = createFeatureTool(detectorType, nfeatures);
+    m_tools[key] = tool;
+    return tool;
+  }
+
+private:
+  std::map<std::pair<int, int>, cv::Ptr<cv::Feature2D> > m_tools;
+};
+
+
+/// Settings for MODE_CASCADE
+struct CascadeSettings
+{
+  std::vector<DetectorType> detectors; // Tried in order until one works well enough
+  double timeBudgetSeconds; // Stop trying more detectors once this much time has passed
+  bool   usePyramid;        // Use computeImageTransformPyramid for each detector
+
+  CascadeSettings() : timeBudgetSeconds(120), usePyramid(false)
+  {
+    detectors.push_back(DETECTOR_TYPE_ORB  );
+    detectors.push_back(DETECTOR_TYPE_SIFT );
+    detectors.push_back(DETECTOR_TYPE_AKAZE);
+  }
+};
+
+/// Parse a comma separated list of detector names such as "orb,sift,akaze".
+/// - Returns false if any of the names are not recognized.
+bool parseDetectorList(const std::string &text, std::vector<DetectorType> &detectors)
+{
+  detectors.clear();
+  std::stringstream stream(text);
+  std::string name;
+  while (std::getline(stream, name, ','))
+  {
+    std::transform(name.begin(), name.end(), name.begin(), ::tolower);
+    if      (name == "brisk") detectors.push_back(DETECTOR_TYPE_BRISK);
+    else if (name == "orb"  ) detectors.push_back(DETECTOR_TYPE_ORB  );
+    else if (name == "sift" ) detectors.push_back(DETECTOR_TYPE_SIFT );
+    else if (name == "akaze") detectors.push_back(DETECTOR_TYPE_AKAZE);
+    else if (!name.empty())
+    {
+      printf("Unrecognized detector type: %s\n", name.c_str());
+      return false;
+    }
+  }
+  return !detectors.empty();
+}
+
+
+/// Create the descriptor matcher for a detector type.
+cv::Ptr<cv::DescriptorMatcher> createDescriptorMatcher(const DetectorType detectorType,
+                                                       const MatcherType  matcherType)
+{
+  // Only SIFT produces floating point descriptors, the others are binary.
+  const bool binary = (detectorType != DETECTOR_TYPE_SIFT);
+  if (matcherType == MATCHER_FLANN)
+  {
+    const int numChecks = 64; // Higher is more accurate but slower
+    if (binary)
+    {
+      // Multi-probe LSH
+      const int numTables       = 12;
+      const int keySize         = 20;
+      const int multiProbeLevel = 2;
+      return cv::makePtr<cv::FlannBasedMatcher>(
+                cv::makePtr<cv::flann::LshIndexParams>(numTables, keySize, multiProbeLevel),
+                cv::makePtr<cv::flann::SearchParams>(numChecks));
+    }
+    const int numTrees = 4;
+    return cv::makePtr<cv::FlannBasedMatcher>(
+              cv::makePtr<cv::flann::KDTreeIndexParams>(numTrees),
+              cv::makePtr<cv::flann::SearchParams>(numChecks));
+  }
+  if (binary) // Hamming distance is used for binary descriptors
+    return cv::DescriptorMatcher::create("BruteForce-Hamming");
+  return cv::DescriptorMatcher::create("BruteForce");
+}
+
+/// Settings for matching guided by the approximate image position, scale, and rotation
+struct GuidedMatchSettings
+{
+  bool   enabled;
+  double centerTolerance; // Max center offset as a fraction of the larger reference image side
+  double scale;           // Expected size of match image features relative to the reference image
+  double angleBand;       // Max keypoint orientation error in degrees
+
+  GuidedMatchSettings() : enabled(false), centerTolerance(0.25), scale(1.0), angleBand(20) {}
+};
+
+/// Keeps the features computed for a match image in memory so that it can be
+///  aligned to several reference images while only detecting its features once.
+/// - Only valid for a single match image!
+class MatchFeatureMemo
+{
+public:
+
+  /// Returns false if the features have not been computed yet.
+  bool load(const std::string &key, std::vector<cv::KeyPoint> &keypoints, cv::Mat &descriptors) const
+  {
+    std::map<std::string, Entry>::const_iterator iter = m_entries.find(key);
+    if (iter == m_entries.end())
+      return false;
+    keypoints   = iter->second.keypoints;
+    descriptors = iter->second.descriptors.clone(); // The caller may modify the descriptors
+    printf("Reusing %lu match image features.\n", keypoints.size());
+    return true;
+  }
+
+  void save(const std::string &key, const std::vector<cv::KeyPoint> &keypoints,
+            const cv::Mat &descriptors)
+  {
+    Entry &entry = m_entries[key];
+    entry.keypoints   = keypoints;
+    entry.descriptors = descriptors.clone();
+  }
+
+private:
+
+  struct Entry
+  {
+    std::vector<cv::KeyPoint> keypoints;
+    cv::Mat descriptors;
+  };
+  std::map<std::string, Entry> m_entries;
+};
+
+
+/// Optional objects which are kept between alignment calls.
+/// - Any of the pointers may be NULL.
+struct AlignmentContext
+{
+  FeatureToolCache* toolCache;    // Keeps detector objects allocated
+  FeatureCache*     featureCache; // Stores reference image features on disk
+  CascadeSettings   cascade;
+  MatcherType       matcherType;
+  int               tileSize; // If nonzero, detect features in tiles of this size in parallel.
+  AlignmentTiming*  timing;   // Records the time spent in each stage
+  GuidedMatchSettings guided;
+  MatchFeatureMemo* matchFeatures; // If set, match image features are reused from here.
+  int64             stopTicks; // If nonzero, give up on an alignment after this cv::getTickCount() value.
+
+  AlignmentContext() : toolCache(NULL), featureCache(NULL), matcherType(MATCHER_BRUTE_FORCE),
+                       tileSize(0), timing(NULL), matchFeatures(NULL), stopTicks(0) {}
+};
+
+/// Returns true if the alignment using this context has run out of time.
+bool pastStopTime(const AlignmentContext* context)
+{
+  return context && (context->stopTicks != 0) && (cv::getTickCount() >= context->stopTicks);
+}
+
+
+/// Returns the settings string used in reference feature cache keys.
+/// - Increment FEATURE_VERSION if the preprocessing or the detector parameters change!
+std::string getFeatureSettingsString(const DetectorType detectorType, const int nfeatures,
+                                     const int tileSize)
+{
+  const int FEATURE_VERSION = 1;
+  std::stringstream s;
+  s << "d" << detectorType << "_n" << nfeatures << "_t" << tileSize << "_v" << FEATURE_VERSION;
+  return s.str();
+}
+
+
+/// One unit of feature detection work, either a whole image or one tile of it.
+struct FeatureJob
+{
+  const cv::Mat*         image;
+  DetectorType           detectorType;
+  int                    nfeatures;
+  cv::Ptr<cv::Feature2D> tool; // If empty, a new detector object is created for the job.
+  cv::Rect               tile; // Region of the image passed to the detector
+  cv::Rect               core; // Only keypoints in this region are kept
+  std::vector<cv::KeyPoint> keypoints; // Output in image coordinates
+  cv::Mat                   descriptors;
+};
+
+/// Runs a list of feature jobs, used with cv::parallel_for_.
+class FeatureJobBody : public cv::ParallelLoopBody
+{
+public:
+  FeatureJobBody(std::vector<FeatureJob> &jobs) : m_jobs(jobs) {}
+
+  virtual void operator()(const cv::Range &range) const
+  {
+    for (int i=range.start; i<range.end; ++i)
+    {
+      FeatureJob &job = m_jobs[i];
+      // Detector objects are not shared between threads.
+      cv::Ptr<cv::Feature2D> tool = job.tool;
+      if (tool.empty())
+        tool = createFeatureTool(job.detectorType, job.nfeatures, false);
+      std::vector<cv::KeyPoint> keypoints;
+      cv::Mat descriptors;
+      tool->detectAndCompute((*job.image)(job.tile), cv::noArray(), keypoints, descriptors);
+      if (job.tile == job.core) // Whole image, nothing to filter
+      {
+        job.keypoints.swap(keypoints);
+        job.descriptors = descriptors;
+        continue;
+      }
+
+      // Only keep keypoints in the core of the tile so that the overlapping
+      //  regions do not produce duplicate features.
+      const cv::Point2f offset(static_cast<float>(job.tile.x), static_cast<float>(job.tile.y));
+      for (size_t k=0; k<keypoints.size(); ++k)
+      {
+        cv::KeyPoint keypoint = keypoints[k];
+        keypoint.pt += offset;
+        if (!job.core.contains(cv::Point(static_cast<int>(keypoint.pt.x),
+                                         static_cast<int>(keypoint.pt.y))))
+          continue;
+        job.keypoints.push_back(keypoint);
+        job.descriptors.push_back(descriptors.row(static_cast<int>(k)));
+      }
+    }
+  }
+
+private:
+  std::vector<FeatureJob> &m_jobs;
+};
+
+
+/// Tiles are padded by this much so features near their edges are not lost.
+/// - Must be larger than the descriptor patch size.
+const int FEATURE_TILE_OVERLAP = 48;
+
+/// Add the feature jobs for one image to a job list.
+/// - If tileSize is set, large images are split into overlapping tiles and
+///   the feature count is divided between the tiles by area so the features
+///   are spread out across the image.
+/// - tool is used for the image if it is not split into tiles.
+void addFeatureJobs(const cv::Mat &image, const DetectorType detectorType, const int nfeatures,
+                    cv::Ptr<cv::Feature2D> tool, const int tileSize,
+                    std::vector<FeatureJob> &jobs)
+{
+  const int MIN_TILE_FEATURES = 100;
+
+  const cv::Rect imageRect(0, 0, image.cols, image.rows);
+  FeatureJob job;
+  job.image        = &image;
+  job.detectorType = detectorType;
+  if ((tileSize <= 0) || ((image.rows <= tileSize) && (image.cols <= tileSize)))
+  {
+    job.nfeatures = nfeatures;
+    job.tool      = tool;
+    job.tile      = imageRect;
+    job.core      = imageRect;
+    jobs.push_back(job);
+    return;
+  }
+
+  const double imageArea = static_cast<double>(image.rows) * image.cols;
+  size_t numTiles = 0;
+  for (int r=0; r<image.rows; r+=tileSize)
+  {
+    for (int c=0; c<image.cols; c+=tileSize)
+    {
+      job.core = cv::Rect(c, r, std::min(tileSize, image.cols-c), std::min(tileSize, image.rows-r));
+      job.tile = cv::Rect(job.core.x - FEATURE_TILE_OVERLAP, job.core.y - FEATURE_TILE_OVERLAP,
+                          job.core.width  + 2*FEATURE_TILE_OVERLAP,
+                          job.core.height + 2*FEATURE_TILE_OVERLAP) & imageRect;
+      job.nfeatures = std::max(static_cast<int>(nfeatures * job.core.area() / imageArea),
+                               MIN_TILE_FEATURES);
+      jobs.push_back(job);
+      ++numTiles;
+    }
+  }
+  printf("Split %d x %d image into %lu tiles.\n", image.cols, image.rows, numTiles);
+}
+
+/// Add feature jobs which only detect features inside the given regions of an image.
+/// - The regions should not overlap.  The feature count for the whole image is
+///   divided between them by area so the feature density is unchanged.
+void addRegionFeatureJobs(const cv::Mat &image, const DetectorType detectorType, const int nfeatures,
+                          const std::vector<cv::Rect> &regions, std::vector<FeatureJob> &jobs)
+{
+  const int MIN_REGION_FEATURES = 50;
+
+  const cv::Rect imageRect(0, 0, image.cols, image.rows);
+  const double imageArea = static_cast<double>(image.rows) * image.cols;
+  FeatureJob job;
+  job.image        = &image;
+  job.detectorType = detectorType;
+  for (size_t i=0; i<regions.size(); ++i)
+  {
+    job.core = regions[i] & imageRect;
+    if (job.core.area() == 0)
+      continue;
+    job.tile = cv::Rect(job.core.x - FEATURE_TILE_OVERLAP, job.core.y - FEATURE_TILE_OVERLAP,
+                        job.core.width  + 2*FEATURE_TILE_OVERLAP,
+                        job.core.height + 2*FEATURE_TILE_OVERLAP) & imageRect;
+    job.nfeatures = std::max(static_cast<int>(nfeatures * job.core.area() / imageArea),
+                             MIN_REGION_FEATURES);
+    jobs.push_back(job);
+  }
+}
+
+/// Get the cells of a regionSize grid over an image which are within radius
+///  pixels of any of the points.  The points are multiplied by pointScale first.
+void getPointRegions(const std::vector<cv::Point2f> &points, const double pointScale,
+                     const cv::Size &imageSize, const int regionSize, const double radius,
+                     std::vector<cv::Rect> &regions)
+{
+  const int numCols = (imageSize.width  + regionSize - 1) / regionSize;
+  const int numRows = (imageSize.height + regionSize - 1) / regionSize;
+  std::set<std::pair<int, int> > cells;
+  for (size_t i=0; i<points.size(); ++i)
+  {
+    const double x = points[i].x * pointScale;
+    const double y = points[i].y * pointScale;
+    const int minCol = std::max(0,         static_cast<int>(floor((x - radius) / regionSize)));
+    const int maxCol = std::min(numCols-1, static_cast<int>(floor((x + radius) / regionSize)));
+    const int minRow = std::max(0,         static_cast<int>(floor((y - radius) / regionSize)));
+    const int maxRow = std::min(numRows-1, static_cast<int>(floor((y + radius) / regionSize)));
+    for (int row=minRow; row<=maxRow; ++row)
+      for (int col=minCol; col<=maxCol; ++col)
+        cells.insert(std::pair<int, int>(row, col));
+  }
+  const cv::Rect imageRect(0, 0, imageSize.width, imageSize.height);
+  regions.clear();
+  for (std::set<std::pair<int, int> >::const_iterator iter=cells.begin(); iter!=cells.end(); ++iter)
+    regions.push_back(cv::Rect(iter->second*regionSize, iter->first*regionSize,
+                               regionSize, regionSize) & imageRect);
+}
+
+/// Run all of the feature jobs in parallel.
+/// - The number of threads is set with cv::setNumThreads().
+void runFeatureJobs(std::vector<FeatureJob> &jobs)
+{
+  printf("Running %lu feature detection jobs using %d threads...\n", jobs.size(), cv::getNumThreads());
+  cv::parallel_for_(cv::Range(0, static_cast<int>(jobs.size())), FeatureJobBody(jobs));
+}
+
+/// Merge the results of the jobs in [start, stop) into one set of features.
+void mergeFeatureJobs(const std::vector<FeatureJob> &jobs, const size_t start, const size_t stop,
+                      std::vector<cv::KeyPoint> &keypoints, cv::Mat &descriptors)
+{
+  keypoints.clear();
+  descriptors = cv::Mat();
+  for (size_t i=start; i<stop; ++i)
+  {
+    if (jobs[i].keypoints.empty())
+      continue;
+    keypoints.insert(keypoints.end(), jobs[i].keypoints.begin(), jobs[i].keypoints.end());
+    descriptors.push_back(jobs[i].descriptors);
+  }
+}
+
+
+/// Runs preprocess() on several images, used with cv::parallel_for_.
+class PreprocessBody : public cv::ParallelLoopBody
+{
+public:
+  PreprocessBody(const std::vector<const cv::Mat*> &inputs, const std::vector<cv::Mat*> &outputs)
+    : m_inputs(inputs), m_outputs(outputs) {}
+
+  virtual void operator()(const cv::Range &range) const
+  {
+    for (int i=range.start; i<range.end; ++i)
+      preprocess(*m_inputs[i], *m_outputs[i]);
+  }
+
+private:
+  const std::vector<const cv::Mat*> &m_inputs;
+  const std::vector<cv::Mat*>       &m_outputs;
+};
+
+
+/// Find the two best matches for each reference descriptor, only considering match
+///  image keypoints within windowSize pixels of where priorTransform predicts them.
+/// - priorTransform is from MATCH to REF.
+/// - If angleBand is positive, candidates must also have keypoint orientations
+///   which differ by expectedAngleDiff (REF minus MATCH) to within angleBand degrees.
+/// - Output is in the same format as DescriptorMatcher::knnMatch with k=2, but
+///   entries may contain a single match if there was only one candidate.
+///   filterSeparatedMatches drops those since they cannot pass the ratio test.
+void matchWithinWindow(const std::vector<cv::KeyPoint> &keypointsA, const cv::Mat &descriptorsA,
+                       const std::vector<cv::KeyPoint> &keypointsB, const cv::Mat &descriptorsB,
+                       const cv::Mat &priorTransform, const double windowSize, const int normType,
+                       std::vector<std::vector<cv::DMatch> > &matches,
+                       const double expectedAngleDiff=0, const double angleBand=0)
+{
+  matches.clear();
+  if (keypointsA.empty() || keypointsB.empty() || (windowSize <= 0))
+    return;
+
+  // Bin the match keypoints into a grid with cells smaller than the window so
+  //  that the candidates for a cell are not much more than the window area.
+  const int    CELLS_PER_WINDOW = 2;
+  const double cellSize = windowSize / CELLS_PER_WINDOW;
+  float minX = keypointsB[0].pt.x, maxX = minX;
+  float minY = keypointsB[0].pt.y, maxY = minY;
+  for (size_t i=1; i<keypointsB.size(); ++i)
+  {
+    minX = std::min(minX, keypointsB[i].pt.x);  maxX = std::max(maxX, keypointsB[i].pt.x);
+    minY = std::min(minY, keypointsB[i].pt.y);  maxY = std::max(maxY, keypointsB[i].pt.y);
+  }
+  const int numCols = static_cast<int>((maxX - minX) / cellSize) + 1;
+  const int numRows = static_cast<int>((maxY - minY) / cellSize) + 1;
+  std::vector<std::vector<int> > gridB(numCols*numRows);
+  for (size_t i=0; i<keypointsB.size(); ++i)
+  {
+    int col = static_cast<int>((keypointsB[i].pt.x - minX) / cellSize);
+    int row = static_cast<int>((keypointsB[i].pt.y - minY) / cellSize);
+    gridB[row*numCols + col].push_back(static_cast<int>(i));
+  }
+
+  // Predict the location of each reference keypoint in the match image and
+  //  put them in the same grid, skipping those which land outside the match image.
+  std::vector<cv::Point2f> refPts(keypointsA.size()), predictedPts;
+  for (size_t i=0; i<keypointsA.size(); ++i)
+    refPts[i] = keypointsA[i].pt;
+  cv::perspectiveTransform(refPts, predictedPts, priorTransform.inv());
+  std::vector<std::vector<int> > gridA(numCols*numRows);
+  for (size_t i=0; i<keypointsA.size(); ++i)
+  {
+    const cv::Point2f &p = predictedPts[i];
+    if ((p.x < minX - windowSize) || (p.x > maxX + windowSize) ||
+        (p.y < minY - windowSize) || (p.y > maxY + windowSize))
+      continue;
+    int col = std::min(numCols-1, std::max(0, static_cast<int>(floor((p.x - minX) / cellSize))));
+    int row = std::min(numRows-1, std::max(0, static_cast<int>(floor((p.y - minY) / cellSize))));
+    gridA[row*numCols + col].push_back(static_cast<int>(i));
+  }
+
+  // Match all the reference keypoints in a cell at once against the match keypoints
+  //  in the nearby cells, with a mask to enforce the window and the angle band.
+  const int    reach    = CELLS_PER_WINDOW;
+  const double windowSq = windowSize*windowSize;
+  cv::BFMatcher matcher(normType);
+  matches.reserve(keypointsA.size());
+  for (int row=0; row<numRows; ++row)
+  {
+    for (int col=0; col<numCols; ++col)
+    {
+      const std::vector<int> &cellA = gridA[row*numCols + col];
+      if (cellA.empty())
+        continue;
+
+      std::vector<int> candidates;
+      for (int r=std::max(0, row-reach); r<=std::min(numRows-1, row+reach); ++r)
+        for (int c=std::max(0, col-reach); c<=std::min(numCols-1, col+reach); ++c)
+          candidates.insert(candidates.end(), gridB[r*numCols + c].begin(), gridB[r*numCols + c].end());
+      if (candidates.empty())
+        continue;
+
+      cv::Mat queryDescriptors, trainDescriptors;
+      cv::Mat mask = cv::Mat::zeros(static_cast<int>(cellA.size()), static_cast<int>(candidates.size()), CV_8U);
+      bool anyAllowed = false;
+      for (size_t a=0; a<cellA.size(); ++a)
+      {
+        const int i = cellA[a];
+        const cv::Point2f &p = predictedPts[i];
+        queryDescriptors.push_back(descriptorsA.row(i));
+        for (size_t b=0; b<candidates.size(); ++b)
+        {
+          const int j = candidates[b];
+          const double dx = keypointsB[j].pt.x - p.x;
+          const double dy = keypointsB[j].pt.y - p.y;
+          if (dx*dx + dy*dy > windowSq)
+            continue;
+          if ((angleBand > 0) && (keypointsA[i].angle >= 0) && (keypointsB[j].angle >= 0))
+          {
+            double angleError = fmod(keypointsA[i].angle - keypointsB[j].angle - expectedAngleDiff, 360.0);
+            if (angleError < -180.0) angleError += 360.0;
+            if (angleError >  180.0) angleError -= 360.0;
+            if (fabs(angleError) > angleBand)
+              continue;
+          }
+          mask.at<unsigned char>(static_cast<int>(a), static_cast<int>(b)) = 1;
+          anyAllowed = true;
+        }
+      }
+      if (!anyAllowed)
+        continue;
+      for (size_t b=0; b<candidates.size(); ++b)
+        trainDescriptors.push_back(descriptorsB.row(candidates[b]));
+
+      // Masked out pairs are skipped and queries with no candidates are dropped.
+      std::vector<std::vector<cv::DMatch> > cellMatches;
+      matcher.knnMatch(queryDescriptors, trainDescriptors, cellMatches, 2, mask, true);
+      for (size_t k=0; k<cellMatches.size(); ++k)
+      {
+        if (cellMatches[k].empty())
+          continue;
+        for (size_t m=0; m<cellMatches[k].size(); ++m)
+        {
+          cellMatches[k][m].queryIdx = cellA[cellMatches[k][m].queryIdx];
+          cellMatches[k][m].trainIdx = candidates[cellMatches[k][m].trainIdx];
+        }
+        matches.push_back(cellMatches[k]);
+      }
+    }
+  }
+}
+
+
+/// Keep only matches which are clearly better than the second best candidate.
+/// - Entries with fewer than two candidates cannot pass the ratio test and are dropped.
+void filterSeparatedMatches(const std::vector<std::vector<cv::DMatch> > &matches,
+                            std::vector<cv::DMatch> &seperatedMatches)
+{
+  const float SEPERATION_RATIO = 0.8; // Min seperation between top two matches
+  seperatedMatches.clear();
+  seperatedMatches.reserve(matches.size());
+  for (size_t i = 0; i < matches.size(); ++i)
+  {
+    // Only accept matches which stand out
+    if (matches[i].size() < 2)
+      continue;
+    if (matches[i][0].distance < SEPERATION_RATIO * matches[i][1].distance)
+    {
+      seperatedMatches.push_back(matches[i][0]);
+    }
+  }
+}
+
+
+/// Find the ratio test matches between the strongest keypoints in each image.
+/// - The output matches index into the full keypoint lists.
+void matchStrongestKeypoints(const std::vector<cv::KeyPoint> &keypointsA, const cv::Mat &descriptorsA,
+                             const std::vector<cv::KeyPoint> &keypointsB, const cv::Mat &descriptorsB,
+                             const int normType, const size_t numStrongest,
+                             std::vector<cv::DMatch> &matches)
+{
+  // Get the indices of the highest response keypoints in each image
+  std::vector<std::pair<float, int> > responsesA, responsesB;
+  for (size_t i=0; i<keypointsA.size(); ++i)
+    responsesA.push_back(std::pair<float, int>(-keypointsA[i].response, static_cast<int>(i)));
+  for (size_t i=0; i<keypointsB.size(); ++i)
+    responsesB.push_back(std::pair<float, int>(-keypointsB[i].response, static_cast<int>(i)));
+  std::sort(responsesA.begin(), responsesA.end());
+  std::sort(responsesB.begin(), responsesB.end());
+  responsesA.resize(std::min(numStrongest, responsesA.size()));
+  responsesB.resize(std::min(numStrongest, responsesB.size()));
+  cv::Mat subsetA, subsetB;
+  for (size_t i=0; i<responsesA.size(); ++i)
+    subsetA.push_back(descriptorsA.row(responsesA[i].second));
+  for (size_t i=0; i<responsesB.size(); ++i)
+    subsetB.push_back(descriptorsB.row(responsesB[i].second));
+
+  matches.clear();
+  if ((subsetA.rows < 2) || (subsetB.rows < 2))
+    return;
+  cv::BFMatcher matcher(normType);
+  std::vector<std::vector<cv::DMatch> > knnMatches;
+  matcher.knnMatch(subsetA, subsetB, knnMatches, 2);
+  filterSeparatedMatches(knnMatches, matches);
+  for (size_t i=0; i<matches.size(); ++i)
+  {
+    matches[i].queryIdx = responsesA[matches[i].queryIdx].second;
+    matches[i].trainIdx = responsesB[matches[i].trainIdx].second;
+  }
+}
+
+
+/// Estimate a MATCH to REF transform from matches between the strongest keypoints,
+///  used to guide the feature matching.
+/// - The estimate is rejected if it places the match image center further than
+///   centerTolerance (a fraction of the larger reference image side) from the
+///   reference image center or if its scale is far from the expected scale.
+/// - windowSize is set from the error of the estimate, in match image pixels.
+/// - Returns false if no usable estimate was found.
+bool estimateGuidedPrior(const cv::Size &refSize, const cv::Size &matchSize,
+                         const std::vector<cv::KeyPoint> &keypointsA, const cv::Mat &descriptorsA,
+                         const std::vector<cv::KeyPoint> &keypointsB, const cv::Mat &descriptorsB,
+                         const int normType, const double scale, const double centerTolerance,
+                         cv::Mat &priorTransform, double &rotationDegrees, double &windowSize)
+{
+  const size_t NUM_STRONGEST      = 500;
+  const size_t MIN_PRIOR_MATCHES  = 10;
+  const int    MIN_PRIOR_INLIERS  = 8;
+  const double RANSAC_THRESHOLD   = 8.0;  // In reference image pixels
+  const double MAX_SCALE_ERROR    = 2.0;  // Ratio to the expected scale
+  const double WINDOW_PER_RMS     = 4.0;  // Window size relative to the inlier error
+  const double MIN_WINDOW         = 16.0;
+  const double MAX_WINDOW         = 64.0;
+  const double PI = 3.14159265359;
+
+  std::vector<cv::DMatch> matches;
+  matchStrongestKeypoints(keypointsA, descriptorsA, keypointsB, descriptorsB,
+                          normType, NUM_STRONGEST, matches);
+  printf("Estimating guided prior from %lu strong keypoint matches.\n", matches.size());
+  if (matches.size() < MIN_PRIOR_MATCHES)
+    return false;
+
+  std::vector<cv::Point2f> refPts, matchPts;
+  for (size_t i=0; i<matches.size(); ++i)
+  {
+    refPts.push_back  (keypointsA[matches[i].queryIdx].pt);
+    matchPts.push_back(keypointsB[matches[i].trainIdx].pt);
+  }
+  std::vector<unsigned char> inlierMask;
+  cv::Mat H = cv::findHomography(matchPts, refPts, cv::RANSAC, RANSAC_THRESHOLD, inlierMask);
+  if (H.empty())
+    return false;
+  const int numInliers = cv::countNonZero(inlierMask);
+  if (numInliers < MIN_PRIOR_INLIERS)
+    return false;
+
+  // Check the estimate against what we already know about the images.
+  std::vector<cv::Point2f> center(1, cv::Point2f(matchSize.width/2.0f, matchSize.height/2.0f));
+  std::vector<cv::Point2f> projectedCenter;
+  cv::perspectiveTransform(center, projectedCenter, H);
+  const double maxOffset = centerTolerance * std::max(refSize.width, refSize.height);
+  const double offset    = cv::norm(projectedCenter[0] - cv::Point2f(refSize.width/2.0f, refSize.height/2.0f));
+  const double fitScale  = sqrt(fabs(H.at<double>(0,0)*H.at<double>(1,1) - H.at<double>(0,1)*H.at<double>(1,0)));
+  if ((offset > maxOffset) || (fitScale <= 0) ||
+      (fitScale > scale*MAX_SCALE_ERROR) || (fitScale < scale/MAX_SCALE_ERROR))
+  {
+    printf("Rejecting guided prior with center offset %lf and scale %lf\n", offset, fitScale);
+    return false;
+  }
+
+  // The window only needs to cover the error of the estimate.
+  std::vector<cv::Point2f> projectedPts;
+  cv::perspectiveTransform(matchPts, projectedPts, H);
+  double sumSq = 0;
+  for (size_t i=0; i<projectedPts.size(); ++i)
+  {
+    if (!inlierMask[i])
+      continue;
+    const cv::Point2f diff = projectedPts[i] - refPts[i];
+    sumSq += diff.x*diff.x + diff.y*diff.y;
+  }
+  const double rmsMatchPixels = sqrt(sumSq / numInliers) / fitScale;
+  windowSize = std::min(MAX_WINDOW, std::max(MIN_WINDOW, WINDOW_PER_RMS*rmsMatchPixels));
+
+  rotationDegrees = atan2(H.at<double>(1,0), H.at<double>(0,0)) * 180.0 / PI;
+  priorTransform  = H;
+  return true;
+}
+
+
+/// Returns the number of inliers
+/// - Computed transform is from MATCH (second) to REF (first).
+/// - If priorTransform is provided, only matches which agree with it to within
+///   priorWindow pixels are considered.
+/// - If refRegions or matchRegions are provided, features are only detected inside
+///   those regions of that image and the feature caches are not used for it.
+int computeImageTransform(const cv::Mat &refImageIn, const cv::Mat &matchImageIn,
+                          cv::Mat &transform,
+                          std::vector<cv::Point2f> &refInlierCoords, 
+                          std::vector<cv::Point2f> &matchInlierCoords,
+                          const std::string debugFolder,
+                          const int          kernelSize  =5, 
+                          const DetectorType detectorType=DETECTOR_TYPE_ORB,
+                          bool debug=true,
+                          AlignmentContext* context=NULL,
+                          const cv::Mat &priorTransform=cv::Mat(),
+                          const double priorWindow=0,
+                          const std::vector<cv::Rect> &refRegions=std::vector<cv::Rect>(),
+                          const std::vector<cv::Rect> &matchRegions=std::vector<cv::Rect>())
+{
+  FeatureToolCache* toolCache    = context ? context->toolCache    : NULL;
+  FeatureCache*     featureCache = (context && refRegions.empty())   ? context->featureCache  : NULL;
+  MatchFeatureMemo* matchMemo    = (context && matchRegions.empty()) ? context->matchFeatures : NULL;
+  const int         tileSize     = context ? context->tileSize     : 0;
+  AlignmentTiming localTiming;
+  AlignmentTiming &timing = (context && context->timing) ? *context->timing : localTiming;
+
+  std::vector<cv::KeyPoint> keypointsA, keypointsB;
+  cv::Mat descriptorsA, descriptorsB;  
+
+  const int numPixelsRef   = refImageIn.rows   * refImageIn.cols;
+  const int numPixelsMatch = matchImageIn.rows * matchImageIn.cols;
+
+  // Adaptively set the number of features
+  int nfeaturesRef   = numPixelsRef   / 850;
+  int nfeaturesMatch = numPixelsMatch / 850;
+  const int MIN_FEATURES =  3000;
+  const int MAX_FEATURES = 15000;
+  if (nfeaturesRef   < MIN_FEATURES) nfeaturesRef   = MIN_FEATURES;
+  if (nfeaturesMatch < MIN_FEATURES) nfeaturesMatch = MIN_FEATURES;
+  if (nfeaturesRef   > MAX_FEATURES) nfeaturesRef   = MAX_FEATURES;
+  if (nfeaturesMatch > MAX_FEATURES) nfeaturesMatch = MAX_FEATURES;
+
+  printf("Using %d reference features.\n", nfeaturesRef);
+  printf("Using %d match features.\n",     nfeaturesMatch);
+
+  // The same reference image is often used for several alignments, so its
+  //  features may already be in the cache.
+  std::string refCacheKey;
+  bool haveRefFeatures = false;
+  if (featureCache)
+  {
+    refCacheKey     = featureCache->makeKey(refImageIn, getFeatureSettingsString(detectorType, nfeaturesRef, tileSize));
+    haveRefFeatures = featureCache->load(refCacheKey, keypointsA, descriptorsA);
+  }
+  // When aligning to several reference images the match features are only computed once.
+  std::stringstream matchMemoKey;
+  bool haveMatchFeatures = false;
+  if (matchMemo)
+  {
+    matchMemoKey << getFeatureSettingsString(detectorType, nfeaturesMatch, tileSize)
+                 << "_" << matchImageIn.cols << "x" << matchImageIn.rows;
+    haveMatchFeatures = matchMemo->load(matchMemoKey.str(), keypointsB, descriptorsB);
+  }
+  timing.endStage("featureCache");
+
+  // Preprocess the images to improve feature detection
+  // - The two images are independent until matching so they are processed concurrently.
+  cv::Mat refImage, matchImage;
+  std::vector<const cv::Mat*> preprocessInputs;
+  std::vector<cv::Mat*>       preprocessOutputs;
+  if (!haveMatchFeatures || debug)
+  {
+    preprocessInputs.push_back (&matchImageIn);
+    preprocessOutputs.push_back(&matchImage);
+  }
+  if (!haveRefFeatures || debug)
+  {
+    preprocessInputs.push_back (&refImageIn);
+    preprocessOutputs.push_back(&refImage);
+  }
+  cv::parallel_for_(cv::Range(0, static_cast<int>(preprocessInputs.size())),
+                    PreprocessBody(preprocessInputs, preprocessOutputs));
+  timing.endStage("preprocess");
+  
+  if (debug)
+  {
+    printf("Writing preprocessed images...\n");
+    cv::imwrite( debugFolder+"basemapProcessed.jpeg", refImage );
+    cv::imwrite( debugFolder+"geocamProcessed.jpeg",  matchImage );
+  }
+  
+  cv::Ptr<cv::Feature2D> detectorRef, detectorMatch;
+  if (toolCache)
+  {
+    detectorRef   = toolCache->get(detectorType, nfeaturesRef  );
+    detectorMatch = toolCache->get(detectorType, nfeaturesMatch);
+  }
+  else
+  {
+    detectorRef   = createFeatureTool(detectorType, nfeaturesRef  );
+    detectorMatch = createFeatureTool(detectorType, nfeaturesMatch);
+  }
+  // The tool cache returns the same object for equal feature counts, but
+  //  the two images are processed at the same time.
+  if ((!haveRefFeatures) && (!haveMatchFeatures) && (detectorMatch.get() == detectorRef.get()))
+    detectorMatch = createFeatureTool(detectorType, nfeaturesMatch);
+
+  // TODO: Try out a cloud masking algorithm for the ISS image!
+  // - Handle clouds in the reference image using Earth Engine.
+  //cv::Mat keypointMask(matchImage.size(), CV_8U)
+
+  // Detect and describe features in both images at once
+  std::vector<FeatureJob> featureJobs;
+  if (!haveRefFeatures) // Basemap
+  {
+    if (refRegions.empty())
+      addFeatureJobs(refImage, detectorType, nfeaturesRef, detectorRef, tileSize, featureJobs);
+    else
+      addRegionFeatureJobs(refImage, detectorType, nfeaturesRef, refRegions, featureJobs);
+  }
+  const size_t numRefJobs = featureJobs.size();
+  if (!haveMatchFeatures) // ISS image
+  {
+    if (matchRegions.empty())
+      addFeatureJobs(matchImage, detectorType, nfeaturesMatch, detectorMatch, tileSize, featureJobs);
+    else
+      addRegionFeatureJobs(matchImage, detectorType, nfeaturesMatch, matchRegions, featureJobs);
+  }
+  runFeatureJobs(featureJobs);
+  timing.endStage("detectExtract");
+
+  if (!haveRefFeatures)
+  {
+    mergeFeatureJobs(featureJobs, 0, numRefJobs, keypointsA, descriptorsA);
+
+    // Cache the raw descriptors, any post processing is applied after loading.
+    if (featureCache && (keypointsA.size() > 0))
+      featureCache->save(refCacheKey, keypointsA, descriptorsA);
+  }
+  if (!haveMatchFeatures)
+  {
+    mergeFeatureJobs(featureJobs, numRefJobs, featureJobs.size(), keypointsB, descriptorsB);
+    if (matchMemo)
+      matchMemo->save(matchMemoKey.str(), keypointsB, descriptorsB);
+  }
+  timing.endStage("featureCache");
+  timing.setCount("refKeypoints",   keypointsA.size());
+  timing.setCount("matchKeypoints", keypointsB.size());
+  if (pastStopTime(context))
+  {
+    printf("Out of time after feature detection.\n");
+    return 0;
+  }
+
+  if ( (keypointsA.size() == 0) || (keypointsB.size() == 0) )
+  {
+    std::cout << "Failed to find any features in an image!\n";
+    return 0;
+  }
+  printf("Detected %lu and %lu keypoints\n", keypointsA.size(), keypointsB.size());
+
+  // TODO: Does not seem to make a difference...
+  //if ( (detectorType == DETECTOR_TYPE_SIFT) || (detectorType == DETECTOR_TYPE_AKAZE))
+  if (detectorType == DETECTOR_TYPE_SIFT)
+  {
+    applyRootSift(descriptorsA);
+    applyRootSift(descriptorsB);
+  }
+  
+  if (debug)
+  {
+    cv::Mat keypointImageA, keypointImageB;
+    cv::drawKeypoints(refImageIn, keypointsA, keypointImageA,
+                      cv::Scalar::all(-1), cv::DrawMatchesFlags::DRAW_RICH_KEYPOINTS);
+    cv::drawKeypoints(matchImageIn, keypointsB, keypointImageB,
+                      cv::Scalar::all(-1), cv::DrawMatchesFlags::DRAW_RICH_KEYPOINTS);
+    cv::imwrite( debugFolder+"refKeypoints.tif", keypointImageA);
+    cv::imwrite( debugFolder+"matchKeypoints.tif", keypointImageB);
+  }
+  
+  // Find the closest match for each feature
+  // Hamming distance is used for binary descriptors
+  const int normType = (detectorType == DETECTOR_TYPE_SIFT) ? cv::NORM_L2 : cv::NORM_HAMMING;
+  const size_t N_BEST_MATCHES = 2;
+  std::vector<std::vector<cv::DMatch> > matches;
+  std::vector<cv::DMatch> seperatedMatches;
+  if (!priorTransform.empty())
+  {
+    matchWithinWindow(keypointsA, descriptorsA, keypointsB, descriptorsB,
+                      priorTransform, priorWindow, normType, matches);
+  }
+  else if (context && context->guided.enabled)
+  {
+    // Use a transform estimated from the strongest keypoints, checked against
+    //  the known image center and scale, to limit the candidate matches for each feature.
+    const GuidedMatchSettings &guided = context->guided;
+    cv::Mat guidedPrior;
+    double  rotation = 0, window = 0;
+    if (estimateGuidedPrior(refImageIn.size(), matchImageIn.size(),
+                            keypointsA, descriptorsA, keypointsB, descriptorsB,
+                            normType, guided.scale, guided.centerTolerance,
+                            guidedPrior, rotation, window))
+    {
+      printf("Guided matching with rotation %lf and window size %lf\n", rotation, window);
+      timing.endStage("guidedPrior");
+      matchWithinWindow(keypointsA, descriptorsA, keypointsB, descriptorsB,
+                        guidedPrior, window, normType, matches,
+                        rotation, guided.angleBand);
+      filterSeparatedMatches(matches, seperatedMatches);
+    }
+    else
+      timing.endStage("guidedPrior");
+
+    // If the prior was wrong there will be few matches, fall back to global matching.
+    const size_t MIN_GUIDED_MATCHES = 20;
+    if (seperatedMatches.size() < MIN_GUIDED_MATCHES)
+    {
+      printf("Guided matching found only %lu matches, using global matching.\n",
+             seperatedMatches.size());
+      matches.clear();
+      seperatedMatches.clear();
+    }
+  }
+  if (matches.empty())
+  {
+    const MatcherType matcherType = context ? context->matcherType : MATCHER_BRUTE_FORCE;
+    cv::Ptr<cv::DescriptorMatcher> matcher = createDescriptorMatcher(detectorType, matcherType);
+    matcher->knnMatch(descriptorsA, descriptorsB, matches, N_BEST_MATCHES);
+  }
+  printf("Initial matching finds %lu matches.\n", matches.size());
+  timing.endStage("match");
+  timing.setCount("initialMatches", matches.size());
+  if (pastStopTime(context))
+  {
+    printf("Out of time after feature matching.\n");
+    return 0;
+  }
+
+  if (seperatedMatches.empty())
+    filterSeparatedMatches(matches, seperatedMatches);
+  printf("After match seperation have %lu out of %lu points remaining\n",
+         seperatedMatches.size(), matches.size());
+  timing.endStage("ratioFilter");
+  timing.setCount("separatedMatches", seperatedMatches.size());
+  const size_t MIN_LEGAL_MATCHES = 3;
+  if (seperatedMatches.size() < MIN_LEGAL_MATCHES)
+    return 0;
+
+  //// TODO: If this ever works, try to use it!
+  //printf("Attempting to compute aligning image rotation...\n");
+  //double calcRotation=0;
+  //if (!estimateImageRotation(keypointsA, keypointsB, seperatedMatches, calcRotation))
+  //  printf("Failed to compute a rotation alignment between the images!\n"); 
+  
+  //-- Quick calculation of max and min distances between keypoints
+  double max_dist = 0; double min_dist = 9999999;
+  for (size_t i=0; i<seperatedMatches.size(); i++)
+  { 
+    if ((seperatedMatches[i].queryIdx < 0) || (seperatedMatches[i].trainIdx < 0))
+      continue;
+    double dist = seperatedMatches[i].distance;
+    //std::cout << matches[i].queryIdx <<", "<< matches[i].trainIdx << ", " << dist <<  std::endl;
+    if (dist < min_dist) 
+      min_dist = dist;
+    if (dist > max_dist) 
+      max_dist = dist;
+  }
+  //printf("-- Max dist : %f \n", max_dist );
+  //printf("-- Min dist : %f \n", min_dist );
+  
+  if (debug)
+  {
+    cv::Mat matches_image1;
+    cv::drawMatches(refImageIn, keypointsA, matchImageIn, keypointsB,
+                    seperatedMatches, matches_image1, cv::Scalar::all(-1), cv::Scalar::all(-1),
+                    std::vector<char>(),cv::DrawMatchesFlags::NOT_DRAW_SINGLE_POINTS);
+    cv::imwrite(debugFolder+"seperated_matches.tif", matches_image1);
+  }
+  
+  
+  //-- Pick out "good" matches
+  float goodDist = max_dist;//(min_dist + max_dist) / 2.0;
+  //if (argc > 3)
+  //  goodDist = atof(argv[3]);
+  const size_t DUPLICATE_CUTOFF = 3;
+  std::vector< cv::DMatch > good_matches;
+  for (int i=0; i<seperatedMatches.size(); i++)
+  { 
+    // First verify that the match is valid
+    if ( (seperatedMatches[i].queryIdx < 0) ||
+         (seperatedMatches[i].trainIdx < 0) ||  
+         (seperatedMatches[i].queryIdx >= keypointsA.size()) || 
+         (seperatedMatches[i].trainIdx >= keypointsB.size()) )
+      continue;
+    
+    // Throw out matches that match to the same point as other matches
+    size_t duplicateCount = 0;
+    for (int j=0; j<seperatedMatches.size(); j++)
+    {
+      if (i == j) continue;
+      if ( (seperatedMatches[i].queryIdx == seperatedMatches[j].queryIdx) ||
+           (seperatedMatches[i].trainIdx == seperatedMatches[j].trainIdx)  )
+      ++duplicateCount;
+    }
+    //printf("Count = %d\n", duplicateCount);
+    if (duplicateCount >= DUPLICATE_CUTOFF)
+      continue;
+    
+    // Now check the distance
+    if (seperatedMatches[i].distance <= goodDist)
+      good_matches.push_back( seperatedMatches[i]);
+    
+    //good_matches.push_back( seperatedMatches[i]);
+  }
+  printf("After additional filtering have %lu out of %lu points remaining\n",
+         good_matches.size(), seperatedMatches.size());
+  timing.endStage("duplicateFilter");
+  timing.setCount("goodMatches", good_matches.size());
+  if (good_matches.size() < MIN_LEGAL_MATCHES)
+    return 0;
+
+  if (debug)
+  {
+    cv::Mat matches_image2;
+    cv::drawMatches(refImageIn, keypointsA, matchImageIn, keypointsB,
+                    good_matches, matches_image2, cv::Scalar::all(-1), cv::Scalar::all(-1),
+                    std::vector<char>(),cv::DrawMatchesFlags::NOT_DRAW_SINGLE_POINTS);
+    cv::imwrite(debugFolder+"good_matches.tif", matches_image2);
+  }
+  
+  // Get the coordinates from the remaining good matches  
+  std::vector<cv::Point2f> refPts;
+  std::vector<cv::Point2f> matchPts;
+  for(size_t i = 0; i < good_matches.size(); i++ )
+  {
+    refPts.push_back  (keypointsA[good_matches[i].queryIdx].pt);
+    matchPts.push_back(keypointsB[good_matches[i].trainIdx].pt);
+  }
+  printf("Computing homography...\n");
+  
+  // Compute a transform between the images using RANSAC
+  // - Start with a small error acceptance threshold, but increase it if we don't find a solution.
+  const int MIN_INLIER_DIST_PIXELS = 5;
+  const int MAX_INLIER_DIST_PIXELS = 20;
+  const int INC_INLIER_DIST_PIXELS = 3;
+  cv::Mat inlierMask;
+  size_t numInliers = 0;
+  for (int d=MIN_INLIER_DIST_PIXELS; d<MAX_INLIER_DIST_PIXELS; d+=INC_INLIER_DIST_PIXELS)
+  {
+    numInliers = 0;
+    printf("Searching for homography with inlier distance = %d\n", d);
+    transform = cv::findHomography( matchPts, refPts, cv::RHO, d, inlierMask );
+    if (inlierMask.rows == 0)
+      continue; // Special case for no inliers!
+    for (size_t i=0; i<refPts.size(); ++i)
+    {  // Count the number of inliers
+      if (inlierMask.at<unsigned char>(i, 0) > 0)
+        ++numInliers;
+    }
+    // Stop increasing the match distance when we get the minimum legal number of inliers
+    if (numInliers > MIN_LEGAL_MATCHES)
+      break;
+  }
+  printf("Finished computing homography.\n");
+  timing.endStage("ransac");
+  
+  // TODO: Use some sort of affine based check to throw out bad points?
+  //       Often, but not always, an affine based transform works ok.
+  //       This would help alleviate cases where one bad match messes up
+  //       an otherwise good transform.
+  
+  if (inlierMask.rows == 0)
+  {
+    printf("Failed to find any inliers!\n");
+    return 0;
+  }
+  
+  // Convert from OpenCV inlier mask to vector of inlier indices
+  std::vector<size_t    > inlierIndices;
+  std::vector<cv::DMatch> inlierMatches;
+  inlierMatches.reserve(numInliers);
+  inlierIndices.reserve(numInliers);
+  for (size_t i=0; i<refPts.size(); ++i)
+  {
+    if (inlierMask.at<unsigned char>(i, 0) > 0)
+    {
+      inlierIndices.push_back(i);
+      inlierMatches.push_back(good_matches[i]);
+    }
+  }
+  printf("Obtained %lu inliers.\n", inlierIndices.size());
+
+  for(size_t i = 0; i < inlierIndices.size(); i++ )
+  {
+    // Get the keypoints from the used matches
+    refInlierCoords.push_back  (refPts  [inlierIndices[i]]);
+    matchInlierCoords.push_back(matchPts[inlierIndices[i]]);
+  }
+
+  // A function to help filter results but it is not currently used
+  //affineInlierPrune(matchInlierCoords, refInlierCoords);
+  timing.endStage("inlierPrune");
+  timing.setCount("inliers", numInliers);
+  
+  if (debug)
+  {
+    cv::Mat matches_image3;
+    cv::drawMatches(refImageIn, keypointsA, matchImageIn, keypointsB,
+                    inlierMatches, matches_image3, cv::Scalar::all(-1), cv::Scalar::all(-1),
+                    std::vector<char>(),cv::DrawMatchesFlags::NOT_DRAW_SINGLE_POINTS);
+                       
+    cv::imwrite(debugFolder+"match_debug_image.tif", matches_image3);
+  }
+
+
+
+  // Return the number of inliers found
+  return static_cast<int>(numInliers);
+}
+
+/// Compute the transform on downsampled images, then refine it at full resolution
+///  using only the features near the coarse inliers, matched within a window
+///  around the locations predicted by the coarse transform.
+/// - Falls back to computeImageTransform at full resolution if either step fails.
+/// - The coarse and refine passes are timed as separate stages.
+int computeImageTransformPyramid(const cv::Mat &refImageIn, const cv::Mat &matchImageIn,
+                                 cv::Mat &transform,
+                                 std::vector<cv::Point2f> &refInlierCoords, 
+                                 std::vector<cv::Point2f> &matchInlierCoords,
+                                 const std::string debugFolder,
+                                 const int          kernelSize,
+                                 const DetectorType detectorType,
+                                 bool debug,
+                                 AlignmentContext* context=NULL)
+{
+  const double PYRAMID_SCALE        = 0.25; // Size of the coarse images
+  const int    MIN_COARSE_INLIERS   = 10;   // Need this many inliers to trust the coarse transform
+  const double REFINE_WINDOW_PIXELS = 40;   // Full resolution search distance around the prediction
+  const int    MIN_COARSE_SIZE      = 400;  // Don't shrink images smaller than this
+  const int    REFINE_REGION_SIZE   = 128;  // Features are detected in grid cells of this size...
+  const double REFINE_RADIUS_PIXELS = 96;   // ...which are this close to a coarse inlier.
+
+  AlignmentTiming localTiming;
+  AlignmentTiming &timing = (context && context->timing) ? *context->timing : localTiming;
+
+  const int minSize = std::min(std::min(refImageIn.rows,   refImageIn.cols),
+                               std::min(matchImageIn.rows, matchImageIn.cols));
+  if (minSize*PYRAMID_SCALE >= MIN_COARSE_SIZE)
+  {
+    printf("Computing coarse transform at scale %lf\n", PYRAMID_SCALE);
+    timing.setPrefix("coarse_");
+    cv::Mat refSmall, matchSmall, coarseTransform;
+    cv::resize(refImageIn,   refSmall,   cv::Size(), PYRAMID_SCALE, PYRAMID_SCALE, cv::INTER_AREA);
+    cv::resize(matchImageIn, matchSmall, cv::Size(), PYRAMID_SCALE, PYRAMID_SCALE, cv::INTER_AREA);
+    timing.endStage("resize");
+    std::vector<cv::Point2f> refCoarseCoords, matchCoarseCoords;
+    int numCoarseInliers = computeImageTransform(refSmall, matchSmall, coarseTransform,
+                                                 refCoarseCoords, matchCoarseCoords, debugFolder,
+                                                 kernelSize, detectorType, false, context);
+    if (numCoarseInliers >= MIN_COARSE_INLIERS)
+    {
+      // Convert the coarse transform to full resolution coordinates
+      cv::Mat scaleUp = cv::Mat::eye(3, 3, CV_64F);
+      scaleUp.at<double>(0,0) = 1.0/PYRAMID_SCALE;
+      scaleUp.at<double>(1,1) = 1.0/PYRAMID_SCALE;
+      cv::Mat priorTransform = scaleUp * coarseTransform * scaleUp.inv();
+
+      // The coarse inliers show where the images overlap and have features,
+      //  so the full resolution features are only detected around them.
+      timing.setPrefix("refine_");
+      std::vector<cv::Rect> refRegions, matchRegions;
+      getPointRegions(refCoarseCoords,   1.0/PYRAMID_SCALE, refImageIn.size(),
+                      REFINE_REGION_SIZE, REFINE_RADIUS_PIXELS, refRegions);
+      getPointRegions(matchCoarseCoords, 1.0/PYRAMID_SCALE, matchImageIn.size(),
+                      REFINE_REGION_SIZE, REFINE_RADIUS_PIXELS, matchRegions);
+      timing.setCount("refRegions",   refRegions.size());
+      timing.setCount("matchRegions", matchRegions.size());
+      printf("Refining transform at full resolution in %lu and %lu regions\n",
+             refRegions.size(), matchRegions.size());
+      int numInliers = computeImageTransform(refImageIn, matchImageIn, transform,
+                                             refInlierCoords, matchInlierCoords, debugFolder,
+                                             kernelSize, detectorType, debug, context,
+                                             priorTransform, REFINE_WINDOW_PIXELS,
+                                             refRegions, matchRegions);
+      timing.setPrefix("");
+      if (numInliers > 0)
+        return numInliers;
+      refInlierCoords.clear();
+      matchInlierCoords.clear();
+    }
+    timing.setPrefix("");
+    if (pastStopTime(context))
+      return 0;
+    printf("Coarse to fine alignment failed, trying full resolution matching.\n");
+  }
+  return computeImageTransform(refImageIn, matchImageIn, transform,
+                               refInlierCoords, matchInlierCoords, debugFolder,
+                               kernelSize, detectorType, debug, context);
+}
+
+
+/// Calls computImageTransform with multiple parameters until one succeeds
+int computeImageTransformRobust(const cv::Mat &refImageIn, const cv::Mat &matchImageIn,
+                                cv::Mat &transform,
+                                std::vector<cv::Point2f> &refInlierCoords, 
+                                std::vector<cv::Point2f> &matchInlierCoords,
+                                const ModeType mode,
+                                const std::string &debugFolder,
+                                bool debug,
+                                AlignmentContext* context=NULL)
+{
+  // Try not to accept solutions with fewer outliers
+  const int DESIRED_NUM_INLIERS  = 20;
+  const int REQUIRED_NUM_INLIERS = 10;
+  cv::Mat bestTransform;
+  int bestNumInliers = 0;
+  int numInliers;
+  
+  if (mode == MODE_FAST)
+  {
+    int kernelSize   = 5;
+    int detectorType = DETECTOR_TYPE_ORB;
+    printf("Attempting transform with kernel size = %d and detector type = %d\n",
+           kernelSize, detectorType);
+    numInliers = computeImageTransform(refImageIn, matchImageIn, transform, 
+                                       refInlierCoords, matchInlierCoords,
+                                       debugFolder,
+                                       kernelSize, static_cast<DetectorType>(detectorType), debug,
+                                       context);
+    return numInliers;
+  }
+  if (mode == MODE_ACCURATE)
+  {
+    int kernelSize   = 5;
+    int detectorType = DETECTOR_TYPE_SIFT;
+    printf("Attempting transform with kernel size = %d and detector type = %d\n",
+           kernelSize, detectorType);
+    numInliers = computeImageTransform(refImageIn, matchImageIn, transform, 
+                                       refInlierCoords, matchInlierCoords,
+                                       debugFolder,
+                                       kernelSize, static_cast<DetectorType>(detectorType), debug,
+                                       context);
+    return numInliers;
+  } 
+  if (mode == MODE_CASCADE)
+  {
+    // Try progressively more expensive detectors until we get enough inliers
+    //  or run out of time, keeping the best result.
+    CascadeSettings defaultCascade;
+    const CascadeSettings &cascade = context ? context->cascade : defaultCascade;
+    // - The first detector always runs to completion, the later ones also
+    //   stop partway through if they run past the time budget.
+    int kernelSize = 5;
+    const double startTicks = static_cast<double>(cv::getTickCount());
+    const int64  stopTicks  = static_cast<int64>(startTicks + cascade.timeBudgetSeconds*cv::getTickFrequency());
+    std::vector<cv::Point2f> bestRefInliers, bestMatchInliers;
+    for (size_t i=0; i<cascade.detectors.size(); ++i)
+    {
+      double elapsed = (cv::getTickCount() - startTicks) / cv::getTickFrequency();
+      if ((i > 0) && (elapsed >= cascade.timeBudgetSeconds))
+      {
+        printf("Stopping detector cascade after %lf seconds.\n", elapsed);
+        break;
+      }
+      if (context)
+        context->stopTicks = (i > 0) ? stopTicks : 0;
+      int detectorType = cascade.detectors[i];
+      printf("Attempting transform with kernel size = %d and detector type = %d\n",
+             kernelSize, detectorType);
+      std::vector<cv::Point2f> refCoords, matchCoords;
+      cv::Mat thisTransform(3, 3, CV_32FC1);
+      if (cascade.usePyramid)
+        numInliers = computeImageTransformPyramid(refImageIn, matchImageIn, thisTransform,
+                                                  refCoords, matchCoords, debugFolder,
+                                                  kernelSize, static_cast<DetectorType>(detectorType),
+                                                  debug, context);
+      else
+        numInliers = computeImageTransform(refImageIn, matchImageIn, thisTransform,
+                                           refCoords, matchCoords, debugFolder,
+                                           kernelSize, static_cast<DetectorType>(detectorType),
+                                           debug, context);
+      if (numInliers > bestNumInliers)
+      {
+        bestTransform  = thisTransform;
+        bestNumInliers = numInliers;
+        bestRefInliers.swap(refCoords);
+        bestMatchInliers.swap(matchCoords);
+      }
+      // Stop at the first result evaluateRegistrationAccuracy rates as high
+      //  confidence, otherwise escalate to the next detector.
+      if (bestNumInliers >= HIGH_CONFIDENCE_MIN_INLIERS)
+        break;
+    }
+    if (context)
+      context->stopTicks = 0;
+    if (bestNumInliers == 0)
+      return 0;
+    transform = bestTransform;
+    refInlierCoords.insert  (refInlierCoords.end(),   bestRefInliers.begin(),   bestRefInliers.end());
+    matchInlierCoords.insert(matchInlierCoords.end(), bestMatchInliers.begin(), bestMatchInliers.end());
+    return bestNumInliers;
+  }
+  if (mode == MODE_PYRAMID)
+  {
+    int kernelSize   = 5;
+    int detectorType = DETECTOR_TYPE_ORB;
+    printf("Attempting pyramid transform with kernel size = %d and detector type = %d\n",
+           kernelSize, detectorType);
+    numInliers = computeImageTransformPyramid(refImageIn, matchImageIn, transform, 
+                                              refInlierCoords, matchInlierCoords,
+                                              debugFolder,
+                                              kernelSize, static_cast<DetectorType>(detectorType), debug,
+                                              context);
+    return numInliers;
+  }
+  printf("ERROR: Did not recognize the execution mode!");
+  return 0; 
+  
+  // To improve run speed, this function is currently set up to try only a single
+  //  parameter configuration.
+  // - If this changes, we need to make sure that the best set of inliers make it to the output variables.
+/*  
+  // Keep trying transform parameter combinations until we get a good
+  //   match as determined by the inlier count
+  for (int kernelSize=5; kernelSize<6; kernelSize += 20)
+  {
+    for (int detectorType=2; detectorType<4; detectorType+=10)
+    {
+      printf("Attempting transform with kernel size = %d and detector type = %d\n",
+             kernelSize, detectorType);
+      numInliers = computeImageTransform(refImageIn, matchImageIn, transform, 
+                                         refInlierCoords, matchInlierCoords,
+                                         debugFolder,
+                                         kernelSize, static_cast<DetectorType>(detectorType), debug);
+      
+      
+      return numInliers; // DEBUG!!!!!!!!!
+      
+      if (numInliers >= DESIRED_NUM_INLIERS)
+        return numInliers; // This transform is good enough, return it.
+
+      if (numInliers > bestNumInliers)
+      {
+        // This is the best transform yet.
+        bestTransform  = transform;
+        bestNumInliers = numInliers;
+      }
+    } // End detector type loop
+  } // End kernel size loop
+
+  if (bestNumInliers < REQUIRED_NUM_INLIERS)
+    return 0; // Did not get an acceptable transform!
+
+  // Use the best transform we got
+  transform = bestTransform;
+  return bestNumInliers;
+*/
+}
+
+/// Try to estimate the accuracy of the computed registration
+std::string evaluateRegistrationAccuracy(int numInliers, const cv::Mat &transform)
+{
+  // Make some simple decisions based on the inlier count
+  if (numInliers < LOW_CONFIDENCE_MIN_INLIERS)
+    return "CONFIDENCE_NONE";
+  if (numInliers >= HIGH_CONFIDENCE_MIN_INLIERS)
+    return "CONFIDENCE_HIGH";
+
+  return "CONFIDENCE_LOW";
+}
+
+
+/// The result of aligning the match image to one image in a list of reference images
+struct BatchAlignmentResult
+{
+  int         refIndex;   // Index into the reference image list
+  int         numInliers;
+  std::string confidence; // Output of evaluateRegistrationAccuracy
+  cv::Mat     transform;  // From MATCH to this REF
+  std::vector<cv::Point2f> refInlierCoords;
+  std::vector<cv::Point2f> matchInlierCoords;
+
+  /// Sorts the results with the most inliers first
+  bool operator<(const BatchAlignmentResult &other) const {return numInliers > other.numInliers;}
+};
+
+/// Align one match image to each reference image in a list until a high
+///  confidence result is found.
+/// - The match image features are only computed once for all of the reference images.
+/// - Reference images which were not tried because of an early exit have no result.
+/// - The output is sorted by decreasing inlier count.
+void computeImageTransformBatch(const std::vector<cv::Mat> &refImages, const cv::Mat &matchImageIn,
+                                const ModeType mode,
+                                const std::string &debugFolder,
+                                bool debug,
+                                AlignmentContext* context,
+                                std::vector<BatchAlignmentResult> &results)
+{
+  AlignmentContext batchContext;
+  if (context)
+    batchContext = *context;
+  MatchFeatureMemo matchMemo;
+  batchContext.matchFeatures = &matchMemo;
+
+  results.clear();
+  for (size_t i=0; i<refImages.size(); ++i)
+  {
+    printf("Aligning to reference image %lu of %lu\n", i+1, refImages.size());
+    BatchAlignmentResult result;
+    result.refIndex   = static_cast<int>(i);
+    result.numInliers = 0;
+    result.transform  = cv::Mat(3, 3, CV_32FC1);
+    if (refImages[i].data)
+    {
+      try
+      {
+        result.numInliers = computeImageTransformRobust(refImages[i], matchImageIn, result.transform,
+                                                        result.refInlierCoords, result.matchInlierCoords,
+                                                        mode, debugFolder, debug, &batchContext);
+      }
+      catch (const cv::Exception &e)
+      {
+        printf("Caught OpenCV exception during alignment: %s\n", e.what());
+        result.numInliers = 0;
+      }
+    }
+    else
+      printf("Skipping empty reference image %lu\n", i);
+    if (!result.numInliers)
+    {
+      result.refInlierCoords.clear();
+      result.matchInlierCoords.clear();
+    }
+    result.confidence = evaluateRegistrationAccuracy(result.numInliers, result.transform);
+    printf("Computed %s transform with %d inliers.\n", result.confidence.c_str(), result.numInliers);
+    results.push_back(result);
+    if (result.confidence == "CONFIDENCE_HIGH")
+      break;
+  }
+  std::stable_sort(results.begin(), results.end());
+}
+
+
+#endif // GEOREF_IMAGE_ALIGNMENT_H
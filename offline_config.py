@@ -77,12 +77,124 @@ MAX_CLOUD_PERCENTAGE_INT = int(MAX_CLOUD_PERCENTAGE*100)
 # Processing settings
 
 
+# ==================================================
+# Image alignment settings
+
+# How the C++ image alignment code is called:
+# - 'library'    = Load build/libgeorefAlignment.so in process (fastest).
+# - 'daemon'     = Keep one build/registerGeocamImage --server process per worker.
+# - 'subprocess' = Run build/registerGeocamImage once per alignment attempt.
+ALIGNMENT_BACKEND = 'library'
+
+# The pyramid, cascade, and guided matching options below change which feature
+#  matches are found, so they are disabled until each one has been compared with
+#  the default alignment on a sample of our frames.  The timing recorded for every
+#  alignment (see alignment_engine.parseTiming) lists the time spent in each stage
+#  along with the keypoint and inlier counts for that comparison.
+
+# If True, the fast alignment method first aligns downsampled copies of the images
+#  and then only detects and matches full resolution features near that estimate.
+USE_PYRAMID_ALIGNMENT = False
+
+# If True, every alignment tries the detectors below in order, stopping at the first
+#  high confidence result.  This replaces both the fast and the slow (SIFT) methods.
+USE_ALIGNMENT_CASCADE = False
+ALIGNMENT_CASCADE_DETECTORS = ['orb', 'sift', 'akaze']
+
+# Don't start another detector in the cascade after this many seconds.
+ALIGNMENT_TIME_BUDGET = 90
+
+# Restrict candidate feature matches to a small window around where a transform
+#  estimated from the strongest keypoints places them.  Global matching is used
+#  if this finds too few matches.
+USE_GUIDED_MATCHING = False
+
+# Reject the estimated transform if it moves the image center further than this
+#  fraction of the reference image size from the reference image center.
+GUIDED_CENTER_TOLERANCE = 0.25
+
+# Descriptor matching method:
+# - 'bf'    = Exact brute force matching.
+# - 'flann' = Approximate matching, KD-trees for SIFT and LSH for the binary descriptors.
+#             Faster on large images, but not yet validated against brute force.
+ALIGNMENT_MATCHER = 'bf'
+
+# Images larger than this many pixels on a side have their features detected
+#  in tiles which are processed in parallel.  Set to 0 to disable tiling.
+ALIGNMENT_TILE_SIZE = 1024
+
+# Number of threads used by the C++ alignment code, 0 uses all available cores.
+ALIGNMENT_NUM_THREADS = 0
+
+# Keypoints and descriptors computed for reference images are cached here
+#  so that aligning more frames to the same reference image is faster.
+# - Set to '' to disable the cache.
+FEATURE_CACHE_FOLDER = '/media/network/GeoRef/featureCache/'
+
+# When the cache grows larger than this the least recently used files are deleted.
+FEATURE_CACHE_MAX_MB = 4096
+
+# Number of points along each side of the pixel grid used to fit the
+#  image to projected and GDC coordinate transforms.
+GEO_TRANSFORM_GRID_SIZE = 10
+
+# Number of threads used to warp the output images, 0 uses all available cores.
+WARP_NUM_THREADS = 0
+
+# Memory GDAL may use for each chunk of the output image when warping.
+WARP_MEMORY_LIMIT_MB = 256
+
+# Where reference images come from:
+# - 'earthengine' = Build a Landsat composite with Earth Engine and download it.
+# - 'local'       = Cut the image out of the local mosaic below, no network needed.
+REFERENCE_SOURCE = 'earthengine'
+
+# Local reference mosaic, any GDAL readable RGB Byte image such as a
+#  cloud optimized GeoTIFF or a VRT over GeoTIFF tiles.  Overviews are used
+#  when the requested resolution is coarser than the mosaic.
+LOCAL_REFERENCE_MOSAIC = '/media/network/GeoRef/referenceMosaic/mosaic.vrt'
+
+# Reference images fetched from Earth Engine are kept here so that later frames
+#  covering the same area at the same resolution and season are cropped locally.
+# - Set to '' to disable the cache.
+REFERENCE_CACHE_FOLDER = '/media/network/GeoRef/referenceCache/'
+
+# When the cache grows larger than this the least recently used chips are deleted.
+REFERENCE_CACHE_MAX_MB = 8192
+
+# Each cached chip is fetched this many times larger than one request needs
+#  so that it also covers the requests of nearby frames.
+REFERENCE_CACHE_MARGIN = 1.25
+
+# Fetched chips are kept within this many pixels on a side, both for the margin
+#  above and when one chip is fetched for a group of nearby frames.
+# - Earth Engine refuses downloads which are too large.
+REFERENCE_MAX_FETCH_SIZE = 3000
+
+# Number of threads the registration processor uses to fetch reference images
+#  ahead of the alignment jobs.  Set to 0 to fetch inside each alignment job.
+REFERENCE_FETCH_THREADS = 4
+
+# Failed reference image fetches are retried with a randomized exponential backoff
+#  up to this many attempts in total.
+REFERENCE_FETCH_MAX_ATTEMPTS = 6
+
+# The fetch threads give up on a reference image after this many seconds, including
+#  the Earth Engine requests in progress.  The alignment job then tries to fetch it itself.
+REFERENCE_FETCH_DEADLINE = 600
+
+
 # ==================================================
 # "Local" alignment settings
 
 # Only try to match a certain number of times
 LOCAL_ALIGNMENT_MAX_ATTEMPTS = 4
 
+# Nearby frame images are downloaded and aligned this many at a time, so the new
+#  image features are shared within a group but an early high confidence result
+#  does not pay for downloading the remaining frames.
+LOCAL_ALIGNMENT_BATCH_SIZE = 2
+
 # Limit to the frame count that we can match to in each direction
 LOCAL_ALIGNMENT_MAX_FRAME_RANGE = 20
 
@@ -40,9 +40,17 @@ cv::Point2f transformPoint(const cv::Point2f &pointIn, const cv::Mat &transform)
 }
 
 
-void writeOverlayImage(const cv::Mat &refImage, const cv::Mat &warpImage,
+void writeOverlayImage(const cv::Mat &refImageIn, const cv::Mat &warpImageIn,
                        const cv::Mat &transform, const std::string &outputPath)
 {
+  // The overlay is drawn in color, expand any grayscale inputs.
+  cv::Mat refImage  = refImageIn;
+  cv::Mat warpImage = warpImageIn;
+  if (refImage.channels() == 1)
+    cv::cvtColor(refImageIn, refImage, CV_GRAY2BGR);
+  if (warpImage.channels() == 1)
+    cv::cvtColor(warpImageIn, warpImage, CV_GRAY2BGR);
+
 // DEBUG - Paste the match image on top of the reference image
   cv::Mat warpedImage, mergedImage;
   cv::Size warpSize(refImage.rows, refImage.cols);
@@ -0,0 +1,421 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+import os
+import math
+import time
+import Queue
+import shutil
+import sqlite3
+import tempfile
+import threading
+import uuid
+
+import offline_config
+from ImageFetcher import miscUtilities
+
+'''
+   Fetches reference images from the source selected in offline_config and
+   keeps a persistent on-disk cache of the images fetched from Earth Engine.
+
+   Consecutive frames from a roll cover overlapping ground at the same resolution
+   and season, so each chip is fetched somewhat larger than a single request
+   needs and later requests which fall entirely inside a cached chip are served
+   by cropping it locally.  The chip bounds are kept in a SQLite R*Tree index
+   along with the metadata returned by the fetch.
+'''
+
+# Chips are matched to a request if their resolution is within this fraction.
+MPP_TOLERANCE = 0.05
+
+def getSeasonKey(date):
+    '''Returns the season window key for a date in the YYYY.MM.dd format used by
+       the reference fetcher.  Requests in the same month share their chips.'''
+    return date[0:7]
+
+def getImageBounds(imagePath):
+    '''Returns the (minLon, minLat, maxLon, maxLat) bounding box of a north-up geotiff.'''
+    from osgeo import gdal
+    dataset = gdal.Open(imagePath)
+    if dataset is None:
+        raise Exception('GDAL could not open image file ' + imagePath)
+    (originX, pixelWidth, rotX, originY, rotY, pixelHeight) = dataset.GetGeoTransform()
+    endX = originX + pixelWidth *dataset.RasterXSize
+    endY = originY + pixelHeight*dataset.RasterYSize
+    return (min(originX, endX), min(originY, endY), max(originX, endX), max(originY, endY))
+
+def cropChip(chipPath, bounds, outputPath):
+    '''Write the part of a cached chip inside bounds to a new geotiff.
+       Returns the fraction of valid pixels in the cropped image.'''
+    from osgeo import gdal
+    (minLon, minLat, maxLon, maxLat) = bounds
+    dataset = gdal.Translate(outputPath, chipPath, projWin=[minLon, maxLat, maxLon, minLat])
+    if dataset is None:
+        raise Exception('Failed to crop cached reference image ' + chipPath)
+    percentValid = miscUtilities.getPercentValid(dataset)
+    dataset = None # Close the file
+    return percentValid
+
+
+class ReferenceChipCache(object):
+    '''Keeps track of the reference chips stored in a folder.
+       The least recently used chips are deleted when the total size passes maxBytes.'''
+
+    def __init__(self, folder, maxBytes):
+        self._folder   = folder
+        self._maxBytes = maxBytes
+        self._dbPath   = os.path.join(folder, 'chips.sqlt')
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        connection = self._connect()
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS chips (id INTEGER PRIMARY KEY, '
+                               'path TEXT, metersPerPixel REAL, season TEXT, sensor TEXT, '
+                               'percentValid REAL, numBytes INTEGER, lastAccess REAL)')
+            connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS chipBounds '
+                               'USING rtree(id, minLon, maxLon, minLat, maxLat)')
+        connection.close()
+
+    def _connect(self):
+        '''Multiple processes may share the cache, so wait for each other's writes.'''
+        return sqlite3.connect(self._dbPath, timeout=60)
+
+    def getNewChipPath(self):
+        '''Returns an unused path for a new chip file.  The name is unique across the
+           fetch threads and processes sharing the cache.  The file is not created.'''
+        return os.path.join(self._folder, 'chip_%s.tif' % uuid.uuid4().hex)
+
+    def findChip(self, bounds, metersPerPixel, season, sensor=None):
+        '''Returns (chipPath, metersPerPixel, sensor, percentValid) for a cached chip
+           which fully contains bounds, or None if there is not one.
+           If sensor is provided only chips from that sensor are considered.'''
+        (minLon, minLat, maxLon, maxLat) = bounds
+        sensorClause = ''
+        values = [minLon, maxLon, minLat, maxLat,
+                  metersPerPixel*(1.0-MPP_TOLERANCE), metersPerPixel*(1.0+MPP_TOLERANCE), season]
+        if sensor is not None:
+            sensorClause = 'AND sensor = ? '
+            values.append(sensor)
+        values.append(metersPerPixel)
+        connection = self._connect()
+        with connection:
+            rows = connection.execute(
+                'SELECT chips.id, path, metersPerPixel, sensor, percentValid '
+                'FROM chips JOIN chipBounds ON chips.id = chipBounds.id '
+                'WHERE chipBounds.minLon <= ? AND chipBounds.maxLon >= ? AND '
+                '      chipBounds.minLat <= ? AND chipBounds.maxLat >= ? AND '
+                '      metersPerPixel BETWEEN ? AND ? AND season = ? ' + sensorClause +
+                'ORDER BY ABS(metersPerPixel - ?)', values).fetchall()
+            chip = None
+            for (chipId, path, chipMpp, sensor, percentValid) in rows:
+                if not os.path.exists(path): # Deleted by something else
+                    self._removeChip(connection, chipId)
+                    continue
+                connection.execute('UPDATE chips SET lastAccess = ? WHERE id = ?',
+                                   (time.time(), chipId))
+                chip = (path, chipMpp, sensor, percentValid)
+                break
+        connection.close()
+        return chip
+
+    def addChip(self, chipPath, metersPerPixel, season, sensor, percentValid):
+        '''Record a newly fetched chip file, then enforce the size limit.'''
+        (minLon, minLat, maxLon, maxLat) = getImageBounds(chipPath)
+        connection = self._connect()
+        with connection:
+            cursor = connection.execute(
+                'INSERT INTO chips (path, metersPerPixel, season, sensor, percentValid, '
+                'numBytes, lastAccess) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (chipPath, metersPerPixel, season, sensor, percentValid,
+                 os.path.getsize(chipPath), time.time()))
+            connection.execute('INSERT INTO chipBounds VALUES (?, ?, ?, ?, ?)',
+                               (cursor.lastrowid, minLon, maxLon, minLat, maxLat))
+            self._evict(connection)
+        connection.close()
+
+    def _removeChip(self, connection, chipId):
+        connection.execute('DELETE FROM chips      WHERE id = ?', (chipId,))
+        connection.execute('DELETE FROM chipBounds WHERE id = ?', (chipId,))
+
+    def _evict(self, connection):
+        '''Delete the least recently used chips until the cache fits in the size limit.'''
+        totalBytes = connection.execute('SELECT SUM(numBytes) FROM chips').fetchone()[0] or 0
+        if totalBytes <= self._maxBytes:
+            return
+        rows = connection.execute('SELECT id, path, numBytes FROM chips '
+                                  'ORDER BY lastAccess').fetchall()
+        for (chipId, path, numBytes) in rows:
+            if totalBytes <= self._maxBytes:
+                break
+            print 'Removing cached reference image ' + path
+            if os.path.exists(path):
+                os.remove(path)
+            self._removeChip(connection, chipId)
+            totalBytes -= numBytes
+
+
+_chipCache = None
+
+def getChipCache():
+    '''Returns the cache configured in offline_config, or None if it is disabled.'''
+    global _chipCache
+    if not offline_config.REFERENCE_CACHE_FOLDER:
+        return None
+    if not _chipCache:
+        _chipCache = ReferenceChipCache(offline_config.REFERENCE_CACHE_FOLDER,
+                                        offline_config.REFERENCE_CACHE_MAX_MB*1024*1024)
+    return _chipCache
+
+
+def getReferenceFetcher():
+    '''Returns the fetchReferenceImage function of the reference image source in offline_config.
+       Each source provides fetchReferenceImage(longitude, latitude, metersPerPixel, date,
+       outputPath, bufferScale=1.0, deadline=None) which writes a north-up EPSG:4326
+       RGB geotiff to outputPath and returns (percentValid, metersPerPixel, sensorName).
+       The sources make a single attempt, retrying is done by fetchWithRetries.'''
+    if offline_config.REFERENCE_SOURCE == 'local':
+        import ImageFetcher.localReferenceImage
+        return ImageFetcher.localReferenceImage.fetchReferenceImage
+    if offline_config.REFERENCE_SOURCE == 'earthengine':
+        import ImageFetcher.fetchReferenceImage
+        return ImageFetcher.fetchReferenceImage.fetchReferenceImage
+    raise Exception('Unrecognized reference image source: ' + str(offline_config.REFERENCE_SOURCE))
+
+
+def getChosenSensor(longitude, latitude, date):
+    '''Returns the sensor the configured source has already chosen for requests near a
+       location and date, or None if it has not made a choice there yet.
+       Cached chips from other sensors are not used for those requests.'''
+    if offline_config.REFERENCE_SOURCE == 'earthengine':
+        import ImageFetcher.fetchReferenceImage
+        return ImageFetcher.fetchReferenceImage.getChosenSensor(longitude, latitude, date)
+    return None
+
+
+def fetchWithRetries(longitude, latitude, metersPerPixel, date, outputPath, bufferScale=1.0,
+                     deadline=None):
+    '''Call the configured fetcher, trying again after a randomized exponential backoff
+       if it fails.  This is the only place fetches are retried.  No new attempt is
+       started after deadline, a time.time() value, which is also passed to the fetcher.
+       Returns (percentValid, metersPerPixel, sensorName)'''
+    BASE_DELAY = 2
+    MAX_DELAY  = 60
+    fetcher = getReferenceFetcher()
+    return miscUtilities.retryWithBackoff(
+        lambda: fetcher(longitude, latitude, metersPerPixel, date, outputPath, bufferScale, deadline),
+        offline_config.REFERENCE_FETCH_MAX_ATTEMPTS, BASE_DELAY, MAX_DELAY, deadline)
+
+
+def fetchReferenceImage(longitude, latitude, metersPerPixel, date, outputPath, deadline=None):
+    '''Fetch a reference image from the configured source and save it to disk.
+       Earth Engine images are first looked for in the chip cache and newly
+       fetched images are added to it.
+       Raises an exception if no fetch succeeds before deadline, a time.time() value.
+       Returns (percentValid, metersPerPixel)'''
+
+    # The local mosaic is already on disk so there is no point caching it.
+    cache = None
+    if offline_config.REFERENCE_SOURCE != 'local':
+        cache = getChipCache()
+    if not cache:
+        (percentValid, mppToUse, sensor) = fetchWithRetries(longitude, latitude, metersPerPixel,
+                                                            date, outputPath, deadline=deadline)
+        return (percentValid, mppToUse)
+
+    (mppToUse, bufferSizeMeters) = miscUtilities.getReferenceRequestSize(metersPerPixel)
+    bounds = miscUtilities.getLonLatBounds(longitude, latitude, bufferSizeMeters)
+    season = getSeasonKey(date)
+
+    chip = cache.findChip(bounds, mppToUse, season, getChosenSensor(longitude, latitude, date))
+    if chip:
+        # The valid fraction stored for the chip covers more than this request.
+        (chipPath, chipMpp, sensor, chipPercentValid) = chip
+        print 'Using cached reference image ' + chipPath
+        percentValid = cropChip(chipPath, bounds, outputPath)
+        return (percentValid, chipMpp)
+
+    # Fetch a larger chip than we need so that it covers nearby requests too.
+    bufferScale = min(offline_config.REFERENCE_CACHE_MARGIN,
+                      getMaxBufferScale(mppToUse, bufferSizeMeters))
+    chipPath = cache.getNewChipPath()
+    try:
+        (percentValid, mppToUse, sensor) = fetchWithRetries(longitude, latitude, metersPerPixel, date,
+                                                            chipPath, max(1.0, bufferScale), deadline)
+        requestPercentValid = cropChip(chipPath, bounds, outputPath)
+        cache.addChip(chipPath, mppToUse, season, sensor, percentValid)
+    except:
+        if os.path.exists(chipPath):
+            os.remove(chipPath)
+        raise
+    return (requestPercentValid, mppToUse)
+
+
+def getMaxBufferScale(metersPerPixel, bufferSizeMeters):
+    '''Returns the largest bufferScale which keeps a fetched chip within
+       REFERENCE_MAX_FETCH_SIZE pixels on a side.'''
+    return (offline_config.REFERENCE_MAX_FETCH_SIZE * metersPerPixel / 2.0) / bufferSizeMeters
+
+
+def getPrefetchClusters(requests):
+    '''Groups reference image requests which are close enough together to be cut from
+       a single fetched chip.  Each request is (longitude, latitude, metersPerPixel, date)
+       and they should be in ground track order, as consecutive frames are.
+       Requests already covered by the chip cache are skipped and only groups of
+       two or more requests are returned.'''
+
+    cache = None
+    if offline_config.REFERENCE_SOURCE != 'local':
+        cache = getChipCache()
+    if not cache:
+        return []
+
+    # Extend the current cluster while the union of its bounds still fits in one chip.
+    clusters = []
+    current  = []
+    for (longitude, latitude, metersPerPixel, date) in requests:
+        (mppToUse, bufferSizeMeters) = miscUtilities.getReferenceRequestSize(metersPerPixel)
+        bounds = miscUtilities.getLonLatBounds(longitude, latitude, bufferSizeMeters)
+        season = getSeasonKey(date)
+        if cache.findChip(bounds, mppToUse, season, getChosenSensor(longitude, latitude, date)):
+            continue
+        request = {'request': (longitude, latitude, metersPerPixel, date),
+                   'bounds' : bounds, 'mpp': mppToUse, 'season': season}
+        if current:
+            first = current[0]
+            union = (min(first['union'][0], bounds[0]), min(first['union'][1], bounds[1]),
+                     max(first['union'][2], bounds[2]), max(first['union'][3], bounds[3]))
+            if ((season == first['season']) and
+                (abs(mppToUse - first['mpp']) <= MPP_TOLERANCE*first['mpp']) and
+                (miscUtilities.getBoundsSizeMeters(union) / first['mpp']
+                 <= offline_config.REFERENCE_MAX_FETCH_SIZE)):
+                first['union'] = union
+                current.append(request)
+                continue
+            clusters.append(current)
+        request['union'] = bounds
+        current = [request]
+    if current:
+        clusters.append(current)
+
+    return [[r['request'] for r in cluster] for cluster in clusters if len(cluster) > 1]
+
+
+def prefetchReferenceCluster(cluster, deadline=None):
+    '''Fetch one chip covering all of the requests from getPrefetchClusters into the chip cache.
+       Only one attempt is made since each request falls back to its own fetch.
+       Returns True if the chip was fetched before deadline, a time.time() value.'''
+
+    cache = getChipCache()
+    (longitude, latitude, metersPerPixel, date) = cluster[0]
+    (mppToUse, bufferSizeMeters) = miscUtilities.getReferenceRequestSize(metersPerPixel)
+    boundsList = []
+    for request in cluster:
+        requestBuffer = miscUtilities.getReferenceRequestSize(request[2])[1]
+        boundsList.append(miscUtilities.getLonLatBounds(request[0], request[1], requestBuffer))
+    union = (min([b[0] for b in boundsList]), min([b[1] for b in boundsList]),
+             max([b[2] for b in boundsList]), max([b[3] for b in boundsList]))
+
+    # Center a square chip on the union of the requests, leaving a little
+    #  slack for the approximate bounds calculation.
+    BOUNDS_SLACK = 1.02
+    centerLon   = (union[0] + union[2]) / 2.0
+    centerLat   = (union[1] + union[3]) / 2.0
+    bufferScale = BOUNDS_SLACK * miscUtilities.getBoundsSizeMeters(union) / (2.0*bufferSizeMeters)
+
+    print ('Fetching one reference image for ' + str(len(cluster)) + ' frames around '
+           + str((centerLon, centerLat)))
+    fetcher  = getReferenceFetcher()
+    chipPath = cache.getNewChipPath()
+    try:
+        (percentValid, mppToUse, sensor) = fetcher(centerLon, centerLat, metersPerPixel, date,
+                                                   chipPath, max(1.0, bufferScale), deadline)
+        cache.addChip(chipPath, mppToUse, getSeasonKey(date), sensor, percentValid)
+    except Exception as e:
+        print 'Failed to prefetch reference image, caught exception: ' + str(e)
+        if os.path.exists(chipPath):
+            os.remove(chipPath)
+        return False
+    return True
+
+
+class ReferenceFetchService(object):
+    '''Fetches reference images on a pool of threads ahead of the alignment jobs,
+       so the alignment processes do not sit idle waiting on downloads.
+       Requests are (longitude, latitude, metersPerPixel, date) tuples.'''
+
+    def __init__(self, numThreads, deadlineSeconds):
+        self._deadlineSeconds = deadlineSeconds
+        self._workFolder      = tempfile.mkdtemp(prefix='georefReference')
+        self._queue           = Queue.Queue()
+        self._clusterEvents   = {}
+        self._count           = 0
+        self._lock            = threading.Lock()
+        for i in range(numThreads):
+            thread = threading.Thread(target=self._run)
+            thread.setDaemon(True) # Don't hold up the program on this thread
+            thread.start()
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            try:
+                task()
+            except Exception as e:
+                print 'Reference fetch thread caught exception: ' + str(e)
+
+    def prefetchClusters(self, requests):
+        '''Fetch one chip for each group of nearby requests, see getPrefetchClusters.
+           Later calls to submit() for those requests wait for their chip first.'''
+        for cluster in getPrefetchClusters(requests):
+            event    = threading.Event()
+            deadline = time.time() + self._deadlineSeconds
+            for request in cluster:
+                self._clusterEvents[request] = event
+            def fetchCluster(cluster=cluster, event=event, deadline=deadline):
+                try:
+                    prefetchReferenceCluster(cluster, deadline)
+                finally:
+                    event.set()
+            self._queue.put(fetchCluster)
+
+    def submit(self, request, callback):
+        '''Fetch the reference image for a request into a new file, then call
+           callback(reference) from a fetch thread.  reference is
+           (refImagePath, percentValid, refMetersPerPixel), or None if the fetch
+           did not succeed before the deadline.  The callback owns the file.'''
+        deadline     = time.time() + self._deadlineSeconds
+        clusterEvent = self._clusterEvents.pop(request, None)
+        with self._lock:
+            self._count += 1
+            outputPath = os.path.join(self._workFolder, 'ref_image_%d.tif' % self._count)
+
+        def fetch():
+            if clusterEvent:
+                clusterEvent.wait(max(0, deadline - time.time()))
+            (longitude, latitude, metersPerPixel, date) = request
+            reference = None
+            try:
+                (percentValid, refMetersPerPixel) = fetchReferenceImage(
+                    longitude, latitude, metersPerPixel, date, outputPath, deadline)
+                reference = (outputPath, percentValid, refMetersPerPixel)
+            except Exception as e:
+                print 'Failed to fetch reference image, caught exception: ' + str(e)
+            callback(reference)
+        self._queue.put(fetch)
+
+    def cleanup(self):
+        '''Delete any fetched images which were not cleaned up by their callbacks.'''
+        shutil.rmtree(self._workFolder, ignore_errors=True)
@@ -19,7 +19,7 @@ import sys
 
 import math
 import numpy
-import ImageFetcher.fetchReferenceImage
+import reference_cache
 import IrgStringFunctions, IrgGeoFunctions
 
 from registration_common import TemporaryDirectory
@@ -56,53 +56,52 @@ def convertTransformToGeo(imageToRefImageTransform, newImagePath, refImagePath,
     refPixelToGdcTransform = registration_common.getPixelToGdcTransform(
                                                   refImagePath, refImageGeoTransform)
 
-    # Generate a list of point pairs
-    imagePoints = []
-    projPoints  = []
-    gdcPoints   = []
-    
-    
     print 'transform = \n' + str(imageToRefTransform.matrix)
-    
-    # Loop through an evenly spaced grid of pixels in the new image
-    # - For each pixel, compute the desired output coordinate
-    pointPixelSpacing = (newImageSize[0] + newImageSize[1]) / 20 # Results in about 100 points
-    for r in range(0, newImageSize[0], pointPixelSpacing):
-        for c in range(0, newImageSize[1], pointPixelSpacing):
-            # Get pixel in new image and matching pixel in the reference image
-            thisPixel       = numpy.array([float(c), float(r)])
-            pixelInRefImage = imageToRefTransform.forward(thisPixel)
-
-            # If any pixel transforms outside the reference image our transform
-            # is probably invalid but continue on skipping this pixel.
-            if ((not registration_common.isPixelValid(thisPixel, newImageSize)) or
-                (not registration_common.isPixelValid(pixelInRefImage, refImageSize))):
-                continue
-
-            # Compute the location of this pixel in the projected coordinate system
-            #  used by the transform.py file.
-            if (not refImageGeoTransform):
-                # Use the geo information of the reference image
-                gdcCoordinate       = refPixelToGdcTransform.forward(pixelInRefImage)
-                projectedCoordinate = transform.lonLatToMeters(gdcCoordinate)
-            else: # Use the user-provided transform
-                projectedCoordinate = refImageGeoTransform.forward(pixelInRefImage)
-                gdcCoordinate       = transform.metersToLatLon(projectedCoordinate)
-                
-            imagePoints.append(thisPixel)
-            projPoints.append(projectedCoordinate)
-            gdcPoints.append(gdcCoordinate)
-            #print str(thisPixel) + ' --> ' + str(gdcCoordinate) + ' <--> ' + str(projectedCoordinate)
+
+    # When each step of a chain is linear or projective the chain is a single
+    #  projective transform which can be computed exactly.
+    # - Converting between GDC and projected coordinates is not linear, so
+    #   only one of the two output transforms is exact.
+    if (not refImageGeoTransform):
+        testImageToProjectedTransform = None
+        testImageToGdcTransform = registration_common.composeTransforms(refPixelToGdcTransform,
+                                                                         imageToRefTransform)
+    else:
+        testImageToProjectedTransform = registration_common.composeTransforms(refImageGeoTransform,
+                                                                               imageToRefTransform)
+        testImageToGdcTransform = None
+
+    # The other transform is fit to sampled points.
+    # Use an evenly spaced grid of pixels in the new image and the
+    #  matching pixels in the reference image.
+    imagePoints      = registration_common.getPixelGrid(newImageSize[0], newImageSize[1])
+    pixelsInRefImage = registration_common.forwardPoints(imageToRefTransform, imagePoints)
+
+    # If any pixel transforms outside the reference image our transform
+    # is probably invalid but continue on skipping those pixels.
+    valid = registration_common.arePixelsValid(pixelsInRefImage, refImageSize)
+    imagePoints      = imagePoints     [valid]
+    pixelsInRefImage = pixelsInRefImage[valid]
+
+    # Compute the location of each pixel in the projected coordinate system
+    #  used by the transform.py file.
+    if (not refImageGeoTransform):
+        # Use the geo information of the reference image
+        gdcPoints  = registration_common.forwardPoints(refPixelToGdcTransform, pixelsInRefImage)
+        projPoints = registration_common.lonLatToMetersArray(gdcPoints)
+    else: # Use the user-provided transform
+        projPoints = registration_common.forwardPoints(refImageGeoTransform, pixelsInRefImage)
+        gdcPoints  = registration_common.metersToLonLatArray(projPoints)
 
     # Compute a transform object that converts from the new image to projected coordinates
     #print 'Converting transform to world coordinates...'
     #testImageToProjectedTransform = transform.getTransform(numpy.asarray(worldPoints),
     #                                                       numpy.asarray(imagePoints))
-    testImageToProjectedTransform = transform.ProjectiveTransform.fit(numpy.asarray(projPoints),
-                                                                      numpy.asarray(imagePoints))
+    if testImageToProjectedTransform is None:
+        testImageToProjectedTransform = transform.ProjectiveTransform.fit(projPoints, imagePoints)
     
-    testImageToGdcTransform = transform.ProjectiveTransform.fit(numpy.asarray(gdcPoints),
-                                                                numpy.asarray(imagePoints))
+    if testImageToGdcTransform is None:
+        testImageToGdcTransform = transform.ProjectiveTransform.fit(gdcPoints, imagePoints)
     
     #print refPixelToGdcTransform
     #print testImageToProjectedTransform
@@ -146,7 +145,7 @@ def register_image(imagePath, centerLon, centerLat, metersPerPixel, imageDate,
             refImagePath    = os.path.join(workDir, 'ref_image.tif')
             refImageLogPath = os.path.join(workDir, 'ref_image_info.tif')
             if not os.path.exists(refImagePath):
-                (percentValid, refMetersPerPixel) = ImageFetcher.fetchReferenceImage.fetchReferenceImage(
+                (percentValid, refMetersPerPixel) = reference_cache.fetchReferenceImage(
                                                         centerLon, centerLat,
                                                         metersPerPixel, imageDate, refImagePath)
                 # Log the metadata
@@ -178,28 +177,108 @@ def register_image(imagePath, centerLon, centerLat, metersPerPixel, imageDate,
     
         # Try to align to the reference image
         # - The transform is from image to refImage
-        (imageToRefImageTransform, confidence, imageInliers, refInliers) = \
+        (imageToRefImageTransform, confidence, imageInliers, refInliers, alignTiming) = \
                 registration_common.alignScaledImages(imagePath, refImagePath, inputScaling, workPrefix, force, debug, slowMethod)
-    
-        # If we failed, just return dummy information with zero confidence.
-        if (confidence == registration_common.CONFIDENCE_NONE):
-            return (registration_common.getIdentityTransform(),
-                    registration_common.getIdentityTransform(),
-                    registration_common.CONFIDENCE_NONE, [], [], 0)
-    
-        # Convert the transform into a pixel-->Projected coordinate transform
-        (imageToProjectedTransform, imageToGdcTransform, refImageToGdcTransform) = \
-                convertTransformToGeo(imageToRefImageTransform, imagePath, refImagePath, referenceGeoTransform)
-    
-        # For each input image inlier, generate the world coordinate.
-        
-        gdcInliers = []
-        for pix in refInliers:
-            gdcCoordinate = refImageToGdcTransform.forward(pix)
-            gdcInliers.append(gdcCoordinate)
-    
-        return (imageToProjectedTransform, imageToGdcTransform,
-                confidence, imageInliers, gdcInliers, refMetersPerPixel)
+        print 'Alignment time = ' + str(alignTiming['total'])
+
+        return convertAlignmentToGeo(imagePath, refImagePath, referenceGeoTransform,
+                                     imageToRefImageTransform, confidence,
+                                     imageInliers, refInliers, refMetersPerPixel)
+
+
+def register_image_batch(imagePath, metersPerPixel, refImagePaths, referenceGeoTransforms,
+                         refMetersPerPixels, debug=False, force=False, slowMethod=False):
+    '''Attempts to geo-register the provided image against each of a list of
+       already registered reference images, such as nearby ISS frames.
+       The features of the input image are only computed once for each group of
+       reference images with about the same resolution, and no more reference
+       images are tried after a high confidence result.
+       Returns a list of (refIndex, imageToProjectedTransform, imageToGdcTransform,
+       confidence, imageInliers, gdcInliers, refMetersPerPixel) tuples in the
+       register_image format, sorted from the best alignment to the worst.'''
+
+    if not (os.path.exists(imagePath)):
+        raise Exception('Input image path does not exist!')
+    for refImagePath in refImagePaths:
+        if not os.path.exists(refImagePath):
+            raise Exception('Provided reference image path does not exist!')
+
+    with TemporaryDirectory() as myWorkDir:
+
+        # Set up paths in a temporary directory
+        if not debug:
+            workDir = myWorkDir
+        else: # In debug mode, create a more permanent work location.
+            workDir = os.path.splitext(imagePath)[0]
+        if not os.path.exists(workDir):
+            os.mkdir(workDir)
+        workPrefix = workDir + '/work'
+
+        # The input image is scaled once for each group of reference images with
+        #  about the same resolution, so each alignment sees the scale it expects.
+        # - If we could not estimate the MPP value of the new image, guess that it is
+        #   the same as the reference images.
+        SCALE_TOLERANCE = 0.10
+        scaleGroups = [] # Lists of reference indices, in the order they were provided
+        for (refIndex, refMetersPerPixel) in enumerate(refMetersPerPixels):
+            thisMpp = metersPerPixel if metersPerPixel else refMetersPerPixel
+            inputScaling = thisMpp / refMetersPerPixel
+            for (groupScaling, group) in scaleGroups:
+                if abs(inputScaling / groupScaling - 1.0) <= SCALE_TOLERANCE:
+                    group.append(refIndex)
+                    break
+            else:
+                scaleGroups.append((inputScaling, [refIndex]))
+
+        results = []
+        for (groupIndex, (inputScaling, group)) in enumerate(scaleGroups):
+            print 'inputScaling      = ' + str(inputScaling)
+            (alignResults, alignTiming) = \
+                    registration_common.alignScaledImageBatch(imagePath,
+                                                              [refImagePaths[i] for i in group],
+                                                              inputScaling,
+                                                              workPrefix + '-' + str(groupIndex),
+                                                              force, debug, slowMethod)
+            print 'Alignment time = ' + str(alignTiming['total'])
+
+            haveHighConfidence = False
+            for (batchIndex, imageToRefImageTransform, confidence, imageInliers, refInliers) in alignResults:
+                refIndex = group[batchIndex]
+                results.append((refIndex,) +
+                               convertAlignmentToGeo(imagePath, refImagePaths[refIndex],
+                                                     referenceGeoTransforms[refIndex],
+                                                     imageToRefImageTransform, confidence,
+                                                     imageInliers, refInliers,
+                                                     refMetersPerPixels[refIndex]))
+                if confidence == registration_common.CONFIDENCE_HIGH:
+                    haveHighConfidence = True
+            if haveHighConfidence:
+                break # Don't try the remaining groups
+        results.sort(key=lambda r: len(r[4]), reverse=True)
+        return results
+
+
+def convertAlignmentToGeo(imagePath, refImagePath, referenceGeoTransform,
+                          imageToRefImageTransform, confidence, imageInliers, refInliers,
+                          refMetersPerPixel):
+    '''Converts image alignment results into the register_image output format.'''
+
+    # If we failed, just return dummy information with zero confidence.
+    if (confidence == registration_common.CONFIDENCE_NONE):
+        return (registration_common.getIdentityTransform(),
+                registration_common.getIdentityTransform(),
+                registration_common.CONFIDENCE_NONE, [], [], 0)
+
+    # Convert the transform into a pixel-->Projected coordinate transform
+    (imageToProjectedTransform, imageToGdcTransform, refImageToGdcTransform) = \
+            convertTransformToGeo(imageToRefImageTransform, imagePath, refImagePath, referenceGeoTransform)
+
+    # For each input image inlier, generate the world coordinate.
+    gdcInliers = [tuple(p) for p in
+                  registration_common.forwardPoints(refImageToGdcTransform, refInliers)]
+
+    return (imageToProjectedTransform, imageToGdcTransform,
+            confidence, imageInliers, gdcInliers, refMetersPerPixel)
 
 
 def test():
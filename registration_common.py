@@ -28,6 +28,7 @@ import tempfile
 
 import IrgGeoFunctions
 import offline_config
+import alignment_engine
 
 basepath    = os.path.abspath(sys.path[0]) # Scott debug
 sys.path.insert(0, basepath + '/../geocamTiePoint')
@@ -130,13 +131,47 @@ def cropImageLabel(jpegPath, outputPath):
         print cmd
         os.system(cmd)
 
-def updateExif(exifSourcePath, geotiffFilePath):
-    '''Copy EXIF info from the source file to the geotiff file'''
+# EXIF tags from the exiftool argument files which getTiffTagMetadata writes
+#  through GDAL when the geotiff is created instead.
+GDAL_WRITTEN_EXIF_ARGS = ['-EXIF:Artist', '-EXIF:Copyright', '-EXIF:Software']
 
+def getTiffTagMetadata(exifSourcePath):
+    '''Returns the GDAL metadata items for the EXIF tags which GDAL can write as TIFF tags
+       when it creates an output geotiff, so updateExif does not need to copy them.'''
+    exifData = piexif.load(exifSourcePath)
+    metadata = {'TIFFTAG_SOFTWARE': 'GeoRef',
+                'TIFFTAG_DATETIME': datetime.datetime.now().strftime('%Y:%m:%d %H:%M:%S')}
+    for (tag, key) in [(piexif.ImageIFD.Artist,    'TIFFTAG_ARTIST'),
+                       (piexif.ImageIFD.Copyright, 'TIFFTAG_COPYRIGHT')]:
+        if tag in exifData['0th']:
+            metadata[key] = exifData['0th'][tag]
+    return metadata
+
+def getExiftoolTagArgs():
+    '''Returns the exiftool tag arguments from the argument files for the tags GDAL can't write.'''
     # These two files contain a bunch of arguments that are read by exiftool
-    creationArgsFile = settings.STATIC_ROOT + '/georef_imageregistration/creation-args.txt'
-    extrasArgsFile = settings.STATIC_ROOT + '/georef_imageregistration/extras-args.txt'
-    
+    argsFiles = [settings.STATIC_ROOT + '/georef_imageregistration/creation-args.txt',
+                 settings.STATIC_ROOT + '/georef_imageregistration/extras-args.txt']
+    args = []
+    for argsFile in argsFiles:
+        with open(argsFile, 'r') as handle:
+            for line in handle:
+                line = line.strip()
+                if line and (not line.startswith('#')) and (line not in GDAL_WRITTEN_EXIF_ARGS):
+                    args.append(line)
+    return args
+
+def updateExif(exifSourcePath, geotiffFilePath):
+    '''Copy the EXIF info GDAL could not write at creation time from the source file
+       to the geotiff file.  exiftool rewrites the whole file, so this is skipped
+       if the source file has none of those tags.'''
+
+    exifData = piexif.load(exifSourcePath)
+    if (not exifData['Exif']) and (piexif.ImageIFD.Make  not in exifData['0th']) \
+                              and (piexif.ImageIFD.Model not in exifData['0th']):
+        print 'No camera EXIF info to copy from ' + exifSourcePath
+        return
+
     outputFileName = geotiffFilePath
     # rename the geotiff input to "temp" so that we can generate a new geotiffFilePath geotiff file with updated exif.
     #     tempFileName = geotiffFilePath + ".temp"  
@@ -144,16 +179,17 @@ def updateExif(exifSourcePath, geotiffFilePath):
     tempFileName = os.path.dirname(outputFileName) + "/temp-%s%s" % (datetime.datetime.utcnow().strftime('%Y-%m-%d_%H:%M:%S%Z'), file_extension)
     
     os.rename(outputFileName, tempFileName)
-    print "Exif Source Path: %s"
-    
-    try: 
-        exifCmd = 'exiftool -tagsFromFile %s -@ %s -@ %s -ModifyDate="`date \'+%%Y:%%m:%%d %%H:%%M:%%S\'`" -EXIF:Software="%s" -o %s %s' \
-                    % (exifSourcePath, creationArgsFile, extrasArgsFile, "GeoRef", outputFileName, tempFileName)      
-        os.system(exifCmd)
-        os.remove(tempFileName)  
-    except Exception as e: 
+    print "Exif Source Path: %s" % exifSourcePath
+    
+    exifCmd = (['exiftool', '-tagsFromFile', exifSourcePath] + getExiftoolTagArgs() +
+               ['-o', outputFileName, tempFileName])
+    if subprocess.call(exifCmd) != 0:
+        print "Failed to copy over the exif information."
+        if os.path.exists(outputFileName):
+            os.remove(outputFileName)
         os.rename(tempFileName, outputFileName)
-        print "Failed to copy over the exif information. %s" % e
+        return
+    os.remove(tempFileName)
 
 
 def getIdentityTransform():
@@ -165,6 +201,80 @@ def isPixelValid(pixel, size):
     return ((pixel[0] >= 0      ) and (pixel[1] >= 0      ) and
             (pixel[0] <  size[0]) and (pixel[1] <  size[1])    )
 
+def arePixelsValid(pixels, size):
+    '''Vectorized version of isPixelValid, returns a boolean mask for an Nx2 array'''
+    return ((pixels[:,0] >= 0      ) & (pixels[:,1] >= 0      ) &
+            (pixels[:,0] <  size[0]) & (pixels[:,1] <  size[1])    )
+
+def getPixelGrid(width, height, gridSize=None):
+    '''Returns an Nx2 array of (x, y) pixels evenly spaced over an image,
+       with gridSize points along each side.'''
+    if not gridSize:
+        gridSize = offline_config.GEO_TRANSFORM_GRID_SIZE
+    (xs, ys) = numpy.meshgrid(numpy.linspace(0, width -1, gridSize),
+                              numpy.linspace(0, height-1, gridSize))
+    return numpy.column_stack([xs.ravel(), ys.ravel()])
+
+def _getTransformMatrix(tform):
+    '''Returns the 3x3 matrix of a linear or projective transform, or None for other types'''
+    matrix = getattr(tform, 'matrix', None)
+    if matrix is None:
+        return None
+    matrix = numpy.asarray(matrix, dtype=numpy.float64)
+    if matrix.shape != (3, 3):
+        return None
+    return matrix
+
+def _applyMatrix(matrix, points):
+    '''Apply a 3x3 homogeneous transform matrix to an Nx2 array'''
+    homogeneous = numpy.column_stack([points, numpy.ones(len(points))]).dot(matrix.T)
+    return homogeneous[:,0:2] / homogeneous[:,2:3]
+
+def forwardPoints(tform, points):
+    '''Apply tform.forward to each row of an Nx2 array, returning an Nx2 array.
+       Linear and projective transforms are applied to all of the points at once.'''
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+    matrix = _getTransformMatrix(tform)
+    if matrix is None:
+        return numpy.array([tform.forward(p) for p in points], dtype=numpy.float64).reshape(-1, 2)
+    return _applyMatrix(matrix, points)
+
+def reversePoints(tform, points):
+    '''Apply tform.reverse to each row of an Nx2 array, returning an Nx2 array.'''
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+    matrix = _getTransformMatrix(tform)
+    if matrix is None:
+        return numpy.array([tform.reverse(p) for p in points], dtype=numpy.float64).reshape(-1, 2)
+    return _applyMatrix(numpy.linalg.inv(matrix), points)
+
+def composeTransforms(outer, inner):
+    '''Returns a ProjectiveTransform equal to applying inner and then outer, or None if
+       either of them is not a linear or projective transform.'''
+    outerMatrix = _getTransformMatrix(outer)
+    innerMatrix = _getTransformMatrix(inner)
+    if (outerMatrix is None) or (innerMatrix is None):
+        return None
+    return transform.ProjectiveTransform(outerMatrix.dot(innerMatrix))
+
+# Same projection constant as lonLatToMeters and metersToLatLon in transform.py
+ORIGIN_SHIFT = 2 * math.pi * 6378137 / 2.0
+
+def lonLatToMetersArray(lonLat):
+    '''Vectorized transform.lonLatToMeters for an Nx2 array of (lon, lat) points'''
+    lonLat = numpy.asarray(lonLat, dtype=numpy.float64).reshape(-1, 2)
+    mx = lonLat[:,0] * ORIGIN_SHIFT / 180.0
+    my = numpy.log(numpy.tan((90.0 + lonLat[:,1]) * math.pi / 360.0)) / (math.pi / 180.0)
+    my = my * ORIGIN_SHIFT / 180.0
+    return numpy.column_stack([mx, my])
+
+def metersToLonLatArray(meters):
+    '''Vectorized transform.metersToLatLon for an Nx2 array of projected points'''
+    meters = numpy.asarray(meters, dtype=numpy.float64).reshape(-1, 2)
+    lon = (meters[:,0] / ORIGIN_SHIFT) * 180.0
+    lat = (meters[:,1] / ORIGIN_SHIFT) * 180.0
+    lat = 180.0 / math.pi * (2.0 * numpy.arctan(numpy.exp(lat * math.pi / 180.0)) - math.pi / 2.0)
+    return numpy.column_stack([lon, lat])
+
 
 def estimateGroundResolution(focalLength, width, height, sensorWidth, sensorHeight,
                              stationLon, stationLat, stationAlt, centerLon, centerLat, tilt=0.0):
@@ -284,23 +394,13 @@ def getPixelToGdcTransform(imagePath, pixelToProjectedTransform=None):
         # Use the simple file info call (the input file may not have geo information)
         (width, height) = IrgGeoFunctions.getImageSize(imagePath)
         
-        imagePoints = []
-        gdcPoints   = []
-        
-        # Loop through a spaced out grid of pixels in the image
-        pointPixelSpacing = (width + height) / 20 # Results in about 100 points
-        for r in range(0, width, pointPixelSpacing):
-            for c in range(0, height, pointPixelSpacing):
-                # This pixel --> projected coords --> lonlat coord
-                thisPixel           = numpy.array([float(c), float(r)])
-                projectedCoordinate = pixelToProjectedTransform.forward(thisPixel)
-                gdcCoordinate       = transform.metersToLatLon(projectedCoordinate)
-        
-                imagePoints.append(thisPixel)
-                gdcPoints.append(gdcCoordinate)
+        # Use a spaced out grid of pixels in the image
+        # - This pixel --> projected coords --> lonlat coord
+        imagePoints = getPixelGrid(width, height)
+        gdcPoints   = metersToLonLatArray(forwardPoints(pixelToProjectedTransform, imagePoints))
+
         # Solve for a transform with all of these point pairs
-        pixelToGdcTransform = transform.getTransform(numpy.asarray(gdcPoints),
-                                                     numpy.asarray(imagePoints))
+        pixelToGdcTransform = transform.getTransform(gdcPoints, imagePoints)
         
     else: # Using a reference image from EE which will have nice bounds.
 
@@ -357,14 +457,87 @@ def getGdcTransformFromPixelTransform(imageSize, pixelTransform, refImageGdcTran
 
 
 
-def alignImages(testImagePath, refImagePath, workPrefix, force, debug=False, slowMethod=False):
-    '''Call the C++ code to find the image alignment'''
+def loadTransformFile(transformPath):
+    '''Load the transform, confidence, and inliers written by registerGeocamImage'''
+    handle   = open(transformPath, 'r')
+    fileText = handle.read()
+    handle.close()
+    lines = fileText.split('\n')
+    confidence = CONFIDENCE_NONE
+    if 'CONFIDENCE_LOW' in lines[0]:
+        confidence = CONFIDENCE_LOW
+    if 'CONFIDENCE_HIGH' in lines[0]:
+        confidence = CONFIDENCE_HIGH
+    tform = [float(f) for f in lines[2].split(',')] +  \
+            [float(f) for f in lines[3].split(',')] +  \
+            [float(f) for f in lines[4].split(',')]
+    refInliers  = []
+    testInliers = []
+    for line in lines[6:]:
+        if len(line) < 2:
+            break
+        numbers = [float(f) for f in line.split(',')]
+        refInliers.append( (numbers[0], numbers[1]))
+        testInliers.append((numbers[2], numbers[3]))
+    
+    #print tform
+    #print refInliers
+    #print testInliers
+    
+    return (tform, confidence, testInliers, refInliers)
+
+
+def writeTransformFile(transformPath, tform, confidence, testInliers, refInliers):
+    '''Write an alignment result in the registerGeocamImage format read by loadTransformFile'''
+    handle = open(transformPath, 'w')
+    handle.write('CONFIDENCE_' + CONFIDENCE_STRINGS[confidence] + '\n')
+    handle.write('TRANSFORM:\n')
+    for r in range(3):
+        handle.write(', '.join([repr(float(v)) for v in tform[r*3:r*3+3]]) + '\n')
+    handle.write('INLIERS:\n')
+    for (ref, test) in zip(refInliers, testInliers):
+        handle.write('%r, %r, %r, %r\n' % (float(ref[0]), float(ref[1]), float(test[0]), float(test[1])))
+    handle.close()
+
+
+def alignImages(testImagePath, refImagePath, workPrefix, force, debug=False, slowMethod=False,
+                numThreads=None, testReduction=1, priorScale=1.0, testScale=1.0):
+    '''Call the C++ code to find the image alignment.
+       numThreads overrides ALIGNMENT_NUM_THREADS in offline_config.
+       If testReduction is 2, 4, or 8 the test image is loaded at that fraction of its size,
+       then it is resized by testScale.  The results are in the coordinates of the
+       reduced and resized image.
+       priorScale is the approximate test to reference image scale, used by guided matching.
+       Returns (tform, confidence, testInliers, refInliers, timing) where timing
+       holds the time spent in each stage of the alignment, see alignment_engine.parseTiming.'''
     
     transformPath = workPrefix + '-transform.txt'
 
     # The computed transform is from testImage to refImage
+
+    # Use the in-process library or the alignment server unless there is an
+    #  existing result we can reuse.  Their results are written to the same
+    #  file as the command line tool so later calls can reuse them.
+    if ((offline_config.ALIGNMENT_BACKEND in ['library', 'daemon']) and
+        (not os.path.exists(transformPath) or force)):
+        if os.path.exists(transformPath):
+            os.remove(transformPath) # Clear out any old results
+        if offline_config.ALIGNMENT_BACKEND == 'library':
+            print 'Running in-process image alignment...'
+            result = alignment_engine.alignImageFiles(testImagePath, refImagePath, workPrefix,
+                                                      debug, slowMethod, numThreads, testReduction,
+                                                      priorScale, testScale)
+        else:
+            print 'Sending request to image alignment server...'
+            result = alignment_engine.alignImageFilesWithDaemon(testImagePath, refImagePath, workPrefix,
+                                                                debug, slowMethod, numThreads,
+                                                                testReduction, priorScale, testScale)
+        (tform, confidence, testInliers, refInliers, timing) = result
+        writeTransformFile(transformPath, tform, confidence, testInliers, refInliers)
+        return result
     
     # Run the C++ command if we need to generate the transform
+    timing = alignment_engine.parseTiming(None) # No timing if we reuse an existing result
     if (not os.path.exists(transformPath) or force):
         if os.path.exists(transformPath):
             os.remove(transformPath) # Clear out any old results
@@ -372,11 +545,18 @@ def alignImages(testImagePath, refImagePath, workPrefix, force, debug=False, slo
         print 'Running C++ image alignment tool...'
         cmdPath = settings.PROJ_ROOT + '/apps/georef_imageregistration/build/registerGeocamImage'
         
-        cmd = [cmdPath, refImagePath, testImagePath, transformPath]
+        cmd = [cmdPath] + alignment_engine.getToolOptionArgs(numThreads) + [refImagePath, testImagePath, transformPath]
         if debug: cmd.append('y')
         else:     cmd.append('n')
         if slowMethod: cmd.append('y')
         else:          cmd.append('n')
+        cmd += ['--mode', str(alignment_engine.getAlignmentMode(slowMethod))]
+        if testReduction > 1:
+            cmd += ['--match-reduction', str(testReduction)]
+        if testScale != 1.0:
+            cmd += ['--match-scale', repr(testScale)]
+        if priorScale != 1.0:
+            cmd += ['--prior-scale', str(priorScale)]
 
         if debug:
             print cmd
@@ -384,6 +564,9 @@ def alignImages(testImagePath, refImagePath, workPrefix, force, debug=False, slo
         p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
         textOutput, err = p.communicate()
         print textOutput
+        for line in textOutput.split('\n'):
+            if line.startswith('TIMING: '):
+                timing = alignment_engine.parseTiming(line[len('TIMING: '):])
     
     if not os.path.exists(transformPath):
         raise Exception('Failed to compute transform!')
@@ -392,33 +575,23 @@ def alignImages(testImagePath, refImagePath, workPrefix, force, debug=False, slo
         return (tform, confidence)
     
     # Load the computed transform, confidence, and inliers.
-    handle   = open(transformPath, 'r')
-    fileText = handle.read()
-    handle.close()
-    lines = fileText.split('\n')
-    confidence = CONFIDENCE_NONE
-    if 'CONFIDENCE_LOW' in lines[0]:
-        confidence = CONFIDENCE_LOW
-    if 'CONFIDENCE_HIGH' in lines[0]:
-        confidence = CONFIDENCE_HIGH
-    tform = [float(f) for f in lines[2].split(',')] +  \
-            [float(f) for f in lines[3].split(',')] +  \
-            [float(f) for f in lines[4].split(',')]
-    refInliers  = []
-    testInliers = []
-    for line in lines[6:]:
-        if len(line) < 2:
-            break
-        numbers = [float(f) for f in line.split(',')]
-        refInliers.append( (numbers[0], numbers[1]))
-        testInliers.append((numbers[2], numbers[3]))
-    
-    #print tform
-    #print refInliers
-    #print testInliers
-    
-    return (tform, confidence, testInliers, refInliers)
-
+    (tform, confidence, testInliers, refInliers) = loadTransformFile(transformPath)
+    return (tform, confidence, testInliers, refInliers, timing)
+
+
+def getAlignmentScaling(testImageScaling, tolerance):
+    '''Returns (reduction, testScale) such that loading the test image with reduced decoding
+       by reduction (1, 2, 4, or 8) and then resizing it by testScale scales it by
+       testImageScaling.  The largest reduction which does not shrink the image too much
+       is used, and testScale is 1.0 if it is within the tolerance of 1.'''
+    reduction = 1
+    for r in [2, 4, 8]:
+        if testImageScaling*r < 1.0 + tolerance:
+            reduction = r
+    testScale = testImageScaling*reduction
+    if abs(testScale - 1.0) < tolerance:
+        testScale = 1.0
+    return (reduction, testScale)
 
 def alignScaledImages(testImagePath, refImagePath, testImageScaling, workPrefix, force, debug=False, slowMethod=False):
     '''Align a possibly higher resolution input image with a reference image.
@@ -426,38 +599,89 @@ def alignScaledImages(testImagePath, refImagePath, testImageScaling, workPrefix,
     
     # If the scale is within this amount, don't bother rescaling.
     SCALE_TOLERANCE = 0.10
-    if abs(testImageScaling - 1.0) < SCALE_TOLERANCE:
-        # In this case just use the lower level function
-        return alignImages(testImagePath, refImagePath, workPrefix, force, debug, slowMethod)
 
-   
-    # Generate a scaled version of the input image
-    scaledImagePath = workPrefix + '-scaledInputImage.tif'
-    outPercentage = str(testImageScaling*100.0)
-    cmd = 'gdal_translate -outsize ' + outPercentage +'% ' + outPercentage +'% '+ testImagePath +' '+ scaledImagePath
-    print cmd
-    os.system(cmd)
-    if not os.path.exists(scaledImagePath):
-        raise Exception('Failed to rescale image with command:\n' + cmd)
-    
-    # Call alignment with the scaled version
-    (scaledTform, confidence, scaledImageInliers, refInliers) = \
-            alignImages(scaledImagePath, refImagePath, workPrefix, force, debug, slowMethod)
+    # The aligner shrinks the image while decoding it if possible and then
+    #  resizes it in memory, instead of us writing out a scaled copy.
+    (reduction, testScale) = getAlignmentScaling(testImageScaling, SCALE_TOLERANCE)
+    alignScaling = testScale / reduction
+    if alignScaling == 1.0:
+        # In this case just use the lower level function
+        return alignImages(testImagePath, refImagePath, workPrefix, force, debug, slowMethod,
+                           priorScale=testImageScaling)
+
+    print ('Aligning with the input image reduced by ' + str(reduction) +
+           ' and scaled by ' + str(testScale))
+    (scaledTform, confidence, scaledImageInliers, refInliers, timing) = \
+            alignImages(testImagePath, refImagePath, workPrefix, force, debug, slowMethod,
+                        testReduction=reduction, priorScale=testImageScaling/alignScaling,
+                        testScale=testScale)
     
     # De-scale the output transform so that it applies to the input sized image.
-    testInliers = []
-    for pixel in scaledImageInliers:
-        testInliers.append( (pixel[0]/testImageScaling, pixel[1]/testImageScaling) )
     print 'scaled tform = \n' + str(scaledTform)
-    tform = scaledTform
+    (tform, testInliers) = descaleAlignment(scaledTform, scaledImageInliers, alignScaling)
+    print 'tform = \n' + str(tform)
+
+    return (tform, confidence, testInliers, refInliers, timing)
+
+
+def descaleAlignment(scaledTform, scaledImageInliers, testImageScaling):
+    '''Convert an alignment computed with a copy of the test image scaled by
+       testImageScaling so that it applies to the original test image.
+       Returns (tform, testInliers).'''
+    testInliers = [(pixel[0]/testImageScaling, pixel[1]/testImageScaling)
+                   for pixel in scaledImageInliers]
+    tform = list(scaledTform)
     for i in [0, 1, 3, 4, 6, 7]: # Scale the six coefficient values
         tform[i] = tform[i] * testImageScaling
-    print 'tform = \n' + str(tform)
+    return (tform, testInliers)
+
+
+def alignScaledImageBatch(testImagePath, refImagePaths, testImageScaling, workPrefix, force,
+                          debug=False, slowMethod=False):
+    '''Align a possibly higher resolution input image with each of a list of reference
+       images which share the same resolution, stopping after the first high confidence result.
+       With the library backend the input image features are only computed once.
+       Returns (results, timing) where results is a list of
+       (refIndex, tform, confidence, testInliers, refInliers) tuples sorted by
+       decreasing inlier count.  Failed alignments have zero confidence and no inliers
+       and reference images skipped after a high confidence result have no entry.'''
+
+    if offline_config.ALIGNMENT_BACKEND != 'library':
+        # The other backends handle one image pair per call
+        results = []
+        timing  = alignment_engine.parseTiming(None)
+        for (i, refImagePath) in enumerate(refImagePaths):
+            try:
+                (tform, confidence, testInliers, refInliers, pairTiming) = \
+                    alignScaledImages(testImagePath, refImagePath, testImageScaling,
+                                      workPrefix + '-' + str(i), force, debug, slowMethod)
+                alignment_engine.addTiming(timing, pairTiming)
+            except Exception as e:
+                print 'Failed to align with ' + refImagePath + ': ' + str(e)
+                (tform, confidence, testInliers, refInliers) = \
+                    ([1, 0, 0, 0, 1, 0, 0, 0, 1], CONFIDENCE_NONE, [], [])
+            results.append((i, tform, confidence, testInliers, refInliers))
+            if confidence == CONFIDENCE_HIGH:
+                break
+        results.sort(key=lambda r: len(r[3]), reverse=True)
+        return (results, timing)
 
-    if not debug: # Clean up the scaled image
-        os.remove(scaledImagePath)
+    # Work out how the test image will be scaled, see alignScaledImages.
+    SCALE_TOLERANCE = 0.10
+    (reduction, testScale) = getAlignmentScaling(testImageScaling, SCALE_TOLERANCE)
+    alignScaling = testScale / reduction
 
-    return (tform, confidence, testInliers, refInliers)
+    (scaledResults, timing) = alignment_engine.alignImageFileBatch(
+                                  testImagePath, refImagePaths, workPrefix, debug, slowMethod,
+                                  testReduction=reduction,
+                                  priorScale=testImageScaling/alignScaling,
+                                  testScale=testScale)
+
+    results = []
+    for (refIndex, scaledTform, confidence, scaledImageInliers, refInliers) in scaledResults:
+        (tform, testInliers) = descaleAlignment(scaledTform, scaledImageInliers, alignScaling)
+        results.append((refIndex, tform, confidence, testInliers, refInliers))
+    return (results, timing)
 
 
 
@@ -503,21 +727,17 @@ def convertGcps(inputGdcCoords, imageToProjectedTransform, width, height):
        produces a set of GCPs for that image.'''
 
     size = (width, height)
+    if len(inputGdcCoords) == 0:
+        return ([], [])
 
-    imageCoords = []
-    gdcCoords   = []
-
-    for inputCoord in inputGdcCoords:
-        # Convert from GDC to Google projected coordinate
-        coordMeters = transform.lonLatToMeters(inputCoord)
-        
-        # Get image coordinate
-        pixel = imageToProjectedTransform.reverse(coordMeters)
+    # Convert from GDC to Google projected coordinates, then to image coordinates
+    coordMeters = lonLatToMetersArray(inputGdcCoords)
+    pixels      = reversePoints(imageToProjectedTransform, coordMeters)
 
-        # Only keep GCPs that actually fall within the image
-        if isPixelValid(pixel, size):
-            gdcCoords.append(inputCoord)
-            imageCoords.append(pixel)
+    # Only keep GCPs that actually fall within the image
+    valid       = arePixelsValid(pixels, size)
+    imageCoords = [tuple(p) for p in pixels[valid]]
+    gdcCoords   = [inputGdcCoords[i] for i in numpy.nonzero(valid)[0]]
 
     return (imageCoords, gdcCoords)
 
@@ -570,135 +790,213 @@ def generateUncertaintyImage(width, height, imageInliers, minUncertainty, output
     '''Given a list of GCPs in an image, generate a distance image containing the
        distance from each pixel to the nearest GCP location.
        Returns the RMS error.'''
-    
-    # Create a white image with black dots at each GCP coordinate
-    drawLine = ''
-    for point in imageInliers:
-        drawLine += (" point "+ str(point[0]) +","+ str(point[1]))
-    
-    tempPath1 = outputPath + '-tempDot.tif'
-    tempPath2 = outputPath + '-tempDist.tif'
-    cmd = ("convert +depth -size "+str(width)+"x"+str(height)+
-           " xc:white  -fill black -draw '"+drawLine+"' " +tempPath1)
-    #print cmd
-    os.system(cmd)
-    if not os.path.exists(tempPath1):
-        print "tempPath1 is %s" % tempPath1
-        raise Exception('Failed to generate GCP point image!')
 
-    # Get the distance from each 
-    cmd2 = ('convert '+tempPath1+' -morphology Distance Euclidean:1,1 '+ tempPath2)
-    #print cmd2
-    os.system(cmd2)
-    if not os.path.exists(tempPath2):
-        raise Exception('Failed to generate GCP distance image!')
+    from osgeo import gdal
 
     # TODO: Improve this calculation!
 
-    # For each pixel away from a GCP, the uncertainty increases by this
-    #  fraction of the minimum uncertainty.
+    # For each pixel away from a GCP, the uncertainty increases by this amount.
     UNCERTAINTY_STEP_FRACTION = 0.03
-    uncertaintyStep = minUncertainty * UNCERTAINTY_STEP_FRACTION
-    
-    # Figure out the uncertainty range in the output image and generate a scale string.
+
+    # Distances are capped at this many pixels.
     UINT16_MAX = 65535
-    maxUncertainty    = UINT16_MAX * UNCERTAINTY_STEP_FRACTION + minUncertainty
-    uncertaintyString = ((' 0 %d %f %f ') % (UINT16_MAX, minUncertainty, maxUncertainty))
-    
-    # Use gdal_translate to convert from Uint16 to a scaled 32 bit floating point image
-    #  with the final error numbers.
-    cmd3 = ('gdal_translate -b 1 -ot Float32 -scale '+uncertaintyString+ tempPath2 +' '+ outputPath)
-    #print cmd3
-    os.system(cmd3)
-    if not os.path.exists(outputPath):
-        raise Exception('Failed to generate uncertainty image!')
-
-    # Compute the RMS error using a simple command line tool
-    cmdPath = settings.PROJ_ROOT + '/apps/georef_imageregistration/build/computeImageRms'
-    cmd4    = [cmdPath, outputPath]
-    #print cmd4
-    p = subprocess.Popen(cmd4, stdout=subprocess.PIPE)
-    textOutput, err = p.communicate()
-    
-    # Parse the line "RMS: 123"
-    parts    = textOutput.split(':')
-    rmsError = float(parts[1])
 
-    # Clean up
-    os.remove(tempPath1)
-    os.remove(tempPath2)
-    
+    # The image is processed this many rows at a time, matching the output tiles.
+    BLOCK_SIZE = 256
+
+    # Without scipy the distances are computed on a grid with at most this many
+    #  pixels on a side and then interpolated up to the full image size.
+    MAX_REDUCED_SIZE = 1024
+
+    points = numpy.array(imageInliers, dtype=numpy.float64).reshape(-1, 2)
+
+    try:
+        from scipy.spatial import cKDTree
+    except ImportError:
+        cKDTree = None
+
+    driver  = gdal.GetDriverByName('GTiff')
+    options = ['TILED=YES', 'BLOCKXSIZE=%d' % BLOCK_SIZE, 'BLOCKYSIZE=%d' % BLOCK_SIZE,
+               'COMPRESS=LZW', 'PREDICTOR=3', 'BIGTIFF=IF_SAFER']
+
+    if (cKDTree is None) and (max(width, height) > MAX_REDUCED_SIZE):
+        # Compute the distances at reduced resolution and let GDAL interpolate them
+        #  while it writes the full size output image.
+        reduction = float(max(width, height)) / MAX_REDUCED_SIZE
+        outWidth  = max(1, int(round(width /reduction)))
+        outHeight = max(1, int(round(height/reduction)))
+        xCoords   = (numpy.arange(outWidth ) + 0.5) * (float(width )/outWidth ) - 0.5
+        yCoords   = (numpy.arange(outHeight) + 0.5) * (float(height)/outHeight) - 0.5
+        memDataset = gdal.GetDriverByName('MEM').Create('', outWidth, outHeight, 1,
+                                                        gdal.GDT_Float32)
+    else:
+        outWidth   = width
+        outHeight  = height
+        xCoords    = numpy.arange(width,  dtype=numpy.float64)
+        yCoords    = numpy.arange(height, dtype=numpy.float64)
+        memDataset = None
+        dataset    = driver.Create(outputPath, width, height, 1, gdal.GDT_Float32, options)
+        if dataset is None:
+            raise Exception('Failed to create uncertainty image ' + outputPath)
+    band = (memDataset or dataset).GetRasterBand(1)
+
+    tree = None
+    if (cKDTree is not None) and (len(points) > 0):
+        tree = cKDTree(points)
+
+    # Fill in the distance image one strip at a time, computing the RMS as we go.
+    sumSquares = 0.0
+    for row in range(0, outHeight, BLOCK_SIZE):
+        blockRows = yCoords[row:row+BLOCK_SIZE]
+        distances = getDistanceToPoints(xCoords, blockRows, points, tree)
+        distances = numpy.minimum(distances, UINT16_MAX)
+        block = (minUncertainty + UNCERTAINTY_STEP_FRACTION*distances).astype(numpy.float32)
+        band.WriteArray(block, 0, row)
+        sumSquares += numpy.sum(numpy.square(block, dtype=numpy.float64))
+    rmsError = math.sqrt(sumSquares / (outWidth*outHeight))
+
+    if memDataset is not None:
+        dataset = gdal.Translate(outputPath, memDataset, width=width, height=height,
+                                 resampleAlg='bilinear', creationOptions=options)
+        if dataset is None:
+            raise Exception('Failed to create uncertainty image ' + outputPath)
+    dataset = None # Close the file
+
     return rmsError
 
+def getDistanceToPoints(xCoords, yCoords, points, tree=None):
+    '''Returns an array of size len(yCoords) by len(xCoords) containing the exact
+       distance from each of those pixel locations to the nearest point.
+       If provided, tree must be a scipy cKDTree built from points.'''
 
-def qualityGdalwarp(imagePath, outputPath, imagePoints, gdcPoints):
-    '''Use some workarounds to get a higher quality gdalwarp output than is normally possible.'''
+    if len(points) == 0:
+        return numpy.full((len(yCoords), len(xCoords)), numpy.inf)
+
+    if tree is not None:
+        (xGrid, yGrid) = numpy.meshgrid(xCoords, yCoords)
+        (distances, indices) = tree.query(numpy.column_stack((xGrid.ravel(), yGrid.ravel())))
+        return distances.reshape(xGrid.shape)
+
+    # Check each point in turn, the squared distance is separable in x and y.
+    distSquared = numpy.full((len(yCoords), len(xCoords)), numpy.inf)
+    for (x, y) in points:
+        numpy.minimum(distSquared,
+                      numpy.square(yCoords - y)[:,numpy.newaxis] +
+                      numpy.square(xCoords - x)[numpy.newaxis,:],
+                      out=distSquared)
+    return numpy.sqrt(distSquared)
+
+
+def qualityGdalwarp(imagePath, outputPath, imagePoints, gdcPoints,
+                    metadata=None, writeHeaders=False):
+    '''Use some workarounds to get a higher quality gdalwarp output than is normally possible.
+       The metadata fields are added to the output file and if writeHeaders is set
+       the standalone metadata file is written as well.'''
 
     # Generate a high resolution grid of fake GCPs based on a transform we compute,
-    # then call gdalwarp using a high order polynomial to accurately match our transform.
+    # then warp the image with a thin plate spline to accurately match our transform.
+    # - The GCPs are attached to an in-memory VRT of the input image so the
+    #   warp reads the input pixels directly and the output is written in one pass.
+
+    from osgeo import gdal
 
     #trans = transform.ProjectiveTransform.fit(numpy.asarray(gdcPoints),numpy.asarray(imagePoints))ls 
     trans = transform.getTransform(numpy.asarray(gdcPoints),numpy.asarray(imagePoints))
     transformName = trans.getJsonDict()['type']
-    
-    tempPath = outputPath + '-temp.tif'
-    
-    # Generate a temporary image containing the grid of fake GCPs
-    cmd = ('gdal_translate -co "COMPRESS=LZW" -co "tiled=yes"  -co "predictor=2" -a_srs "'
-           + OUTPUT_PROJECTION +'" '+ imagePath +' '+ tempPath)
-    
+
     # Generate the GCPs in a grid, keeping the total under about 500 points so
     # that GDAL does not complain.
+    GCP_GRID_SIZE = 22
     (width, height) = IrgGeoFunctions.getImageSize(imagePath)
-    xStep = width /22
-    yStep = height/22
+    pixels  = getPixelGrid(width, height, GCP_GRID_SIZE)
+    lonlats = forwardPoints(trans, pixels)
+
+    # Keep track of the lonlat size and don't write if it is too big.
+    # - This would work better if it was in pixels, but how to get that size?
     MAX_DEG_SIZE = 20
-    minLon = 999 # Keep track of the lonlat size and don't write if it is too big.
-    minLat = 999 # - This would work better if it was in pixels, but how to get that size?
-    maxLon = -999
-    maxLat = -999
-    for r in range(0,height,yStep):
-        for c in range(0,width,xStep):
-            pixel  = (c,r)
-            lonlat = trans.forward(pixel)
-            cmd += ' -gcp '+ str(c) +' '+str(r) +' '+str(lonlat[0]) +' '+str(lonlat[1])
-            if lonlat[0] < minLon:
-                minLon = lonlat[0]
-            if lonlat[1] < minLat:
-                minLat = lonlat[1]
-            if lonlat[0] > maxLon:
-                maxLon = lonlat[0]
-            if lonlat[1] > maxLat:
-                maxLat = lonlat[1]
-    #print cmd
-    os.system(cmd)
+    (minLon, minLat) = lonlats.min(axis=0)
+    (maxLon, maxLat) = lonlats.max(axis=0)
     if max((maxLon - minLon), (maxLat - minLat)) > MAX_DEG_SIZE:
         raise Exception('Warped image is too large to generate!\n'
                         '-> LonLat bounds: ' + str((minLon, minLat, maxLon, maxLat)))
 
+    gcps = [gdal.GCP(float(lonlat[0]), float(lonlat[1]), 0.0, float(pixel[0]), float(pixel[1]))
+            for (pixel, lonlat) in zip(pixels, lonlats)]
+    sourceDataset = gdal.Translate('', imagePath, format='VRT', GCPs=gcps,
+                                   outputSRS=OUTPUT_PROJECTION)
+    if sourceDataset is None:
+        raise Exception('Failed to attach GCPs to image: ' + imagePath)
+
     # Now generate a warped geotiff.
     # - "order 2" looks terrible with fewer GCPs, but "order 1" does not accurately
     #   capture the footprint of higher tilt images.
     # - tps seems to work well with the evenly spaced grid of virtual GCPs.
-    cmd = ('gdalwarp -co "COMPRESS=LZW" -co "tiled=yes"  -co "predictor=2"'
-               + ' -dstalpha -overwrite -tps -multi -r cubic -t_srs "'
-           + OUTPUT_PROJECTION +'" ' + tempPath +' '+ outputPath)
-    print cmd
-    os.system(cmd)
-
-    # Check output and cleanup
-    os.remove(tempPath)
-    if not os.path.exists(outputPath):
+    # - GDAL evaluates the tps transform on a grid and interpolates between those
+    #   points, and the warp is split into chunks which are processed in parallel.
+    numThreads = offline_config.WARP_NUM_THREADS
+    if not numThreads:
+        numThreads = 'ALL_CPUS'
+    if os.path.exists(outputPath):
+        os.remove(outputPath)
+    print 'Warping ' + imagePath + ' to ' + outputPath
+    outputDataset = gdal.Warp(outputPath, sourceDataset, format='GTiff',
+                              dstSRS=OUTPUT_PROJECTION, tps=True, resampleAlg='cubic',
+                              dstAlpha=True, multithread=True,
+                              warpOptions=['NUM_THREADS=' + str(numThreads)],
+                              warpMemoryLimit=offline_config.WARP_MEMORY_LIMIT_MB*1024*1024,
+                              creationOptions=['COMPRESS=LZW', 'TILED=YES', 'PREDICTOR=2'])
+    sourceDataset = None
+
+    # Check output
+    if outputDataset is None:
         raise Exception('Failed to create warped geotiff file: ' + outputPath)
 
+    # Add some extra metadata fields.
+    extraMetadata = {'TIFFTAG_DOCUMENTNAME': '',
+                     'RESAMPLING_METHOD'   : 'cubic',
+                     'WARP_TRANSFORM'      : transformName}
+    if metadata:
+        extraMetadata.update(metadata)
+    setDatasetMetadata(outputDataset, extraMetadata)
+
+    if writeHeaders:
+        generateStandaloneMetadataFile(outputDataset, outputPath)
+    outputDataset = None # Close the file
+
     return transformName
 
 
 
+def getRegistrationMetadata(posError, fitError, isManualRegistration, exifSourcePath):
+    '''Returns a dictionary of the metadata fields we add to each output geotiff.'''
+
+    if isManualRegistration:
+        registrationMethodString = 'Manual'
+    else:
+        registrationMethodString = 'Automated'
+
+    exifData = piexif.load(exifSourcePath)
+    acquisitionTime = exifData['Exif'][piexif.ExifIFD.DateTimeOriginal]
+
+    # TODO: Do the manual registrations not use Landsat?
+    return {'POSITION_UNCERTAINTY_RMS_METERS': str(posError),
+            'FIT_ERROR_RMS_PIXELS'           : str(fitError),
+            'REGISTRATION_METHOD'            : registrationMethodString,
+            'REGISTRATION_REFERENCE'         : 'Landsat',
+            'ACQUISITION_DATETIME'           : acquisitionTime,
+            'ACQUISITION_DATETIME_TIMEZONE'  : 'GMT'}
+
+def setDatasetMetadata(dataset, metadata):
+    '''Add metadata fields to an open GDAL dataset, keeping any existing fields.'''
+    for (key, value) in metadata.items():
+        dataset.SetMetadataItem(key, value)
+
 def generateGeotiff(imagePath, outputPrefix, imagePoints, gdcPoints, posError, fitError,
                     isManualRegistration, exifSourcePath, writeHeaders, overwrite=False):
     '''Converts a plain tiff to a geotiff using the provided geo information.'''
 
+    from osgeo import gdal
+
     # Check inputs
     if len(imagePoints) != len(gdcPoints):
         raise Exception('Unequal length correspondence points passed to generateGeoTiff!')
@@ -706,132 +1004,86 @@ def generateGeotiff(imagePath, outputPrefix, imagePoints, gdcPoints, posError, f
     noWarpOutputPath = outputPrefix + '-no_warp.tif'
     warpOutputPath   = outputPrefix + '-warp.tif'
 
-    if isManualRegistration:
-        registrationMethodString = 'Manual'
-    else:
-        registrationMethodString = 'Automated'
-
-    exifData = piexif.load(exifSourcePath)
-    acquisitionTime = exifData['Exif'][piexif.ExifIFD.DateTimeOriginal]
-    
-    # TODO: Do the manual registrations not use Landsat?
-    extraMetadataString = ('-mo POSITION_UNCERTAINTY_RMS_METERS=' + str(posError)
-                         + ' -mo FIT_ERROR_RMS_PIXELS=' + str(fitError)
-                         + ' -mo REGISTRATION_METHOD=' + registrationMethodString
-                         + ' -mo REGISTRATION_REFERENCE=Landsat'
-                         + ' -mo ACQUISITION_DATETIME="' + acquisitionTime + '"'
-                         + ' -mo ACQUISITION_DATETIME_TIMEZONE="GMT"')
+    metadata = getRegistrationMetadata(posError, fitError, isManualRegistration, exifSourcePath)
+    metadata.update(getTiffTagMetadata(exifSourcePath))
 
     # First generate a geotiff that adds metadata but does not change the image data.
     # TODO - This may not be useful unless we can duplicate how they processed their RAW data!
     if (not os.path.exists(noWarpOutputPath)) or overwrite:
         print 'Generating UNWARPED output tiff'
-        cmd = ('gdal_translate ' + extraMetadataString
-               + ' -co "COMPRESS=LZW" -co "tiled=yes"  -co "predictor=2" -a_srs "'
-               + OUTPUT_PROJECTION +'" '+ imagePath +' '+ noWarpOutputPath)
-        
-        ## Include an arbitrary tag with our estimated error amount
-        #if errorMeters:
-        #    cmd += ' -mo "REGISTRATION_ERROR=+/-'+str(errorMeters)+' meters" '
-        
+
         # Include the actual GCPs that we matched to our Landsat data.
         MAX_NUM_GCPS = 500 # Too many GCPs breaks gdal!
-        count = 0
-        for (imagePoint, gdcPoint) in zip(imagePoints, gdcPoints):
-            s = (' -gcp %f %f %f %f' % (imagePoint[0], imagePoint[1], gdcPoint[0], gdcPoint[1]))
-            cmd += s
-            count += 1
-            if count == MAX_NUM_GCPS:
-                break
-            
-        # Generate the file using gdal_translate
-        print cmd
-        os.system(cmd)
-        if not os.path.exists(noWarpOutputPath):
+        gcps = [gdal.GCP(float(gdcPoint[0]), float(gdcPoint[1]), 0.0,
+                         float(imagePoint[0]), float(imagePoint[1]))
+                for (imagePoint, gdcPoint) in zip(imagePoints, gdcPoints)[:MAX_NUM_GCPS]]
+
+        # Generate the file and add the metadata before it is closed.
+        dataset = gdal.Translate(noWarpOutputPath, imagePath, GCPs=gcps,
+                                 outputSRS=OUTPUT_PROJECTION,
+                                 creationOptions=['COMPRESS=LZW', 'TILED=YES', 'PREDICTOR=2'])
+        if dataset is None:
             raise Exception('Failed to create geotiff file: ' + noWarpOutputPath)
-        
+        setDatasetMetadata(dataset, metadata)
+
         if writeHeaders:
-            generateStandaloneMetadataFile(noWarpOutputPath)
-            
+            generateStandaloneMetadataFile(dataset, noWarpOutputPath)
+        dataset = None # Close the file
+
         updateExif(exifSourcePath, noWarpOutputPath)
 
     # Now generate a warped geotiff.
     if (not os.path.exists(warpOutputPath)) or overwrite:
         print 'Generating WARPED output tiff'
 
-        transformName = qualityGdalwarp(imagePath, warpOutputPath, imagePoints, gdcPoints)
-        
-        # Add some extra metadata fields.
-        cmd = ('gdal_edit.py -mo TIFFTAG_DOCUMENTNAME= ' + extraMetadataString
-                + ' -mo RESAMPLING_METHOD=cubic -mo WARP_TRANSFORM='+transformName+' ' + warpOutputPath)
-        #print cmd
-        os.system(cmd)
-    
-        if not os.path.exists(warpOutputPath):
-            raise Exception('Failed to create warped geotiff file: ' + warpOutputPath)
-        
-        if writeHeaders:
-            generateStandaloneMetadataFile(warpOutputPath)
-        
+        qualityGdalwarp(imagePath, warpOutputPath, imagePoints, gdcPoints,
+                        metadata, writeHeaders)
+
         updateExif(exifSourcePath, warpOutputPath)
-        
-    
+
     return (noWarpOutputPath, warpOutputPath)
 
 
-def generateStandaloneMetadataFile(inputImagePath):
-    '''Convert geotiff metadata into a nicely formatted external text file.'''
+def generateStandaloneMetadataFile(dataset, imagePath):
+    '''Write the metadata of an open geotiff into a nicely formatted external text file.'''
 
-    # Silently quit when the input image does not exist, that error should already have
-    #  been handled.
-    if not os.path.exists(inputImagePath):
-        return
+    from osgeo import gdal, osr
 
-    outputPath = os.path.splitext(inputImagePath)[0] + '_metadata.txt'
+    outputPath = os.path.splitext(imagePath)[0] + '_metadata.txt'
 
     print 'Generating metadata file ' + outputPath
 
-    cmd = ['gdalinfo', inputImagePath]
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    textOutput, err = p.communicate()
-
-    lines = textOutput.split('\n')
-
-    imageStartLine = metadataStartLine = coordSystemStartLine = gcpStartLine = imageSizeLine = 0
-    index = 0
-    for line in lines:
-        if 'Image Structure Metadata' in line:
-            imageStartLine = index
-        if line == 'Metadata:':
-            metadataStartLine = index
-        if 'Coordinate System is' in line:
-            coordSystemStartLine = index
-        if 'GCP[  0]' in line:
-            gcpStartLine = index
-        if 'Size is ' in line:
-            imageSizeLine = line
-        
-        index += 1
-
-    headerText = 'File Type: GeoTiff\n' + imageSizeLine + '\n'
-    ipHeader = '''[Tie-Points Used For Georeferencing] {Point format is: (pixel column, pixel row) -> (longitude, latitude, 0)}\n'''
-    
-    if gcpStartLine > 0:
-        ipText = ipHeader + '\n'.join(lines[gcpStartLine:metadataStartLine])
-    else:
-        ipText = ''
-    
-    geoText = '[Geographic Coordinate Information]\n' + '\n'.join(lines[coordSystemStartLine+1:coordSystemStartLine+9])
-    
-    imageText = '[Image Structure Metadata]\n' + '\n'.join(lines[imageStartLine+1:])
+    headerText = ('File Type: GeoTiff\nSize is %d, %d\n'
+                  % (dataset.RasterXSize, dataset.RasterYSize))
+
+    imageText = '[Image Structure Metadata]\n'
+    for (key, value) in sorted(dataset.GetMetadata('IMAGE_STRUCTURE').items()):
+        imageText += '  ' + key + '=' + value + '\n'
+    for b in range(1, dataset.RasterCount+1):
+        band = dataset.GetRasterBand(b)
+        imageText += ('Band %d Type=%s, ColorInterp=%s\n'
+                      % (b, gdal.GetDataTypeName(band.DataType),
+                         gdal.GetColorInterpretationName(band.GetColorInterpretation())))
+
+    projection = dataset.GetProjection() or dataset.GetGCPProjection()
+    prettyWkt  = osr.SpatialReference(projection).ExportToPrettyWkt().split('\n')
+    geoText = '[Geographic Coordinate Information]\n' + '\n'.join(prettyWkt[0:8])
+
+    ipText = ''
+    gcps = dataset.GetGCPs()
+    if gcps:
+        ipText = '''[Tie-Points Used For Georeferencing] {Point format is: (pixel column, pixel row) -> (longitude, latitude, 0)}\n'''
+        for (i, gcp) in enumerate(gcps):
+            ipText += ('GCP[%3d]: Id=%s, Info=%s\n          (%.15g,%.15g) -> (%.15g,%.15g,%.15g)\n'
+                       % (i, gcp.Id, gcp.Info, gcp.GCPPixel, gcp.GCPLine,
+                          gcp.GCPX, gcp.GCPY, gcp.GCPZ))
 
     METADATA_SKIP_LIST = ['TIFFTAG', 'AREA_OR_POINT']
-    
-    metadataText = lines[metadataStartLine+1:imageStartLine]
-    
+
     accuracyText = '[Accuracy Measures For Georeferencing Result]\n'
     cameraText = '[Camera Metadata]\n'
-    for line in metadataText:
+    for (key, value) in sorted(dataset.GetMetadata().items()):
+        line = '  ' + key + '=' + value
         # Ignore certain lines
         skip = False
         for item in METADATA_SKIP_LIST:
@@ -844,7 +1096,7 @@ def generateStandaloneMetadataFile(inputImagePath):
             cameraText += line + '\n'
         else:
             accuracyText += line + '\n'
-            
+
     # Generate the output file
     f = open(outputPath, 'w')
     f.write(headerText + '\n')
@@ -856,7 +1108,7 @@ def generateStandaloneMetadataFile(inputImagePath):
     if len(cameraText) > 20: # The warped image does not have this information
         f.write('\n' + cameraText)
     f.close()
-    
+
     print 'Finished writing header file.'
 
 
@@ -20,10 +20,12 @@ import optparse
 
 import registration_common
 import register_image
+import reference_cache
 import traceback
 import numpy
 import time
 import signal
+import threading
 import multiprocessing
 
 import IrgGeoFunctions
@@ -95,69 +97,48 @@ def findNearbyResults(targetFrameData, sourceDb, georefDb):
     return results
     
 
-def matchLocally(mission, roll, frame, sourceDb, georefDb, sourceImagePath):
-    '''Performs image alignment to an already aligned ISS image'''
-
-    # Load new frame info
-    targetFrameData = source_image_utils.FrameInfo()
-    targetFrameData = sourceDb.loadFrame(mission, roll, frame)
-    targetFrameData = computeFrameInfoMetersPerPixel(targetFrameData)
-
-    # Find candidate names to match to
-    possibleNearbyMatches = findNearbyResults(targetFrameData, sourceDb, georefDb)
-
-    if not possibleNearbyMatches:
-        print 'Did not find any potential local matches!'
-
-    for (otherFrame, ourResult) in possibleNearbyMatches:
-
-        print 'Trying local match with frame: ' + str(otherFrame.frame)
-
-        # Get path to other frame image
-        otherImagePath, exifSourcePath = source_image_utils.getSourceImage(otherFrame)
-        source_image_utils.clearExif(exifSourcePath)
-        otherTransform = ourResult[0] # This is still in the google projected format
+def matchLocallyBatch(targetFrameData, sourceImagePath, candidates, otherImagePaths):
+    '''Align the new image to a group of already aligned frames from findNearbyResults.
+       Returns the matchLocally result for the first usable high confidence
+       alignment, or None if there was not one.'''
 
-        #print 'otherTransform = ' + str(otherTransform.matrix)
-
-        print 'New image mpp = ' + str(targetFrameData.metersPerPixel)
-        print 'Local match image mpp = ' + str(otherFrame.metersPerPixel)
-        # If we could not estimate the MPP value of the new image, guess that it is the same as
-        #  the local reference image we are about to try.
-        thisMpp = targetFrameData.metersPerPixel
-        if not thisMpp:
-            thisMpp = otherFrame.metersPerPixel
-        
+    # The batch alignment stops at the first high confidence result, so if
+    #  that result is rejected below try again with the frames it skipped.
+    untried = range(len(candidates))
+    while untried:
         print 'Attempting to register image...'
-        (imageToProjectedTransform, imageToGdcTransform, confidence, imageInliers, gdcInliers, refMetersPerPixel) = \
-            register_image.register_image(sourceImagePath,
-                                          otherFrame.centerLon, otherFrame.centerLat,
-                                          thisMpp, targetFrameData.date,
-                                          refImagePath         =otherImagePath,
-                                          referenceGeoTransform=otherTransform,
-                                          refMetersPerPixelIn  =otherFrame.metersPerPixel,
-                                          debug=options.debug, force=True, slowMethod=False)       
-        if not options.debug:
-            os.remove(otherImagePath) # Clean up the image we matched against
-
-        # Quit once we get a good match
-        if confidence == registration_common.CONFIDENCE_HIGH:
-            print 'High confidence match!'
+        batchResults = register_image.register_image_batch(sourceImagePath,
+                            targetFrameData.metersPerPixel,
+                            [otherImagePaths[i] for i in untried],
+                            [candidates[i][1][0] for i in untried], # Still in the google projected format
+                            [candidates[i][0].metersPerPixel for i in untried],
+                            debug=options.debug, force=True, slowMethod=False)
+
+        tried = []
+        for (batchIndex, imageToProjectedTransform, imageToGdcTransform, confidence,
+             imageInliers, gdcInliers, refMetersPerPixel) in batchResults:
+            tried.append(batchIndex)
+            (otherFrame, ourResult) = candidates[untried[batchIndex]]
+
+            # Quit once we get a good match
+            if confidence != registration_common.CONFIDENCE_HIGH:
+                continue
+            print 'High confidence match with frame ' + str(otherFrame.frame)
             # Convert from the image-to-image GCPs to the reference image GCPs
             #  located in the new image.
             refFrameGdcInliers = ourResult[3] # TODO: Clean this up!
             (width, height)    = IrgGeoFunctions.getImageSize(sourceImagePath)
-            
+
             print '\n\n'
             print refFrameGdcInliers
             print '\n\n'
-            
+
             (imageInliers, gdcInliers) = registration_common.convertGcps(refFrameGdcInliers,
                                                 imageToProjectedTransform, width, height)
-            
+
             print imageInliers
             print '\n\n'
-            
+
             # If none of the original GCPs fall in the new image, don't use this alignment result.
             # - We could use this result, but we don't in order to maintain accuracy standards.
             if imageInliers:
@@ -168,6 +149,49 @@ def matchLocally(mission, roll, frame, sourceDb, georefDb, sourceImagePath):
             else:
                 print 'Inliers out of bounds!'
 
+        untried = [untried[i] for i in range(len(untried)) if i not in tried]
+    return None
+
+
+def matchLocally(mission, roll, frame, sourceDb, georefDb, sourceImagePath):
+    '''Performs image alignment to an already aligned ISS image'''
+
+    # Load new frame info
+    targetFrameData = source_image_utils.FrameInfo()
+    targetFrameData = sourceDb.loadFrame(mission, roll, frame)
+    targetFrameData = computeFrameInfoMetersPerPixel(targetFrameData)
+
+    # Find candidate names to match to
+    possibleNearbyMatches = findNearbyResults(targetFrameData, sourceDb, georefDb)
+
+    if not possibleNearbyMatches:
+        print 'Did not find any potential local matches!'
+
+    print 'New image mpp = ' + str(targetFrameData.metersPerPixel)
+
+    # Download and align the other frames a few at a time so that the features
+    #  of the new image are shared within each group, but a good match early on
+    #  does not pay for fetching the rest of the candidates.
+    batchSize = max(1, offline_config.LOCAL_ALIGNMENT_BATCH_SIZE)
+    for start in range(0, len(possibleNearbyMatches), batchSize):
+        candidates = possibleNearbyMatches[start:start+batchSize]
+        otherImagePaths = []
+        try:
+            for (otherFrame, ourResult) in candidates:
+                print ('Trying local match with frame: ' + str(otherFrame.frame) +
+                       ', mpp = ' + str(otherFrame.metersPerPixel))
+                otherImagePath, exifSourcePath = source_image_utils.getSourceImage(otherFrame)
+                source_image_utils.clearExif(exifSourcePath)
+                otherImagePaths.append(otherImagePath)
+
+            result = matchLocallyBatch(targetFrameData, sourceImagePath, candidates, otherImagePaths)
+            if result:
+                return result
+        finally:
+            if not options.debug:
+                for otherImagePath in otherImagePaths:
+                    os.remove(otherImagePath) # Clean up the images we matched against
+
     # Match failure, return junk values
     return (registration_common.getIdentityTransform(), registration_common.getIdentityTransform(),
             registration_common.CONFIDENCE_NONE, [], [], 9999, None)
@@ -187,8 +211,10 @@ def doNothing(options, frameInfo, searchNearby, georefDb):
     print 'DO NOTHING'
     return 0
 
-def processFrame(options, frameDbData, searchNearby=False):
+def processFrame(options, frameDbData, searchNearby=False, reference=None):
     '''Process a single specified frame.
+       If provided, reference is an already fetched (refImagePath, percentValid, refMetersPerPixel)
+       which this function deletes when it is finished.
        Returns True if we attempted to perform image alignment and did not hit an exception.'''
     try:
         georefDb = georefDbWrapper.DatabaseLogger()
@@ -211,11 +237,15 @@ def processFrame(options, frameDbData, searchNearby=False):
 
             else: # Try to register the image to Landsat
                 print 'Attempting to register image...'
+                refImagePath = refMetersPerPixelIn = None
+                if reference:
+                    (refImagePath, percentValid, refMetersPerPixelIn) = reference
                 (imageToProjectedTransform, imageToGdcTransform, confidence, imageInliers, gdcInliers, refMetersPerPixel) = \
                     register_image.register_image(sourceImagePath,
                                                   frameDbData.centerLon, frameDbData.centerLat,
                                                   frameDbData.metersPerPixel, frameDbData.date,
-                                                  refImagePath=None,
+                                                  refImagePath=refImagePath,
+                                                  refMetersPerPixelIn=refMetersPerPixelIn,
                                                   debug=False, force=True, slowMethod=True)
                 matchedImageId = 'Landsat'
         except Exception as e:
@@ -249,6 +279,8 @@ def processFrame(options, frameDbData, searchNearby=False):
         # a different tool will actually write the output images.
         if not options.debug:
             os.remove(sourceImagePath) # Clean up the source image
+            if reference and os.path.exists(reference[0]):
+                os.remove(reference[0])
         print ('Finished processing frame ' + frameDbData.getIdString()
                + ' with confidence ' + registration_common.CONFIDENCE_STRINGS[confidence])
         return confidence
@@ -362,6 +394,50 @@ def sleepOnNumJobs(jobList, jobLimit):
                 jobList.remove(job)
 
 
+class PendingFrameJob(object):
+    '''Stands in for the pool result of a frame while its reference image is fetched.'''
+
+    def __init__(self):
+        self._result = None
+        self._event  = threading.Event()
+
+    def setResult(self, result):
+        self._result = result
+        self._event.set()
+
+    def ready(self):
+        return self._event.is_set() and self._result.ready()
+
+    def get(self):
+        while not self._event.wait(1):
+            pass
+        return self._result.get()
+
+
+def makeFrameDispatcher(pool, options, frameInfo, job):
+    '''Returns a callback which adds the frame to the processing pool once its
+       reference image has been fetched.'''
+    def dispatch(reference):
+        print 'Registration Processor assigning job: ' + frameInfo.getIdString()
+        job.setResult(pool.apply_async(processFrame,
+                                       args=(options, frameInfo, options.localSearch, reference)))
+    return dispatch
+
+
+def dispatchAfterPrefetch(pool, options, frameInfo, prefetchJob):
+    '''Returns a PendingFrameJob for a frame which is added to the processing pool
+       once the prefetch job for its group of frames finishes, without blocking.'''
+    job = PendingFrameJob()
+    dispatch = makeFrameDispatcher(pool, options, frameInfo, job)
+    def waitForPrefetch():
+        prefetchJob.wait() # The frame fetches its own reference image if the prefetch failed
+        dispatch(None)
+    thread = threading.Thread(target=waitForPrefetch)
+    thread.setDaemon(True)
+    thread.start()
+    return job
+
+
 def initWorker():
     '''Called at the start of each process'''
     signal.signal(signal.SIGINT, signal.SIG_IGN)
@@ -395,6 +471,13 @@ def registrationProcessor(options):
     print 'Setting up worker pool with ' + str(options.numThreads) +' threads.'
     pool = multiprocessing.Pool(options.numThreads, initWorker)
 
+    # Reference images are fetched on separate threads so that the pool
+    #  processes spend their time on image alignment.
+    fetchService = None
+    if (offline_config.REFERENCE_FETCH_THREADS > 0) and not options.localSearch:
+        fetchService = reference_cache.ReferenceFetchService(offline_config.REFERENCE_FETCH_THREADS,
+                                                             offline_config.REFERENCE_FETCH_DEADLINE)
+
     # Don't let our list of pending jobs get too enormous.
     jobLimit = options.limit
     if (jobLimit < 1) or (jobLimit > 60):
@@ -402,6 +485,7 @@ def registrationProcessor(options):
 
     readyFrames = []
     jobList  = []
+    prefetchJobs = {} # Frame ID -> pool result of the prefetch covering that frame
     count = 0
     
     try:
@@ -443,17 +527,50 @@ def registrationProcessor(options):
                 for frame in readyFrames:
                     print frame.getIdString()
 
+                # Fetch one reference image for each group of nearby frames so that
+                #  the jobs can cut their reference images from the chip cache.
+                if fetchService:
+                    fetchService.prefetchClusters([(frame.centerLon, frame.centerLat,
+                                                    frame.metersPerPixel, frame.date)
+                                                   for frame in readyFrames])
+                elif not options.localSearch:
+                    # The frames in a group wait for its prefetch job when they are assigned.
+                    requests = []
+                    frameIds = {}
+                    for frame in readyFrames:
+                        request = (frame.centerLon, frame.centerLat, frame.metersPerPixel, frame.date)
+                        requests.append(request)
+                        frameIds[request] = frame.getIdString()
+                    for cluster in reference_cache.getPrefetchClusters(requests):
+                        prefetchJob = pool.apply_async(reference_cache.prefetchReferenceCluster,
+                                                       args=(cluster,))
+                        for request in cluster:
+                            prefetchJobs[frameIds[request]] = prefetchJob
+
                 #if count > 0:
                 #    raise Exception('DEBUG!!!')
 
                 print '============================================================='
     
             frameInfo = readyFrames.pop() # Grab one of the ready frames from the list
-    
-            print 'Registration Processor assigning job: ' + frameInfo.getIdString()
 
-            # Add this process to the processing pool
-            processResult = pool.apply_async(processFrame, args=(options, frameInfo, options.localSearch))
+            if fetchService:
+                # The frame is added to the processing pool once its reference image arrives
+                print 'Registration Processor fetching reference for: ' + frameInfo.getIdString()
+                processResult = PendingFrameJob()
+                fetchService.submit((frameInfo.centerLon, frameInfo.centerLat,
+                                     frameInfo.metersPerPixel, frameInfo.date),
+                                    makeFrameDispatcher(pool, options, frameInfo, processResult))
+            else:
+                prefetchJob = prefetchJobs.pop(frameInfo.getIdString(), None)
+                if prefetchJob and not prefetchJob.ready():
+                    print 'Registration Processor waiting on reference prefetch for: ' + frameInfo.getIdString()
+                    processResult = dispatchAfterPrefetch(pool, options, frameInfo, prefetchJob)
+                else:
+                    print 'Registration Processor assigning job: ' + frameInfo.getIdString()
+
+                    # Add this process to the processing pool
+                    processResult = pool.apply_async(processFrame, args=(options, frameInfo, options.localSearch))
 
             # Hang on to the process handle and the associated frame ID
             jobList.append((frameInfo.getIdString(), processResult))
@@ -488,6 +605,9 @@ def registrationProcessor(options):
         pool.terminate()
         pool.join()
 
+    if fetchService:
+        fetchService.cleanup()
+
     print '---=== Registration Processor has stopped ===---'
     
     
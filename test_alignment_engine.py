@@ -0,0 +1,67 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+'''
+    Tests for reading the stage timing reported by the C++ aligner.
+'''
+
+import unittest
+
+import alignment_engine
+
+# Formatted the same way as AlignmentTiming::toJson() in imageAlignment.h
+TIMING_TEXT = ('{"stages": {"load": 0.125, "coarse_detect": 1.5, "match": 2e-05}, '
+               '"counts": {"coarse_ref_keypoints": 4000, "inliers": 31}, "total": 1.62502}')
+
+
+class ParseTimingTest(unittest.TestCase):
+
+    def test_parseTiming(self):
+        timing = alignment_engine.parseTiming(TIMING_TEXT)
+        self.assertEqual(timing['stages'], {'load': 0.125, 'coarse_detect': 1.5, 'match': 2e-05})
+        self.assertEqual(timing['counts'], {'coarse_ref_keypoints': 4000, 'inliers': 31})
+        self.assertAlmostEqual(timing['total'], 1.62502)
+
+    def test_emptyTiming(self):
+        for text in [None, '']:
+            self.assertEqual(alignment_engine.parseTiming(text),
+                             {'stages': {}, 'counts': {}, 'total': 0.0})
+        timing = alignment_engine.parseTiming('{"stages": {}, "counts": {}, "total": 0}')
+        self.assertEqual(timing, {'stages': {}, 'counts': {}, 'total': 0})
+
+    def test_emptyTimingIsNotShared(self):
+        first = alignment_engine.parseTiming(None)
+        first['stages']['load'] = 1.0
+        self.assertEqual(alignment_engine.parseTiming(None)['stages'], {})
+
+    def test_invalidTiming(self):
+        self.assertRaises(ValueError, alignment_engine.parseTiming, '{"stages": ')
+
+    def test_addTiming(self):
+        timing = alignment_engine.parseTiming(None)
+        alignment_engine.addTiming(timing, alignment_engine.parseTiming(TIMING_TEXT))
+        other = alignment_engine.parseTiming('{"stages": {"load": 0.5, "refine_match": 1.0}, '
+                                             '"counts": {"inliers": 12}, "total": 1.5}')
+        result = alignment_engine.addTiming(timing, other)
+        self.assertTrue(result is timing)
+        self.assertEqual(timing['stages'], {'load': 0.625, 'coarse_detect': 1.5,
+                                            'match': 2e-05, 'refine_match': 1.0})
+        self.assertEqual(timing['counts'], {'coarse_ref_keypoints': 4000, 'inliers': 12})
+        self.assertAlmostEqual(timing['total'], 3.12502)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+'''
+    Tests for reading image sizes from file headers in IrgGeoFunctions.
+    The fixture files only contain the header bytes needed to find the size.
+'''
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import IrgGeoFunctions
+
+
+def makeJpegSegment(marker, payload):
+    '''Returns the bytes of a JPEG marker segment with a length field'''
+    return '\xff' + chr(marker) + struct.pack('>H', len(payload) + 2) + payload
+
+def makeJpegHeader(width, height, sofMarker=0xC0, includeExif=False):
+    '''Returns the start of a JPEG file up to and including the start of frame segment'''
+    data = '\xff\xd8'
+    if includeExif:
+        # A minimal APP1 block with an empty little endian TIFF structure
+        exif = 'Exif\x00\x00' + 'II*\x00' + struct.pack('<IH', 8, 0) + '\x00' * 64
+        data += makeJpegSegment(0xE1, exif)
+    else:
+        data += makeJpegSegment(0xE0, 'JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00')
+    data += makeJpegSegment(0xDB, '\x00' + '\x01' * 64) # Quantization table
+    data += makeJpegSegment(sofMarker, struct.pack('>BHHB', 8, height, width, 1) + '\x01\x11\x00')
+    data += makeJpegSegment(0xC4, '\x00' + '\x00' * 16) # Huffman table
+    return data
+
+def makeTiffHeader(width, height, order, fieldType):
+    '''Returns a TIFF header with a single image file directory holding the size'''
+    valueFormat = {3:'H', 4:'I'}[fieldType]
+    def makeEntry(tag, value):
+        valueBytes = struct.pack(order + valueFormat, value).ljust(4, '\x00')
+        return struct.pack(order + 'HHI', tag, fieldType, 1) + valueBytes
+    magic = 'II' if (order == '<') else 'MM'
+    data  = magic + struct.pack(order + 'HI', 42, 8)
+    data += struct.pack(order + 'H', 3)
+    data += makeEntry(256, width)
+    data += makeEntry(257, height)
+    data += makeEntry(277, 3) # Samples per pixel, ignored
+    data += struct.pack(order + 'I', 0)
+    return data
+
+
+class ImageSizeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.gdalPaths = []
+        self.originalGdal = IrgGeoFunctions.getImageSizeGdal
+        IrgGeoFunctions.getImageSizeGdal = self.fakeGdalSize
+        IrgGeoFunctions._imageSizeCache.clear()
+
+    def tearDown(self):
+        IrgGeoFunctions.getImageSizeGdal = self.originalGdal
+        IrgGeoFunctions._imageSizeCache.clear()
+        shutil.rmtree(self.folder)
+
+    def fakeGdalSize(self, imagePath):
+        '''Stands in for GDAL and records which files needed it'''
+        self.gdalPaths.append(imagePath)
+        return [11, 7]
+
+    def writeFile(self, name, data):
+        path = os.path.join(self.folder, name)
+        with open(path, 'wb') as handle:
+            handle.write(data)
+        return path
+
+    def test_baselineJpeg(self):
+        path = self.writeFile('baseline.jpg', makeJpegHeader(640, 480))
+        self.assertEqual(IrgGeoFunctions.getImageSize(path), [640, 480])
+        self.assertEqual(self.gdalPaths, [])
+
+    def test_progressiveJpeg(self):
+        path = self.writeFile('progressive.jpg', makeJpegHeader(4288, 2848, sofMarker=0xC2))
+        self.assertEqual(IrgGeoFunctions.getImageSize(path), [4288, 2848])
+        self.assertEqual(self.gdalPaths, [])
+
+    def test_jpegWithExif(self):
+        path = self.writeFile('exif.jpg', makeJpegHeader(3032, 2064, includeExif=True))
+        self.assertEqual(IrgGeoFunctions.getImageSize(path), [3032, 2064])
+        self.assertEqual(self.gdalPaths, [])
+
+    def test_littleEndianTiff(self):
+        path = self.writeFile('little.tif', makeTiffHeader(1500, 1200, '<', 3))
+        self.assertEqual(IrgGeoFunctions.getImageSize(path), [1500, 1200])
+        self.assertEqual(self.gdalPaths, [])
+
+    def test_bigEndianTiff(self):
+        path = self.writeFile('big_short.tif', makeTiffHeader(1500, 1200, '>', 3))
+        self.assertEqual(IrgGeoFunctions.getImageSize(path), [1500, 1200])
+        path = self.writeFile('big_long.tif', makeTiffHeader(70000, 65600, '>', 4))
+        self.assertEqual(IrgGeoFunctions.getImageSize(path), [70000, 65600])
+        self.assertEqual(self.gdalPaths, [])
+
+    def test_gdalFallback(self):
+        # Unknown format, JPEG with the height defined later, truncated JPEG, BigTIFF
+        paths = [self.writeFile('image.png', '\x89PNG\r\n\x1a\n' + '\x00' * 32),
+                 self.writeFile('dnl.jpg',   makeJpegHeader(640, 0)),
+                 self.writeFile('short.jpg', makeJpegHeader(640, 480)[0:30]),
+                 self.writeFile('big.tif',   'II+\x00' + struct.pack('<HHQ', 8, 0, 16))]
+        for path in paths:
+            self.assertEqual(IrgGeoFunctions.getImageSize(path), [11, 7])
+        self.assertEqual(self.gdalPaths, paths)
+
+    def test_cacheUpdatesWhenFileChanges(self):
+        path = self.writeFile('changed.jpg', makeJpegHeader(640, 480))
+        self.assertEqual(IrgGeoFunctions.getImageSize(path), [640, 480])
+        self.writeFile('changed.jpg', makeJpegHeader(1280, 960, includeExif=True))
+        self.assertEqual(IrgGeoFunctions.getImageSize(path), [1280, 960])
+
+    def test_cacheDropsLeastRecentlyUsed(self):
+        originalMax = IrgGeoFunctions.IMAGE_SIZE_CACHE_MAX_ENTRIES
+        IrgGeoFunctions.IMAGE_SIZE_CACHE_MAX_ENTRIES = 2
+        try:
+            paths = [self.writeFile('image%d.png' % i, 'not an image') for i in range(3)]
+            IrgGeoFunctions.getImageSize(paths[0])
+            IrgGeoFunctions.getImageSize(paths[1])
+            IrgGeoFunctions.getImageSize(paths[0]) # Cached, now the most recent entry
+            IrgGeoFunctions.getImageSize(paths[2]) # Drops paths[1]
+            self.assertEqual(list(IrgGeoFunctions._imageSizeCache.keys()), [paths[0], paths[2]])
+            self.assertEqual(self.gdalPaths, [paths[0], paths[1], paths[2]])
+        finally:
+            IrgGeoFunctions.IMAGE_SIZE_CACHE_MAX_ENTRIES = originalMax
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,253 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+'''
+    Tests for the reference image fetch helpers which do not contact Earth Engine.
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import ee
+import offline_config
+import reference_cache
+from ImageFetcher import miscUtilities
+
+# Importing the fetcher initializes Earth Engine, which chooseSensor does not need.
+_eeInitialize = ee.Initialize
+ee.Initialize = lambda *args, **kwargs: None
+try:
+    from ImageFetcher import fetchReferenceImage
+finally:
+    ee.Initialize = _eeInitialize
+
+
+class FakeClock(object):
+    '''Replaces the time module in miscUtilities so that sleeping is instant'''
+
+    def __init__(self):
+        self.now    = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakeRandom(object):
+    '''Always waits the longest allowed backoff delay'''
+
+    def uniform(self, low, high):
+        return high
+
+
+class FailingFunction(object):
+    '''Raises an exception for the first numFailures calls'''
+
+    def __init__(self, numFailures):
+        self.numFailures = numFailures
+        self.numCalls    = 0
+
+    def __call__(self):
+        self.numCalls += 1
+        if self.numCalls <= self.numFailures:
+            raise Exception('failure %d' % self.numCalls)
+        return 'result'
+
+
+class RetryWithBackoffTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.originalTime   = miscUtilities.time
+        self.originalRandom = miscUtilities.random
+        miscUtilities.time   = self.clock
+        miscUtilities.random = FakeRandom()
+
+    def tearDown(self):
+        miscUtilities.time   = self.originalTime
+        miscUtilities.random = self.originalRandom
+
+    def test_noRetryOnSuccess(self):
+        function = FailingFunction(0)
+        self.assertEqual(miscUtilities.retryWithBackoff(function, 5, 2, 60), 'result')
+        self.assertEqual(function.numCalls, 1)
+        self.assertEqual(self.clock.sleeps, [])
+
+    def test_exponentialBackoff(self):
+        function = FailingFunction(5)
+        self.assertEqual(miscUtilities.retryWithBackoff(function, 6, 2, 20), 'result')
+        self.assertEqual(function.numCalls, 6)
+        # The delay limit doubles after each failure until it reaches maxDelay
+        self.assertEqual(self.clock.sleeps, [4, 8, 16, 20, 20])
+
+    def test_giveUpAfterMaxAttempts(self):
+        function = FailingFunction(10)
+        try:
+            miscUtilities.retryWithBackoff(function, 3, 2, 60)
+            self.fail('Expected an exception')
+        except Exception as e:
+            self.assertEqual(str(e), 'failure 3')
+        self.assertEqual(function.numCalls, 3)
+        self.assertEqual(len(self.clock.sleeps), 2)
+
+    def test_noAttemptAfterDeadline(self):
+        function = FailingFunction(10)
+        deadline = self.clock.now + 10
+        try:
+            miscUtilities.retryWithBackoff(function, 10, 2, 60, deadline)
+            self.fail('Expected an exception')
+        except Exception as e:
+            self.assertEqual(str(e), 'failure 2')
+        # The second delay of 8 seconds would end after the deadline
+        self.assertEqual(self.clock.sleeps, [4])
+        self.assertTrue(self.clock.now <= deadline)
+
+    def test_getRemainingSeconds(self):
+        self.assertTrue(miscUtilities.getRemainingSeconds(None) is None)
+        self.assertEqual(miscUtilities.getRemainingSeconds(self.clock.now + 30), 30)
+        self.assertRaises(Exception, miscUtilities.getRemainingSeconds, self.clock.now)
+
+    def test_getInfoBefore(self):
+        class FakeEeObject(object):
+            numCalls = 0
+            def getInfo(self):
+                self.numCalls += 1
+                return {'bands': []}
+        eeObject = FakeEeObject()
+        self.assertEqual(miscUtilities.getInfoBefore(eeObject, None), {'bands': []})
+        self.assertEqual(miscUtilities.getInfoBefore(eeObject, self.clock.now + 5), {'bands': []})
+        self.assertRaises(Exception, miscUtilities.getInfoBefore, eeObject, self.clock.now)
+        self.assertEqual(eeObject.numCalls, 2)
+
+
+class ChooseSensorTest(unittest.TestCase):
+
+    def test_firstSensorWithEnoughImages(self):
+        enough = fetchReferenceImage.DESIRED_NUM_IMAGES
+        self.assertEqual(fetchReferenceImage.chooseSensor([enough, 50, 50]), (0, False))
+        self.assertEqual(fetchReferenceImage.chooseSensor([enough-1, enough, 50]), (1, False))
+        self.assertEqual(fetchReferenceImage.chooseSensor([0, 3, enough+5]), (2, False))
+
+    def test_mostImagesWhenNoneHaveEnough(self):
+        self.assertEqual(fetchReferenceImage.chooseSensor([2, 5, 1]), (1, True))
+        self.assertEqual(fetchReferenceImage.chooseSensor([4, 0, 4]), (0, True))
+
+    def test_noImages(self):
+        self.assertTrue(fetchReferenceImage.chooseSensor([0, 0, 0]) is None)
+
+
+class ChipCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_newChipPathsAreUnique(self):
+        cache = reference_cache.ReferenceChipCache(self.folder, 1024*1024)
+        paths = [cache.getNewChipPath() for i in range(100)]
+        self.assertEqual(len(set(paths)), len(paths))
+        for path in paths:
+            self.assertEqual(os.path.dirname(path), self.folder)
+            self.assertFalse(os.path.exists(path))
+
+
+class FakeChipCache(object):
+    '''Reports the requests at cachedLatitudes as already covered by a chip'''
+
+    def __init__(self, cachedLatitudes):
+        self.cachedLatitudes = cachedLatitudes
+        self.sensors = []
+
+    def findChip(self, bounds, metersPerPixel, season, sensor=None):
+        self.sensors.append(sensor)
+        centerLat = (bounds[1] + bounds[3]) / 2.0
+        for lat in self.cachedLatitudes:
+            if abs(centerLat - lat) < 1e-6:
+                return ('chip.tif', metersPerPixel, sensor, 1.0)
+        return None
+
+
+class PrefetchClustersTest(unittest.TestCase):
+
+    # At 50 meters per pixel each request covers 100km, and a fetched chip
+    #  can be up to 150km on a side.
+    MPP  = 50
+    DATE = '2002.09.26'
+
+    def setUp(self):
+        self.originalSource   = offline_config.REFERENCE_SOURCE
+        self.originalMaxSize  = offline_config.REFERENCE_MAX_FETCH_SIZE
+        self.originalGetCache = reference_cache.getChipCache
+        self.originalGetSensor = reference_cache.getChosenSensor
+        offline_config.REFERENCE_SOURCE = 'earthengine'
+        offline_config.REFERENCE_MAX_FETCH_SIZE = 3000
+        self.cache = FakeChipCache([])
+        reference_cache.getChipCache    = lambda: self.cache
+        reference_cache.getChosenSensor = lambda lon, lat, date: 'LC8_L1T'
+
+    def tearDown(self):
+        offline_config.REFERENCE_SOURCE = self.originalSource
+        offline_config.REFERENCE_MAX_FETCH_SIZE = self.originalMaxSize
+        reference_cache.getChipCache    = self.originalGetCache
+        reference_cache.getChosenSensor = self.originalGetSensor
+
+    def makeRequests(self, latitudes, mpp=None, date=None):
+        return [(0.0, lat, mpp or self.MPP, date or self.DATE) for lat in latitudes]
+
+    def test_groupsNearbyRequests(self):
+        # Requests 0.3 degrees apart, two fit in each chip
+        requests = self.makeRequests([0.0, 0.3, 0.6, 0.9])
+        self.assertEqual(reference_cache.getPrefetchClusters(requests),
+                         [requests[0:2], requests[2:4]])
+        self.assertEqual(self.cache.sensors, ['LC8_L1T']*4)
+
+    def test_singleRequestsAreDropped(self):
+        requests = self.makeRequests([0.0, 0.3, 1.0, 2.0])
+        self.assertEqual(reference_cache.getPrefetchClusters(requests), [requests[0:2]])
+        self.assertEqual(reference_cache.getPrefetchClusters(requests[2:4]), [])
+
+    def test_seasonAndResolutionSplitClusters(self):
+        requests = (self.makeRequests([0.0, 0.1]) +
+                    self.makeRequests([0.2, 0.3], date='2002.10.02') +
+                    self.makeRequests([0.4, 0.5], mpp=self.MPP*1.2))
+        self.assertEqual(reference_cache.getPrefetchClusters(requests),
+                         [requests[0:2], requests[2:4], requests[4:6]])
+
+    def test_cachedRequestsAreSkipped(self):
+        self.cache.cachedLatitudes = [0.2]
+        requests = self.makeRequests([0.0, 0.2, 0.3])
+        self.assertEqual(reference_cache.getPrefetchClusters(requests),
+                         [[requests[0], requests[2]]])
+
+    def test_noClustersWithoutCache(self):
+        requests = self.makeRequests([0.0, 0.3])
+        reference_cache.getChipCache = lambda: None
+        self.assertEqual(reference_cache.getPrefetchClusters(requests), [])
+        reference_cache.getChipCache = lambda: self.cache
+        offline_config.REFERENCE_SOURCE = 'local'
+        self.assertEqual(reference_cache.getPrefetchClusters(requests), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
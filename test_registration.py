@@ -24,6 +24,7 @@ import numpy
 import ImageFetcher.miscUtilities
 import ImageFetcher.fetchReferenceImage
 import register_image
+import registration_common
 import IrgStringFunctions, IrgGeoFunctions
 from __builtin__ import True
 
@@ -134,8 +135,8 @@ def runTest(test, options):
     force = not options.useExisting
     debug = True
     slowMethod = True
-    (tform, confidence, testInliers, refInliers) = register_image.alignImages(testImagePath, refImagePath, workPrefix, force, debug, slowMethod)
-    if confidence == register_image.CONFIDENCE_NONE:
+    (tform, confidence, testInliers, refInliers, timing) = registration_common.alignImages(testImagePath, refImagePath, workPrefix, force, debug, slowMethod)
+    if confidence == registration_common.CONFIDENCE_NONE:
         raise Exception('Failed to register image!')
 
     # TODO: First generate the ideal transform for every data set!
@@ -193,7 +194,7 @@ def main():
                                                                 seqSeed.imageCenterLoc[1],
                                                                 seqSeed.focalLength,
                                                                 seqSeed.date)
-        if not (confidence == register_image.CONFIDENCE_HIGH):
+        if not (confidence == registration_common.CONFIDENCE_HIGH):
             raise Exception('Cannot run sequence test if first image fails!')
         
         # Run all the other images
@@ -223,14 +224,14 @@ def main():
             (score, confidence, geoTransform) = runTest(i, options)
         except Exception, e:
             score      = 0
-            confidence = register_image.CONFIDENCE_NONE
+            confidence = registration_common.CONFIDENCE_NONE
             print 'Failed to process image ' + i.imagePath
             print(traceback.format_exc())
             
         results.append(score)
         
         confidenceCounts[confidence] += 1
-        print i.imagePath + ' ---> ' + str(score) + ' == ' + register_image.CONFIDENCE_STRINGS[confidence]
+        print i.imagePath + ' ---> ' + str(score) + ' == ' + registration_common.CONFIDENCE_STRINGS[confidence]
         
         print "transform"
         print geoTransform
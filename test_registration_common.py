@@ -0,0 +1,196 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+'''
+    Checks the vectorized point helpers in registration_common against the
+    per-point transform.py functions they replaced.
+'''
+
+import unittest
+import numpy
+
+import registration_common
+from geocamTiePoint import transform
+
+
+class ShiftTransform(object):
+    '''A transform without a matrix, used to check the per-point fallback'''
+
+    def forward(self, pt):
+        return [pt[0] + 0.001*pt[1]**2, pt[1] - 3.0]
+
+    def reverse(self, pt):
+        y = pt[1] + 3.0
+        return [pt[0] - 0.001*y**2, y]
+
+
+def makeProjective(matrix):
+    return transform.ProjectiveTransform(numpy.matrix(matrix, dtype='float64'))
+
+# A transform like the ones computed between an input image and a reference image
+PROJECTIVE = [[ 1.02,   0.05, -130.0],
+              [-0.04,   0.97,  245.5],
+              [ 2e-5, -1.5e-5,   1.0]]
+AFFINE     = [[ 0.5,  0.1,  10.0],
+              [-0.1,  0.5, -20.0],
+              [ 0.0,  0.0,   1.0]]
+
+def forwardEach(tform, points):
+    return numpy.array([numpy.asarray(tform.forward(p), dtype='float64').ravel()
+                        for p in points])
+
+def reverseEach(tform, points):
+    return numpy.array([numpy.asarray(tform.reverse(p), dtype='float64').ravel()
+                        for p in points])
+
+
+class PointHelperTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pixels = registration_common.getPixelGrid(4288, 2848, 7)
+
+    def test_getPixelGrid(self):
+        grid = registration_common.getPixelGrid(4288, 2848, 5)
+        self.assertEqual(grid.shape, (25, 2))
+        # The grid reaches every corner of a landscape image
+        for corner in [(0, 0), (4287, 0), (0, 2847), (4287, 2847)]:
+            self.assertTrue(numpy.any(numpy.all(numpy.abs(grid - corner) < 1e-9, axis=1)))
+        self.assertTrue(numpy.all(registration_common.arePixelsValid(grid, (4288, 2848))))
+        self.assertEqual(len(set(grid[:,0])), 5)
+        self.assertEqual(len(set(grid[:,1])), 5)
+
+    def test_arePixelsValid(self):
+        size   = (100, 50)
+        pixels = numpy.array([[0, 0], [99.5, 49.5], [100, 10], [10, 50],
+                              [-0.1, 10], [10, -0.1], [50, 25]])
+        expected = [registration_common.isPixelValid(p, size) for p in pixels]
+        self.assertEqual(list(registration_common.arePixelsValid(pixels, size)), expected)
+
+    def test_forwardPointsMatchesTransform(self):
+        for matrix in [PROJECTIVE, AFFINE]:
+            tform = makeProjective(matrix)
+            numpy.testing.assert_allclose(registration_common.forwardPoints(tform, self.pixels),
+                                          forwardEach(tform, self.pixels), rtol=1e-12, atol=1e-9)
+
+    def test_reversePointsMatchesTransform(self):
+        for matrix in [PROJECTIVE, AFFINE]:
+            tform = makeProjective(matrix)
+            numpy.testing.assert_allclose(registration_common.reversePoints(tform, self.pixels),
+                                          reverseEach(tform, self.pixels), rtol=1e-12, atol=1e-9)
+
+    def test_forwardReverseRoundTrip(self):
+        tform    = makeProjective(PROJECTIVE)
+        forward  = registration_common.forwardPoints(tform, self.pixels)
+        restored = registration_common.reversePoints(tform, forward)
+        numpy.testing.assert_allclose(restored, self.pixels, atol=1e-6)
+
+    def test_pointsWithoutMatrixUseFallback(self):
+        tform = ShiftTransform()
+        numpy.testing.assert_allclose(registration_common.forwardPoints(tform, self.pixels),
+                                      forwardEach(tform, self.pixels))
+        numpy.testing.assert_allclose(registration_common.reversePoints(tform, self.pixels),
+                                      reverseEach(tform, self.pixels))
+
+    def test_singlePoint(self):
+        tform  = makeProjective(PROJECTIVE)
+        result = registration_common.forwardPoints(tform, [100.0, 200.0])
+        self.assertEqual(result.shape, (1, 2))
+        numpy.testing.assert_allclose(result[0], forwardEach(tform, [[100.0, 200.0]])[0])
+
+    def test_lonLatToMetersArray(self):
+        lonLat = numpy.array([[0.0, 0.0], [-122.06, 37.41], [151.2, -33.87],
+                              [179.9, 84.0], [-179.9, -84.0]])
+        expected = numpy.array([transform.lonLatToMeters(p) for p in lonLat])
+        numpy.testing.assert_allclose(registration_common.lonLatToMetersArray(lonLat),
+                                      expected, rtol=1e-12, atol=1e-6)
+
+    def test_metersToLonLatArray(self):
+        meters = numpy.array([[0.0, 0.0], [-1.3587e7, 4.497e6], [1.6832e7, -4.0107e6],
+                              [2.0e7, 1.9e7]])
+        expected = numpy.array([transform.metersToLatLon(p) for p in meters])
+        numpy.testing.assert_allclose(registration_common.metersToLonLatArray(meters),
+                                      expected, rtol=1e-12, atol=1e-9)
+
+    def test_projectionRoundTrip(self):
+        lonLat = numpy.column_stack([numpy.linspace(-179.0, 179.0, 20),
+                                     numpy.linspace( -80.0,  80.0, 20)])
+        meters = registration_common.lonLatToMetersArray(lonLat)
+        numpy.testing.assert_allclose(registration_common.metersToLonLatArray(meters),
+                                      lonLat, atol=1e-9)
+
+
+class ComposeTransformsTest(unittest.TestCase):
+
+    def test_composeMatchesChainedForward(self):
+        outer    = makeProjective(AFFINE)
+        inner    = makeProjective(PROJECTIVE)
+        composed = registration_common.composeTransforms(outer, inner)
+        pixels   = registration_common.getPixelGrid(3000, 2000, 6)
+        chained  = forwardEach(outer, forwardEach(inner, pixels))
+        numpy.testing.assert_allclose(forwardEach(composed, pixels), chained,
+                                      rtol=1e-12, atol=1e-9)
+
+    def test_composeWithoutMatrix(self):
+        tform = makeProjective(AFFINE)
+        self.assertTrue(registration_common.composeTransforms(tform, ShiftTransform()) is None)
+        self.assertTrue(registration_common.composeTransforms(ShiftTransform(), tform) is None)
+
+
+class AlignmentScalingTest(unittest.TestCase):
+
+    TOLERANCE = 0.10
+
+    def test_getAlignmentScaling(self):
+        # (testImageScaling, reduction, testScale)
+        cases = [(1.0,  1, 1.0),
+                 (1.05, 1, 1.0),
+                 (2.0,  1, 2.0),
+                 (0.8,  1, 0.8),
+                 (0.5,  2, 1.0),
+                 (0.3,  2, 0.6),
+                 (0.26, 4, 1.0),
+                 (0.2,  4, 0.8),
+                 (0.1,  8, 0.8)]
+        for (scaling, reduction, testScale) in cases:
+            result = registration_common.getAlignmentScaling(scaling, self.TOLERANCE)
+            self.assertEqual(result[0], reduction)
+            self.assertAlmostEqual(result[1], testScale)
+
+    def test_scalingIsPreserved(self):
+        # Unless testScale snaps to 1, the decode reduction and resize give the requested scaling
+        for scaling in numpy.linspace(0.05, 3.0, 60):
+            (reduction, testScale) = registration_common.getAlignmentScaling(scaling, self.TOLERANCE)
+            self.assertTrue(reduction in [1, 2, 4, 8])
+            if testScale == 1.0:
+                self.assertTrue(abs(scaling*reduction - 1.0) < self.TOLERANCE)
+            else:
+                self.assertAlmostEqual(testScale / reduction, scaling)
+
+    def test_descaleAlignment(self):
+        scaling     = 0.25
+        scaledTform = list(numpy.array(PROJECTIVE).ravel())
+        (tform, testInliers) = registration_common.descaleAlignment(scaledTform,
+                                                                    [(100.0, 50.0)], scaling)
+        self.assertEqual(testInliers, [(400.0, 200.0)])
+        pixels = registration_common.getPixelGrid(4000, 3000, 5)
+        numpy.testing.assert_allclose(
+            forwardEach(makeProjective(numpy.reshape(tform, (3, 3))), pixels),
+            forwardEach(makeProjective(PROJECTIVE), pixels * scaling),
+            rtol=1e-12, atol=1e-9)
+
+
+if __name__ == '__main__':
+    unittest.main()